@@ -0,0 +1,469 @@
+# -*- coding:utf-8 -*-
+"""
+SATree性能测试,使用SQLite数据库
+用法:
+    python benchmark.py index --size 1000000     #比较有无树字段索引时的查询计划及耗时
+    python benchmark.py write --sizes 1000,10000,100000,1000000   #增加、移动、删除节点的耗时、语句数及影响的记录数
+    python benchmark.py read --json read.json    #关系查询及输出的耗时，结果保存为JSON以便比较不同版本
+    python benchmark.py write --backends nested,closure   #比较左右值与闭包表两种存储方式
+    python benchmark.py cte --sizes 10000,100000  #比较祖先节点、限定层数的后代节点使用左右值区间与递归CTE查询的耗时
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import sessionmaker
+
+from satree import TreeManager, ClosureTreeManager, TreeMixin, TreeNodeNotFound, TREE_NODE_RELATION, TREE_QUERY_MODE
+
+Base = declarative_base()
+
+
+class Node(Base, TreeMixin):
+    __tablename__ = "node"
+    __tree_output_fields__ = ["name"]
+    id = Column(Integer, primary_key=True)
+    name = Column(String(60), default="")
+
+    def __repr__(self):
+        return "Node(%s)" % self.name
+
+
+class ParentNode(Base, TreeMixin):
+    """ 定义了父节点字段的节点，用来测试递归CTE查询 """
+    __tablename__ = "parent_node"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(60), default="")
+    tree_parent_id = Column(Integer)
+
+
+class StatementCounter(object):
+    """
+    记录执行的SQL语句数量、影响的记录数，以及reset后执行的第一条语句
+    """
+
+    def __init__(self, engine):
+        self.statements = 0
+        self.rows = 0
+        self.first_statement = None
+        event.listen(engine, "before_cursor_execute", self.before_execute)
+        event.listen(engine, "after_cursor_execute", self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+        if self.first_statement is None:
+            self.first_statement = (statement, parameters)
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith("SELECT") and cursor.rowcount > 0:
+            self.rows += cursor.rowcount
+
+    def reset(self):
+        self.statements = 0
+        self.rows = 0
+        self.first_statement = None
+
+
+BACKENDS = {"nested": TreeManager, "closure": ClosureTreeManager}
+
+QUERY_MODES = {"nested": TREE_QUERY_MODE.Nested, "cte": TREE_QUERY_MODE.Cte, "auto": TREE_QUERY_MODE.Auto}
+
+
+def open_db(path=None, backend="nested", model=Node):
+    """
+    创建测试数据库,返回(engine,session,TreeManager,StatementCounter)
+    :param backend: nested-左右值(TreeManager)，closure-闭包表(ClosureTreeManager)
+    :param model: 节点类
+    """
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+    engine = create_engine("sqlite:///%s" % path)
+    tm = BACKENDS[backend](model, None)
+    if backend == "closure":
+        tm.get_closure_table()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    #create_indexes会把索引加入到表定义中，新建的数据库总是从没有索引开始
+    for index in model.__table__.indexes:
+        index.drop(engine)
+    session = sessionmaker(bind=engine)()
+    tm.init(model, session)
+    return engine, session, tm, StatementCounter(engine)
+
+
+def build_tree(tm, size, shape="balanced", tree_id=0, first_id=1, branch=10):
+    """
+    通过import_tree生成一棵测试树
+    :param shape: wide-所有节点都是根节点的子节点，deep-每个节点只有一个子节点，balanced-每个节点有branch个子节点
+    :return: 节点id列表
+    """
+    rows = [(None, {"id": first_id, "name": "n%s" % first_id})]
+    for i in xrange(1, size):
+        if shape == "wide":
+            parent = first_id
+        elif shape == "deep":
+            parent = first_id + i - 1
+        else:
+            parent = first_id + (i - 1) / branch
+        rows.append((parent, {"id": first_id + i, "name": "n%s" % (first_id + i)}))
+    tm.import_tree(rows, tree_id=tree_id)
+    return range(first_id, first_id + size)
+
+
+def build_forest(tm, size, trees, shape="balanced"):
+    """
+    生成trees棵树，共size个节点
+    :return: 节点id列表
+    """
+    ids = []
+    tree_size = max(size / trees, 1)
+    for tree_id in range(trees):
+        ids.extend(build_tree(tm, tree_size, shape, tree_id=tree_id, first_id=len(ids) + 1))
+    return ids
+
+
+def timeit(func, repeat):
+    """ 执行func repeat次，返回平均耗时(毫秒) """
+    start = time.time()
+    for i in range(repeat):
+        func(i)
+    return (time.time() - start) * 1000.0 / repeat
+
+
+def explain(engine, statement):
+    """ 返回SQLite的查询计划 """
+    sql, parameters = statement
+    return " | ".join(tuple(row)[-1] for row in engine.execute("EXPLAIN QUERY PLAN " + sql, parameters))
+
+
+def index_queries(tm, nodes):
+    """ 用来比较索引效果的查询 """
+    return [
+        ("get_nodes(level=2)", lambda i: tm.get_nodes(tree_id=nodes[i].tree_id, level=2)),
+        ("get_parent", lambda i: tm.get_parent(nodes[i])),
+        ("get_ancestors", lambda i: tm.get_ancestors(nodes[i])),
+        ("get_children", lambda i: tm.get_children(nodes[i])),
+        ("get_descendants(level=2)", lambda i: tm.get_descendants(nodes[i], 2)),
+        ("get_next_sibling", lambda i: tm.get_next_sibling(nodes[i])),
+    ]
+
+
+def bench_index(args):
+    engine, session, tm, counter = open_db(args.db)
+    print "building %s nodes in %s trees..." % (args.size, args.trees)
+    ids = build_forest(tm, args.size, args.trees)
+    session.commit()
+    random.seed(args.seed)
+    sample = [session.query(Node).get(random.choice(ids[1:])) for i in range(args.repeat)]
+
+    results = {}
+    for indexed in (False, True):
+        if indexed:
+            tm.create_indexes(engine)
+            engine.execute("ANALYZE")
+        for name, query in index_queries(tm, sample):
+            def run(i):
+                counter.reset()
+                try:
+                    query(i)
+                except Exception:
+                    pass
+            elapsed = timeit(run, args.repeat)
+            results[(name, indexed)] = (elapsed, explain(engine, counter.first_statement))
+
+    print "%-26s %12s %12s  %s" % ("query", "no index(ms)", "index(ms)", "plan")
+    for name, query in index_queries(tm, sample):
+        print "%-26s %12.3f %12.3f" % (name, results[(name, False)][0], results[(name, True)][0])
+        print "%26s no index: %s" % ("", results[(name, False)][1])
+        print "%26s index:    %s" % ("", results[(name, True)][1])
+    if args.db is None:
+        os.remove(engine.url.database)
+
+
+def write_operations(tm, session, ids, repeat, batch):
+    """
+    写操作测试，每个操作返回(名称,函数)，函数执行一次操作并提交到数据库(flush)
+    """
+    random.seed(0)
+    next_id = [max(ids) + 1]
+    added = []
+
+    def new_node():
+        node = Node(id=next_id[0], name="x%s" % next_id[0])
+        next_id[0] += 1
+        return node
+
+    def random_node(allow_root=True):
+        while True:
+            node = session.query(Node).get(random.choice(ids))
+            if node is not None and (allow_root or not tm.is_root(node)):
+                return node
+
+    def prepare_add(pos):
+        def prepare():
+            return random_node(allow_root=pos < 2)
+
+        def run(ref):
+            node = new_node()
+            tm.add_node(node, ref, pos=pos)
+            session.flush()
+            added.append(node.id)
+        return prepare, run
+
+    def prepare_move(pos):
+        def prepare():
+            while True:
+                node, ref = random_node(False), random_node(pos < 2)
+                relation = tm.get_node_relation(ref, node)
+                if relation not in (TREE_NODE_RELATION.Self, TREE_NODE_RELATION.Child, TREE_NODE_RELATION.Descendants):
+                    return node, ref
+
+        def run(args):
+            tm.move_node(args[0], args[1], pos=pos)
+            session.flush()
+        return prepare, run
+
+    def prepare_del():
+        return session.query(Node).get(added.pop())
+
+    def run_del(node):
+        tm.del_node(node)
+        session.flush()
+
+    def run_add_many(ref):
+        tm.add_node([new_node() for i in range(batch)], ref)
+        session.flush()
+
+    def run_import(ref):
+        rows = [(None, {"id": next_id[0], "name": "i"})]
+        for i in range(1, batch):
+            rows.append((next_id[0], {"id": next_id[0] + i, "name": "i"}))
+        next_id[0] += batch
+        tm.import_tree(rows, ref)
+        session.flush()
+
+    operations = []
+    for pos, name in enumerate(["LastChild", "FirstChild", "NextSibling", "PreviousSibling"]):
+        operations.append(("add_node(%s)" % name,) + prepare_add(pos))
+    for pos, name in enumerate(["LastChild", "FirstChild", "NextSibling", "PreviousSibling"]):
+        operations.append(("move_node(%s)" % name,) + prepare_move(pos))
+    operations.append(("del_node", prepare_del, run_del))
+    operations.append(("add_node(%s nodes)" % batch, random_node, run_add_many))
+    operations.append(("import_tree(%s nodes)" % batch, random_node, run_import))
+    return operations
+
+
+def iter_cases(args):
+    """ 按存储方式、树的形状、节点数依次返回测试用例(backend,shape,size) """
+    for backend in args.backends.split(","):
+        for shape in args.shapes.split(","):
+            for size in [int(size) for size in args.sizes.split(",")]:
+                yield backend, shape, size
+
+
+def bench_write(args):
+    Node.__tree_spacing__ = args.spacing
+    print "%-8s %-10s %9s %-28s %10s %10s %12s" % (
+        "backend", "shape", "size", "operation", "ms/op", "stmts/op", "rows/op")
+    for backend, shape, size in iter_cases(args):
+        engine, session, tm, counter = open_db(args.db, backend)
+        ids = build_tree(tm, size, shape)
+        session.commit()
+        for name, prepare, run in write_operations(tm, session, ids, args.repeat, args.batch):
+            elapsed, statements, rows = 0.0, 0, 0
+            for i in range(args.repeat):
+                value = prepare()
+                counter.reset()
+                start = time.time()
+                run(value)
+                elapsed += time.time() - start
+                statements += counter.statements
+                rows += counter.rows
+                session.expire_all()
+            print "%-8s %-10s %9s %-28s %10.3f %10.1f %12.1f" % (
+                backend, shape, size, name, elapsed * 1000.0 / args.repeat,
+                float(statements) / args.repeat, float(rows) / args.repeat)
+        session.commit()
+        session.close()
+        if args.db is None:
+            os.remove(engine.url.database)
+        engine.dispose()
+
+
+def read_operations(tm, nodes, refs, root):
+    """ 读操作测试，nodes、refs是随机选取的节点，root是根节点 """
+    def next_sibling(i):
+        try:
+            tm.get_next_sibling(nodes[i])
+        except TreeNodeNotFound:
+            pass
+    operations = [
+        ("get_parent", lambda i: tm.get_parent(nodes[i])),
+        ("get_ancestors", lambda i: tm.get_ancestors(nodes[i])),
+        ("get_descendants(level=1)", lambda i: tm.get_descendants(nodes[i], 1)),
+        ("get_descendants(level=2)", lambda i: tm.get_descendants(nodes[i], 2)),
+        ("get_descendants", lambda i: tm.get_descendants(nodes[i])),
+        ("get_siblings", lambda i: tm.get_siblings(nodes[i])),
+        ("get_next_sibling", next_sibling),
+        ("get_node_relation", lambda i: tm.get_node_relation(nodes[i], refs[i])),
+        ("get_node_relations(refs)", lambda i: tm.get_node_relations(nodes[i], refs)),
+        ("output(level=2)", lambda i: tm.output(nodes[i], level=2)),
+        ("output(level=2,flatted)", lambda i: tm.output(nodes[i], level=2, flatted=True)),
+        ("output(root,level=1,lazy)", lambda i: tm.output(root, level=1, lazy=True)),
+        ("output_children", lambda i: tm.output_children(nodes[i])),
+    ]
+    #闭包表不支持verify_tree
+    if not isinstance(tm, ClosureTreeManager):
+        operations.append(("verify_tree", lambda i: tm.verify_tree(0)))
+    return operations
+
+
+def bench_read(args):
+    results = []
+    modes = {"none": [False], "with": [True], "both": [False, True]}[args.indexes]
+    if args.json != "-":
+        print "%-8s %-10s %9s %-7s %-26s %10s %10s" % (
+            "backend", "shape", "size", "indexes", "operation", "ms/op", "stmts/op")
+    for backend, shape, size in iter_cases(args):
+        engine, session, tm, counter = open_db(args.db, backend)
+        ids = build_tree(tm, size, shape)
+        session.commit()
+        random.seed(args.seed)
+        nodes = [session.query(Node).get(random.choice(ids[1:] or ids)) for i in range(args.repeat)]
+        refs = [session.query(Node).get(random.choice(ids)) for i in range(args.repeat)]
+        root = session.query(Node).get(ids[0])
+        for indexed in modes:
+            if indexed:
+                tm.create_indexes(engine)
+                engine.execute("ANALYZE")
+            for name, query in read_operations(tm, nodes, refs, root):
+                #verify_tree读取整棵树，只执行少量次数
+                repeat = min(args.repeat, 3) if name == "verify_tree" else args.repeat
+
+                def run(i):
+                    query(i)
+                counter.reset()
+                elapsed = timeit(run, repeat)
+                result = {
+                    "backend": backend, "shape": shape, "size": size, "indexes": indexed, "operation": name,
+                    "repeat": repeat, "ms_per_op": round(elapsed, 4),
+                    "statements_per_op": float(counter.statements) / repeat,
+                }
+                results.append(result)
+                if args.json != "-":
+                    print "%-8s %-10s %9s %-7s %-26s %10.3f %10.1f" % (
+                        backend, shape, size, indexed, name, elapsed, result["statements_per_op"])
+        session.close()
+        if args.db is None:
+            os.remove(engine.url.database)
+        engine.dispose()
+
+    if args.json:
+        report = {
+            "benchmark": "read",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "sqlite": engine.dialect.dbapi.sqlite_version,
+            "args": {"backends": args.backends, "sizes": args.sizes, "shapes": args.shapes,
+                     "repeat": args.repeat, "seed": args.seed},
+            "results": results,
+        }
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if args.json == "-":
+            print text
+        else:
+            with open(args.json, "w") as f:
+                f.write(text)
+
+
+def cte_operations(tm, nodes, root):
+    """ 可以使用递归CTE的查询，随机节点大多是叶子节点，另外测试根节点以比较子树很大时的情况 """
+    return [
+        ("get_ancestors", lambda i: tm.get_ancestors(nodes[i])),
+        ("get_descendants(level=2)", lambda i: tm.get_descendants(nodes[i], 2)),
+        ("get_descendants(level=3)", lambda i: tm.get_descendants(nodes[i], 3)),
+        ("root get_descendants(level=2)", lambda i: tm.get_descendants(root, 2)),
+    ]
+
+
+def bench_cte(args):
+    print "%-10s %9s %-6s %-30s %10s %10s" % ("shape", "size", "mode", "operation", "ms/op", "stmts/op")
+    for shape in args.shapes.split(","):
+        for size in [int(size) for size in args.sizes.split(",")]:
+            engine, session, tm, counter = open_db(args.db, model=ParentNode)
+            ids = build_tree(tm, size, shape)
+            session.commit()
+            tm.create_indexes(engine)
+            engine.execute("ANALYZE")
+            random.seed(args.seed)
+            nodes = [session.query(ParentNode).get(random.choice(ids)) for i in range(args.repeat)]
+            root = session.query(ParentNode).get(ids[0])
+            for mode in args.modes.split(","):
+                tm.query_mode = QUERY_MODES[mode]
+                for name, query in cte_operations(tm, nodes, root):
+                    counter.reset()
+                    elapsed = timeit(query, args.repeat)
+                    print "%-10s %9s %-6s %-30s %10.3f %10.1f" % (
+                        shape, size, mode, name, elapsed, float(counter.statements) / args.repeat)
+            session.close()
+            if args.db is None:
+                os.remove(engine.url.database)
+            engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u"SATree benchmark")
+    parser.add_argument("--db", default=None, help=u"SQLite数据库文件，默认使用临时文件")
+    parser.add_argument("--seed", type=int, default=1)
+    subparsers = parser.add_subparsers()
+
+    index_parser = subparsers.add_parser("index", help=u"比较有无树字段索引时的查询计划及耗时")
+    index_parser.add_argument("--size", type=int, default=1000000, help=u"节点总数")
+    index_parser.add_argument("--trees", type=int, default=10, help=u"树的数量")
+    index_parser.add_argument("--repeat", type=int, default=100, help=u"每个查询执行的次数")
+    index_parser.set_defaults(func=bench_index)
+
+    write_parser = subparsers.add_parser("write", help=u"增加、移动、删除节点的耗时、语句数及影响的记录数")
+    write_parser.add_argument("--sizes", default="1000,10000,100000", help=u"树的节点数，多个用逗号分隔")
+    write_parser.add_argument("--shapes", default="wide,deep,balanced", help=u"树的形状，多个用逗号分隔")
+    write_parser.add_argument("--repeat", type=int, default=20, help=u"每个操作执行的次数")
+    write_parser.add_argument("--batch", type=int, default=100, help=u"批量增加的节点数")
+    write_parser.add_argument("--spacing", type=int, default=1, help=u"__tree_spacing__，大于1时测试间隔编号")
+    write_parser.add_argument("--backends", default="nested",
+                              help=u"存储方式，多个用逗号分隔，nested-左右值，closure-闭包表")
+    write_parser.set_defaults(func=bench_write)
+
+    read_parser = subparsers.add_parser("read", help=u"关系查询及输出的耗时")
+    read_parser.add_argument("--sizes", default="1000,10000,100000", help=u"树的节点数，多个用逗号分隔")
+    read_parser.add_argument("--shapes", default="wide,deep,balanced", help=u"树的形状，多个用逗号分隔")
+    read_parser.add_argument("--repeat", type=int, default=50, help=u"每个查询执行的次数")
+    read_parser.add_argument("--indexes", choices=["none", "with", "both"], default="both",
+                             help=u"none-不创建索引，with-创建推荐的索引，both-分别测试")
+    read_parser.add_argument("--backends", default="nested",
+                             help=u"存储方式，多个用逗号分隔，nested-左右值，closure-闭包表")
+    read_parser.add_argument("--json", default=None, help=u"将结果以JSON格式保存到该文件，-表示输出到标准输出")
+    read_parser.set_defaults(func=bench_read)
+
+    cte_parser = subparsers.add_parser("cte", help=u"比较左右值区间与递归CTE查询的耗时")
+    cte_parser.add_argument("--sizes", default="1000,10000,100000", help=u"树的节点数，多个用逗号分隔")
+    cte_parser.add_argument("--shapes", default="wide,deep,balanced", help=u"树的形状，多个用逗号分隔")
+    cte_parser.add_argument("--repeat", type=int, default=50, help=u"每个查询执行的次数")
+    cte_parser.add_argument("--modes", default="nested,cte,auto", help=u"查询方式，多个用逗号分隔，见TREE_QUERY_MODE")
+    cte_parser.set_defaults(func=bench_cte)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,22 @@
 # -*- coding:utf-8 -*-
 __author__ = 'zhwx'
-from sqlalchemy import Column,Integer,and_
-from sqlalchemy import func
-from sqlalchemy.orm import load_only
+from sqlalchemy import Column,Integer,Index,Table,PrimaryKeyConstraint,and_,or_
+from sqlalchemy import func,inspect,case,literal,literal_column,event,select,exists,bindparam
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.exc import UnboundExecutionError
+from bisect import bisect_left,bisect_right
+from array import array
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+import copy
 import json
+import threading
+import time
+import uuid
 
 
 #节点相对位置
@@ -13,6 +26,23 @@ class TREE_NODE_POSITION(object):
     NextSibling=2
     PreviousSibling=3
 
+#写操作时锁定树的方式
+class TREE_LOCK_MODE(object):
+    Off=0           #不锁定
+    Local=1         #进程内锁，每棵树一个锁，适用于单进程多线程，包括SQLite
+    Row=2           #SELECT ... FOR UPDATE锁定根节点记录，适用于支持行锁的数据库
+    Advisory=3      #PostgreSQL的pg_advisory_xact_lock
+
+#祖先节点及限定层数的后代节点的查询方式，只有定义了父节点字段(见TreeMixin.__tree_parent_field__)时才能使用CTE
+class TREE_QUERY_MODE(object):
+    Nested=0        #按左右值区间查询
+    Cte=1           #沿父节点字段递归查询(WITH RECURSIVE)，适用于SQLite 3.8.3+、PostgreSQL等支持递归CTE的数据库
+    Auto=2          #每次调用时按左右值估计区间查询需要扫描的记录数，超过TreeManager.cte_threshold时使用CTE
+
+#进程内锁,{(表名,tree_id):RLock}
+_local_tree_locks={}
+_local_tree_locks_guard=threading.Lock()
+
 #节点关系
 class TREE_NODE_RELATION(object):
     Self=0
@@ -38,6 +68,286 @@ class TreeNodeInvalidOperation(Exception):
     u""" 非法节点操作"""
     pass
 
+class TreeOperationNotSupported(Exception):
+    u"""当前数据库或存储方式不支持该操作"""
+    pass
+
+class TreeVersionConflict(Exception):
+    u"""树已经被其他事务修改，需要回滚后重新读取再重试，参数为(tree_id,期望的版本号,当前版本号)"""
+    pass
+
+
+class TreeSnapshot(object):
+    """
+    树快照,将一棵树的主键及tree_left,tree_right,tree_level一次性载入内存
+    所有值按tree_left顺序存放在数组中，节点关系通过二分查找及区间计算得到，不需要再查询数据库
+    数组中的位置称为索引，以下方法均返回索引，由TreeManager负责将索引转换为节点实例
+    """
+
+    def __init__(self,tree_id,rows):
+        """
+        :param tree_id: 树标识
+        :param rows: 按tree_left排序的(pk,tree_left,tree_right,tree_level)序列
+        """
+        self.tree_id=tree_id
+        self.pks=[]
+        self.lefts=array("l")
+        self.rights=array("l")
+        self.levels=array("l")
+        self.parents=array("l")#父节点的索引,-1代表没有父节点
+        stack=[]
+        for pk,left,right,level in rows:
+            #弹出所有已经结束的节点，栈顶就是父节点
+            while stack and self.rights[stack[-1]]<left:
+                stack.pop()
+            self.parents.append(stack[-1] if stack else -1)
+            stack.append(len(self.pks))
+            self.pks.append(pk)
+            self.lefts.append(left)
+            self.rights.append(right)
+            self.levels.append(level)
+
+    def __len__(self):
+        return len(self.pks)
+
+    def index(self,node):
+        """
+        返回节点在快照中的索引，如果节点不在快照中(或者节点的左右值与快照不一致)则返回-1
+        """
+        i=bisect_left(self.lefts,node.tree_left)
+        if i<len(self.pks) and self.lefts[i]==node.tree_left and self.rights[i]==node.tree_right:
+            return i
+        return -1
+
+    def get_ancestors(self,i):
+        """ 返回所有祖先节点的索引，从根节点开始 """
+        result=[]
+        i=self.parents[i]
+        while i>=0:
+            result.append(i)
+            i=self.parents[i]
+        result.reverse()
+        return result
+
+    def get_descendants(self,i,level=0):
+        """ 返回所有后代节点的索引,level限制返回几级后代 """
+        end=bisect_left(self.lefts,self.rights[i])
+        if level==0:
+            return range(i+1,end)
+        max_level=self.levels[i]+level
+        return [j for j in xrange(i+1,end) if self.levels[j]<=max_level]
+
+    def get_children(self,i):
+        """ 返回所有子节点的索引，遇到子节点后直接跳过该子节点的后代 """
+        result=[]
+        end=bisect_left(self.lefts,self.rights[i])
+        j=i+1
+        while j<end:
+            result.append(j)
+            j=bisect_right(self.lefts,self.rights[j])
+        return result
+
+    def get_next_sibling(self,i):
+        """ 返回下一个兄弟节点的索引，没有则返回-1 """
+        j=bisect_right(self.lefts,self.rights[i])
+        if j<len(self.pks) and self.parents[j]==self.parents[i]:
+            return j
+        return -1
+
+    def get_previous_sibling(self,i):
+        """ 返回上一个兄弟节点的索引，没有则返回-1 """
+        parent=self.parents[i]
+        j=i-1
+        if j<0 or j==parent:
+            return -1
+        #上一个节点可能是上一个兄弟节点的后代，沿父节点向上找
+        while j>=0 and self.parents[j]!=parent:
+            j=self.parents[j]
+        return j
+
+
+class TreeVerifyReport(dict):
+    """
+    树结构校验结果，由TreeManager.verify_tree返回，包括:
+        count   : 校验的节点数量
+        gaps    : 左右值不连续的位置,[(tree_id,起始值,结束值),...]
+        overlaps: 左右值重复或者与父节点交叉的节点,[(tree_id,pk),...]
+        levels  : tree_level不正确的节点,[(tree_id,pk,tree_level,正确的tree_level),...]
+        orphans : 不在根节点范围内的节点,[(tree_id,pk),...]
+        closure : 闭包表模式中闭包记录不正确的节点,[(tree_id,pk),...]
+    没有发现错误时实例为真，因此可以直接使用 if tm.verify_tree(0):
+    """
+
+    def __init__(self):
+        super(TreeVerifyReport,self).__init__(count=0,gaps=[],overlaps=[],levels=[],orphans=[],closure=[])
+
+    @property
+    def valid(self):
+        return not (self["gaps"] or self["overlaps"] or self["levels"] or self["orphans"] or self["closure"])
+
+    def __nonzero__(self):
+        return self.valid
+    __bool__=__nonzero__
+
+
+class TreeCache(object):
+    """
+    TreeManager的缓存接口，默认不缓存任何内容
+    可以继承该类，通过memcached、redis等实现多个进程共享的缓存，保存的键是字符串，值是由pk值、字符串、dict、list构成的数据
+    """
+    def get(self,key):
+        """ 取得缓存的值，不存在时返回None """
+        return None
+
+    def set(self,key,value):
+        """ 写入缓存 """
+        pass
+
+    def delete(self,key):
+        """ 删除缓存 """
+        pass
+
+
+class LocalTreeCache(TreeCache):
+    """
+    进程内缓存，超过max_size时淘汰最近最少使用的值
+    :param max_size: 最多保存的值的数量
+    :param ttl: 过期秒数，0-不过期
+    """
+    def __init__(self,max_size=1000,ttl=0):
+        self.max_size=max_size
+        self.ttl=ttl
+        self._items=OrderedDict()#{key:(过期时间,value)}
+        self._lock=threading.Lock()
+
+    def get(self,key):
+        with self._lock:
+            item=self._items.pop(key,None)
+            if item is None:
+                return None
+            if item[0] is not None and item[0]<time.time():
+                return None
+            self._items[key]=item#重新插入到最后，表示最近使用
+            return item[1]
+
+    def set(self,key,value):
+        with self._lock:
+            self._items.pop(key,None)
+            self._items[key]=(time.time()+self.ttl if self.ttl>0 else None,value)
+            while len(self._items)>self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self,key):
+        with self._lock:
+            self._items.pop(key,None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class TreeProfiler(object):
+    """
+    记录TreeManager公共方法的调用次数、耗时(秒)、执行的SQL语句数及影响的记录数
+    嵌套调用(如get_siblings内部调用get_parent)只记录在最外层的方法上
+    调用深度、SQL语句数及记录数按线程分别计数，只统计在调用线程中执行的SQL语句，同一个实例可以在多个线程中共用
+    :param callback: 每次方法调用结束后调用callback(method,elapsed,statements,rows)，可以用来输出到监控系统
+    """
+    def __init__(self,callback=None):
+        self.callback=callback
+        self.stats={}#{方法名称:{"calls":..,"time":..,"statements":..,"rows":..}}
+        self._local=threading.local()#当前线程的depth、statements、rows
+        self._lock=threading.Lock()
+        self._engines={}#{engine:start次数}，最后一次stop时才移除事件监听
+
+    def _before_execute(self,conn,cursor,statement,parameters,context,executemany):
+        local=self._local
+        if getattr(local,"depth",0)>0:
+            local.statements+=1
+
+    def _after_execute(self,conn,cursor,statement,parameters,context,executemany):
+        local=self._local
+        if getattr(local,"depth",0)>0 and cursor.rowcount>0 and not statement.lstrip()[:6].upper()=="SELECT":
+            local.rows+=cursor.rowcount
+
+    def start(self,engine):
+        """ 开始记录该数据库引擎执行的SQL语句，可以多次start，与stop的次数相同时才停止记录 """
+        with self._lock:
+            count=self._engines.get(engine,0)
+            if count==0:
+                event.listen(engine,"before_cursor_execute",self._before_execute)
+                event.listen(engine,"after_cursor_execute",self._after_execute)
+            self._engines[engine]=count+1
+
+    def stop(self,engine):
+        with self._lock:
+            count=self._engines.get(engine,0)
+            if count>1:
+                self._engines[engine]=count-1
+            elif count==1:
+                del self._engines[engine]
+                event.remove(engine,"before_cursor_execute",self._before_execute)
+                event.remove(engine,"after_cursor_execute",self._after_execute)
+
+    def call(self,method,func,*args,**kwargs):
+        """ 调用func并记录到method名下 """
+        local=self._local
+        if getattr(local,"depth",0)>0:
+            return func(*args,**kwargs)
+        local.depth=1
+        local.statements=local.rows=0
+        start=time.time()
+        try:
+            return func(*args,**kwargs)
+        finally:
+            local.depth=0
+            self.record(method,time.time()-start,local.statements,local.rows)
+
+    def record(self,method,elapsed,statements,rows):
+        with self._lock:
+            item=self.stats.setdefault(method,{"calls":0,"time":0.0,"statements":0,"rows":0})
+            item["calls"]+=1
+            item["time"]+=elapsed
+            item["statements"]+=statements
+            item["rows"]+=rows
+        if self.callback is not None:
+            self.callback(method,elapsed,statements,rows)
+
+    def as_dict(self):
+        """ 返回统计结果,{方法名称:{"calls":调用次数,"time":总耗时,"statements":SQL语句数,"rows":影响的记录数}} """
+        with self._lock:
+            return copy.deepcopy(self.stats)
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+
+
+def _end_transaction(session,transaction):
+    """
+    会话的最外层事务结束时释放TREE_LOCK_MODE.Local锁定的树，并清除事务中记录的锁定状态及树版本号
+    事务中修改过的树在提交或回滚后再更新一次缓存版本号，使其他会话在事务结束前按旧数据写入的缓存失效
+    """
+    if transaction.parent is not None:
+        return
+    session.info.pop("satree_locked",None)
+    session.info.pop("satree_versions",None)
+    for cache,version_key in session.info.pop("satree_changed_trees",()):
+        cache.set(version_key,uuid.uuid4().hex)
+    for lock in session.info.pop("satree_local_locks",[]):
+        lock.release()
+
+
+def _profiled(func):
+    """ TreeManager公共方法的装饰器，没有启用profile时只多一次属性判断 """
+    name=func.__name__
+    @wraps(func)
+    def wrapper(self,*args,**kwargs):
+        if self.profiler is None:
+            return func(self,*args,**kwargs)
+        return self.profiler.call(name,func,self,*args,**kwargs)
+    return wrapper
+
 
 class TreeManager(object):
     """
@@ -61,21 +371,39 @@ class TreeManager(object):
 
     """
 
+    cte_threshold=200#TREE_QUERY_MODE.Auto时，区间查询估计需要扫描的记录数超过该值则使用CTE
 
-    def __init__(self,model_class=None,session=None):
+    def __init__(self,model_class=None,session=None,cache=None,lock_mode=TREE_LOCK_MODE.Off,query_mode=TREE_QUERY_MODE.Nested):
         """
         :param model_class: 提供一个ORM类
         :param session: 提供数据会话对象，如果没有提供则使用户ORM的类方法session取得会话
+        :param cache: TreeCache实例，用来缓存get_descendants、get_ancestors、output的结果
+        :param lock_mode: 写操作时锁定树的方式，见TREE_LOCK_MODE
+        :param query_mode: 祖先节点及限定层数的后代节点的查询方式，见TREE_QUERY_MODE
         :return:
         """
-        self.init(model_class,session)
+        self._snapshots={}#已载入的树快照,{tree_id:TreeSnapshot}
+        self._local=threading.local()#当前线程启用的TreeProfiler
+        self.init(model_class,session,cache,lock_mode,query_mode)
 
-    def init(self,model_class,session):
+    def init(self,model_class,session,cache=None,lock_mode=TREE_LOCK_MODE.Off,query_mode=TREE_QUERY_MODE.Nested):
         self._model_class=model_class
+        self.cache=cache
+        self.lock_mode=lock_mode
+        self.query_mode=query_mode
         if session is None and hasattr(self._model_class,"session"):
             self._session=self._model_class.session
         else:
             self._session=session
+        if lock_mode==TREE_LOCK_MODE.Advisory and self._get_dialect_name() not in (None,"postgresql"):
+            raise TreeOperationNotSupported(u"数据库%s不支持TREE_LOCK_MODE.Advisory" % self._get_dialect_name())
+
+    def _get_dialect_name(self):
+        """ 取得会话连接的数据库类型名称，会话还没有绑定数据库时返回None """
+        try:
+            return self._session.get_bind(self._model_class).dialect.name
+        except (AttributeError,UnboundExecutionError):
+            return None
 
     def _get_tree_sort_key(self):
         """
@@ -86,6 +414,339 @@ class TreeManager(object):
         else:
             return self._model_class.__tree_key__
 
+    @_profiled
+    def snapshot(self,tree_id=0):
+        """
+        载入指定树的快照，载入后该树的get_parent,get_ancestors,get_children,get_siblings等关系查询
+        均在内存中完成，不再查询数据库。当通过add_node,del_node,move_node修改该树时，快照自动失效。
+        适用于读多写少的场合，如一次渲染导航菜单需要反复查询节点关系。
+        :param tree_id: 树标识
+        :return: TreeSnapshot实例
+        """
+        cls=self._model_class
+        rows=self._session.query(cls.__dict__[self.get_primary_field().name],cls.tree_left,cls.tree_right,cls.tree_level)\
+            .filter(cls.__dict__[cls.__tree_key__]==tree_id)\
+            .order_by(cls.tree_left)
+        self._snapshots[tree_id]=TreeSnapshot(tree_id,rows)
+        return self._snapshots[tree_id]
+
+    def drop_snapshot(self,tree_id=None):
+        """
+        删除树快照
+        :param tree_id: 树标识，如果没有指定则删除所有快照
+        """
+        if tree_id is None:
+            self._snapshots.clear()
+        else:
+            self._snapshots.pop(tree_id,None)
+
+    def _invalidate_tree(self,*tree_ids):
+        """ 树结构发生变化时调用，使该树的快照及缓存失效，定义了版本号字段时同时更新树的版本号 """
+        self.invalidate_cache(*tree_ids)
+        if self._get_version_field() is not None:
+            self._bump_tree_versions(tree_ids)
+
+    def invalidate_cache(self,*tree_ids):
+        """
+        使指定树的快照及缓存失效，用于直接修改了节点字段值(不改变树结构)的情况
+        修改在事务结束前其他会话看不到，因此事务提交或回滚时再更新一次版本号，在此之前当前会话读取这些树时不使用缓存
+        """
+        for tree_id in tree_ids:
+            self._snapshots.pop(tree_id,None)
+        if self.cache is not None:
+            #更新版本号后，按旧版本号保存的缓存不会再被读取,由缓存自行淘汰
+            changed=self._get_transaction_info("satree_changed_trees",set())#{(缓存,版本号缓存键)}
+            for tree_id in set(tree_ids)|set([None]):
+                version_key=self._get_version_key(tree_id)
+                self.cache.set(version_key,uuid.uuid4().hex)
+                changed.add((self.cache,version_key))
+
+    def _use_cache(self,tree_ids):
+        """
+        是否可以通过缓存读取及保存结果
+        当前事务修改了相关的树时，缓存中是已提交的数据，当前会话查询到的是未提交的数据，均不能使用缓存
+        :param tree_ids: 结果依赖的树，None代表所有树
+        """
+        if self.cache is None:
+            return False
+        changed=self._session.info.get("satree_changed_trees")
+        if not changed:
+            return True
+        version_keys=set(self._get_version_key(tree_id) for tree_id in (tree_ids if tree_ids is not None else [None]))
+        return not any(version_key in version_keys for cache,version_key in changed)
+
+    def lock_tree(self,*tree_ids):
+        """
+        按lock_mode锁定指定的树，直到会话的当前事务提交或回滚
+        多棵树按tree_id排序后依次锁定，避免死锁
+        """
+        if self.lock_mode==TREE_LOCK_MODE.Off:
+            return
+        session=self._session
+        cls=self._model_class
+        table_name=cls.__table__.name
+        locked=self._get_transaction_info("satree_locked",set())#当前事务中已经锁定的树
+        for tree_id in sorted(set(tree_ids)):
+            if (table_name,tree_id) in locked:
+                continue
+            if self.lock_mode==TREE_LOCK_MODE.Local:
+                with _local_tree_locks_guard:
+                    lock=_local_tree_locks.setdefault((table_name,tree_id),threading.RLock())
+                lock.acquire()
+                self._get_transaction_info("satree_local_locks",[]).append(lock)
+            elif self.lock_mode==TREE_LOCK_MODE.Row:
+                session.query(cls.__dict__[self.get_primary_field().name])\
+                    .filter(self._get_root_condition(tree_id))\
+                    .with_for_update().all()
+            elif self.lock_mode==TREE_LOCK_MODE.Advisory:
+                dialect=self._get_dialect_name()
+                if dialect!="postgresql":
+                    raise TreeOperationNotSupported(u"数据库%s不支持TREE_LOCK_MODE.Advisory" % dialect)
+                session.execute(select([func.pg_advisory_xact_lock(zlib.crc32("%s:%s" % (table_name,tree_id)))]))
+            locked.add((table_name,tree_id))
+
+    def _get_transaction_info(self,name,default):
+        """ 取得会话当前事务中保存的数据，事务结束时自动清除 """
+        session=self._session
+        if not event.contains(session,"after_transaction_end",_end_transaction):
+            event.listen(session,"after_transaction_end",_end_transaction)
+        return session.info.setdefault(name,default)
+
+    def _lock_nodes(self,nodes,tree_ids=()):
+        """
+        写操作前锁定节点所在的树(或者记录树的版本号)，然后重新读取节点的左右值，避免使用其他事务修改前的值
+        :param nodes: 写操作需要读取左右值的已有节点，如ref_node
+        :param tree_ids: 需要同时锁定的其他树
+        """
+        if self.lock_mode==TREE_LOCK_MODE.Off and self._get_version_field() is None:
+            return
+        cls=self._model_class
+        names=[cls.__tree_key__,"tree_left","tree_right","tree_level"]
+        nodes=[node for node in nodes if node is not None and inspect(node).persistent]
+        locked=set()
+        while True:
+            tree_ids=set(tree_ids)|set(self.get_node_tree_id(node) for node in nodes)
+            #节点可能已经被其他事务移动到另一棵树，此时需要再锁定新的树
+            if tree_ids<=locked:
+                break
+            self.lock_tree(*(tree_ids-locked))
+            if self._get_version_field() is not None:
+                versions=self._get_transaction_info("satree_versions",{})
+                for tree_id in tree_ids-locked:
+                    if (cls.__table__.name,tree_id) not in versions:
+                        versions[(cls.__table__.name,tree_id)]=self._read_tree_version(tree_id)
+            locked|=tree_ids
+            for node in nodes:
+                self._session.refresh(node,names)
+
+    def _get_version_field(self):
+        """
+        取得保存树版本号的字段名称，见TreeMixin.__tree_version_field__
+        表中没有定义该字段时返回None
+        """
+        cls=self._model_class
+        name=getattr(cls,"__tree_version_field__",None)
+        return name if name is not None and name in cls.__table__.columns else None
+
+    def _read_tree_version(self,tree_id):
+        """ 从数据库读取树的版本号，树不存在时返回None """
+        cls=self._model_class
+        return self._session.query(cls.__dict__[self._get_version_field()])\
+            .filter(self._get_root_condition(tree_id)).scalar()
+
+    @_profiled
+    def get_tree_version(self,tree_id=0):
+        """
+        读取树的版本号，并作为当前事务中修改该树时期望的版本号
+        在此之后如果该树被其他事务修改，当前事务修改该树时会发生TreeVersionConflict
+        """
+        version=self._read_tree_version(tree_id)
+        self.expect_tree_version(tree_id,version)
+        return version
+
+    def expect_tree_version(self,tree_id,version):
+        """
+        指定当前事务中修改该树时期望的版本号，如客户端读取树时得到的版本号，
+        该树的版本号已经不是version时，修改该树会发生TreeVersionConflict
+        """
+        self._get_transaction_info("satree_versions",{})[(self._model_class.__table__.name,tree_id)]=version
+
+    def _bump_tree_versions(self,tree_ids):
+        """
+        修改树之后通过带条件的UPDATE将版本号加1，版本号已经不是修改前读取的值时说明树已经被其他事务修改，发生TreeVersionConflict
+        """
+        cls=self._model_class
+        version_field=self._get_version_field()
+        column=cls.__dict__[version_field]
+        versions=self._get_transaction_info("satree_versions",{})
+        for tree_id in sorted(set(tree_ids)):
+            expected=versions.get((cls.__table__.name,tree_id))
+            if expected is None:#修改前树还不存在(如增加根节点)，只记录当前版本号
+                versions[(cls.__table__.name,tree_id)]=self._read_tree_version(tree_id)
+                continue
+            count=self._session.query(cls)\
+                .filter(and_(self._get_root_condition(tree_id),column==expected))\
+                .update({column:expected+1},synchronize_session=False)
+            if count==0:
+                current=self._read_tree_version(tree_id)
+                if current is not None:
+                    raise TreeVersionConflict(tree_id,expected,current)
+                versions[(cls.__table__.name,tree_id)]=None#整棵树已经删除
+                continue
+            versions[(cls.__table__.name,tree_id)]=expected+1
+            for node in list(self._session.identity_map.values()):
+                if isinstance(node,cls) and node.__dict__.get(cls.__tree_key__)==tree_id and node.__dict__.get("tree_level")==1:
+                    set_committed_value(node,version_field,expected+1)
+
+    @property
+    def profiler(self):
+        """ 当前线程启用的TreeProfiler，没有启用时为None；TreeMixin共用一个TreeManager，因此不能保存在实例上 """
+        return getattr(self._local,"profiler",None)
+
+    @profiler.setter
+    def profiler(self,value):
+        self._local.profiler=value
+
+    @contextmanager
+    def profile(self,callback=None,profiler=None):
+        """
+        在with语句块内记录当前线程调用各公共方法的次数、耗时、SQL语句数及影响的记录数，不影响其他线程
+        :param callback: 每次方法调用结束后调用callback(method,elapsed,statements,rows)
+        :param profiler: 使用已有的TreeProfiler继续累计，如果没有指定则创建新的
+        例：
+            with tm.profile() as profiler:
+                tm.output(root)
+            print profiler.as_dict()
+        """
+        profiler=TreeProfiler(callback) if profiler is None else profiler
+        engine=self._session.get_bind(self._model_class).engine
+        previous,self.profiler=self.profiler,profiler
+        profiler.start(engine)
+        try:
+            yield profiler
+        finally:
+            profiler.stop(engine)
+            self.profiler=previous
+
+    def _get_version_key(self,tree_id):
+        """ 树版本号的缓存键,tree_id=None时是所有树共用的版本号 """
+        return "satree:%s:version:%s" % (self._model_class.__table__.name,"*" if tree_id is None else tree_id)
+
+    def _get_cache_key(self,tree_ids,args):
+        """
+        取得缓存键,键中包含相关树的当前版本号，任何一棵树发生变化后键都会改变
+        :param tree_ids: 结果依赖的树，None代表所有树
+        :param args: 查询参数
+        """
+        versions=[]
+        for tree_id in sorted(set(tree_ids)) if tree_ids is not None else [None]:
+            version_key=self._get_version_key(tree_id)
+            version=self.cache.get(version_key)
+            if version is None:
+                version=uuid.uuid4().hex
+                self.cache.set(version_key,version)
+            versions.append(version)
+        return "satree:%s:%s:%s" % (self._model_class.__table__.name,",".join(versions),repr(args))
+
+    def _cached_nodes(self,tree_id,args,load):
+        """
+        通过缓存取得节点列表，缓存中只保存pk值，命中时通过_get_nodes_by_pk取得节点
+        :param load: 缓存中没有时调用load()从数据库查询节点列表
+        """
+        if not self._use_cache([tree_id]):
+            return load()
+        key=self._get_cache_key([tree_id],args)
+        pks=self.cache.get(key)
+        if pks is not None:
+            return [node for node in self._get_nodes_by_pk(pks) if node is not None]
+        nodes=load()
+        self.cache.set(key,[self.get_node_primary(node) for node in nodes])
+        return nodes
+
+    def _get_snapshot_index(self,node):
+        """
+        如果节点所在的树已载入快照，返回(快照,节点索引)，否则返回(None,-1)
+        """
+        if self._snapshots:
+            snapshot=self._snapshots.get(self.get_node_tree_id(node))
+            if snapshot is not None:
+                i=snapshot.index(node)
+                if i>=0:
+                    return snapshot,i
+        return None,-1
+
+    def _get_nodes_by_pk(self,pks):
+        """
+        按pks的顺序返回节点实例，已经在会话中的节点直接返回，其余节点通过一次查询取得
+        """
+        cls=self._model_class
+        identity_map=self._session.identity_map
+        nodes={}
+        for pk in pks:
+            node=identity_map.get(identity_key(cls,pk))
+            if node is not None:
+                nodes[pk]=node
+        missing=[pk for pk in pks if pk not in nodes]
+        if len(missing)>0:
+            pk_field=cls.__dict__[self.get_primary_field().name]
+            for node in self._session.query(cls).filter(pk_field.in_(missing)):
+                nodes[self.get_node_primary(node)]=node
+        return [nodes[pk] for pk in pks if pk in nodes]
+
+    def get_indexes(self):
+        """
+        返回树字段的推荐索引,TreeManager的查询均以树标识加左右值范围作为条件，没有索引时都是全表扫描
+            (__tree_key__,tree_left)            :   后代、祖先、兄弟节点等范围查询
+            (__tree_key__,tree_right)           :   插入、删除、移动节点时更新右值
+            (__tree_key__,tree_level,tree_left) :   按层级取节点,如get_nodes(level=n),get_descendants(level=n)
+            (__tree_parent_field__)             :   定义了父节点字段时，按父节点取子节点、兄弟节点
+            (__tree_path_field__)               :   定义了路径字段时，按路径前缀取后代节点
+        索引会加入到模型的表定义中，因此在metadata.create_all之前调用时，创建表时会一起创建索引
+        :return: Index列表
+        """
+        table=self._model_class.__table__
+        table_indexes=dict((index.name,index) for index in table.indexes)
+        indexes=[]
+        for name,columns in self._get_index_definitions():
+            name="ix_%s_tree_%s" % (table.name,name)
+            indexes.append(table_indexes[name] if name in table_indexes else Index(name,*columns))
+        return indexes
+
+    def _get_index_definitions(self):
+        """ 返回get_indexes的索引定义[(名称后缀,[字段,...]),...] """
+        cls=self._model_class
+        table=cls.__table__
+        tree_key=table.columns[cls.__tree_key__]
+        definitions=[
+            ("left",[tree_key,table.columns["tree_left"]]),
+            ("right",[tree_key,table.columns["tree_right"]]),
+            ("level",[tree_key,table.columns["tree_level"],table.columns["tree_left"]]),
+        ]
+        if self._get_parent_field() is not None:
+            definitions.append(("parent",[table.columns[self._get_parent_field()]]))
+        if self._get_path_field() is not None:
+            definitions.append(("path",[table.columns[self._get_path_field()]]))
+        return definitions
+
+    @_profiled
+    def create_indexes(self,bind=None):
+        """
+        在已经存在的表上创建get_indexes返回的索引,已经存在的索引会跳过
+        :param bind: Engine或Connection，如果没有指定则使用会话绑定的数据库
+        :return: 新创建的索引名称列表
+        """
+        if bind is None:
+            bind=self._session.get_bind(self._model_class)
+        table=self._model_class.__table__
+        existing=set(index["name"] for index in inspect(bind).get_indexes(table.name))
+        created=[]
+        for index in self.get_indexes():
+            if index.name not in existing:
+                index.create(bind)
+                created.append(index.name)
+        return created
+
+    @_profiled
     def get_nodes(self,tree_id=None,level=0):
         """
             返回指定tree_id的树
@@ -93,19 +754,46 @@ class TreeManager(object):
         :param level:限制层次,1：只返回根节点，2：返回第二级
         :return:
         """
-        session=self._session
+        return self._query_nodes(tree_id,level).all()
+
+    def _query_nodes(self,tree_id=None,level=0,after_left=None):
+        """ 返回get_nodes的查询，after_left不是None时只返回左值大于该值的节点 """
         cls=self._model_class
-        if tree_id is None:
-            if level==0:
-                return session.query(cls).order_by(self._get_tree_sort_key(),"tree_left").all()
-            else:
-                return session.query(cls).filter(cls.tree_level<=level).order_by(self._get_tree_sort_key(),"tree_left").all()
-        else:
-            if level==0:
-                return session.query(cls).filter(cls.__dict__[cls.__tree_key__]==tree_id).order_by(self._get_tree_sort_key(),"tree_left").all()
-            else:
-                return session.query(cls).filter(and_(cls.__dict__[cls.__tree_key__]==tree_id,cls.tree_level<=level)).order_by(self._get_tree_sort_key(),"tree_left").all()
+        conditions=[]
+        if tree_id is not None:
+            conditions.append(cls.__dict__[cls.__tree_key__]==tree_id)
+        if level>0:
+            conditions.append(cls.tree_level<=level)
+        if after_left is not None:
+            conditions.append(cls.tree_left>after_left)
+        return self._session.query(cls).filter(and_(*conditions)).order_by(self._get_tree_sort_key(),"tree_left")
+
+    def iter_nodes(self,tree_id=None,level=0,batch_size=1000):
+        """
+        逐个返回节点的生成器，参数同get_nodes
+        按树标识及tree_left顺序通过yield_per每次从数据库读取batch_size条记录，内存占用不随树的大小增长。
+        遍历过程中不要修改树的结构。
+        """
+        for node in self._query_nodes(tree_id,level).yield_per(batch_size):
+            yield node
 
+    @_profiled
+    def get_nodes_page(self,tree_id=0,after_left=None,limit=100,level=0,offset=0):
+        """
+        按tree_left分页取得一棵树的节点
+        :param tree_id: 树标识，左值只在一棵树内唯一，因此只能对一棵树分页
+        :param after_left: 只返回左值大于该值的节点，第一页为None，下一页使用上一页最后一个节点的tree_left
+        :param limit: 每页最多返回的节点数
+        :param level: 同get_nodes
+        :param offset: 跳过前offset个节点，按偏移分页时下一页使用offset+len(page)，闭包表模式只支持这种方式
+        :return: 按tree_left排序的节点列表，少于limit个时说明已经是最后一页
+        """
+        query=self._query_nodes(tree_id,level,after_left)
+        if offset>0:
+            query=query.offset(offset)
+        return query.limit(limit).all()
+
+    @_profiled
     def get_root_node(self,node):
         """
         取得node所在树的根节点
@@ -117,10 +805,17 @@ class TreeManager(object):
 
         tree_id=self.get_node_tree_id(node)
         try:
-            return session.query(cls).filter(and_(cls.__dict__[cls.__tree_key__]==tree_id,cls.tree_left==1)).one()
+            return session.query(cls).filter(self._get_root_condition(tree_id)).one()
         except Exception,E:
             return None
 
+    def _get_root_condition(self,tree_id=None):
+        """ 返回根节点的查询条件，tree_id=None时为所有树的根节点 """
+        cls=self._model_class
+        if tree_id is None:
+            return cls.tree_left==1
+        return and_(cls.__dict__[cls.__tree_key__]==tree_id,cls.tree_left==1)
+
     def get_tree_key_field(self):
         """取得标识树的id字段"""
         return self._model_class.__table__.columns[self._model_class.__tree_id__]
@@ -146,10 +841,239 @@ class TreeManager(object):
 
     def get_node_tree_id(self,node):
         """取得节点所属的tree id 值"""
-        tree_id=node.__dict__[self._model_class.__tree_key__] if hasattr(node,self._model_class.__tree_key__) else 0
+        tree_id=getattr(node,self._model_class.__tree_key__,0)
         tree_id=0 if tree_id is None else tree_id
         return tree_id
 
+    def _get_insert_position(self,ref_node,pos):
+        """
+        取得在ref_node的pos位置插入节点时，新节点的左值及层级
+        :return: (左值,层级)
+        """
+        if pos==TREE_NODE_POSITION.LastChild:#增加为最后一个子节点
+            return ref_node.tree_right,ref_node.tree_level+1
+        elif pos==TREE_NODE_POSITION.FirstChild:#增加为第一个子节点
+            return ref_node.tree_left+1,ref_node.tree_level+1
+        elif pos==TREE_NODE_POSITION.NextSibling:#增加为下一个兄弟节点
+            return ref_node.tree_right+1,ref_node.tree_level
+        elif pos==TREE_NODE_POSITION.PreviousSibling:#增加为上一个兄弟节点
+            return ref_node.tree_left,ref_node.tree_level
+        raise TreeNodeInvalidOperation
+
+    def _open_gap(self,ref_node,pos,size):
+        """
+        在ref_node的pos位置空出size个左右值,所有大于等于插入位置的左右值均加上size
+        :return: (空出的第一个左值,新节点的层级,树id)
+        """
+        tree_id=self.get_node_tree_id(ref_node)
+        left,level=self._get_insert_position(ref_node,pos)
+        self._shift_values(tree_id,left,size)
+        return left,level,tree_id
+
+    def _shift_values(self,tree_id,value,offset):
+        """ 将树中所有大于等于value的左右值均加上offset """
+        cls=self._model_class
+        self._session.query(cls)\
+            .filter(and_(cls.tree_right>=value,cls.__dict__[cls.__tree_key__]==tree_id))\
+            .update({cls.tree_right:cls.tree_right+offset})
+        self._session.query(cls)\
+            .filter(and_(cls.tree_left>=value,cls.__dict__[cls.__tree_key__]==tree_id))\
+            .update({cls.tree_left:cls.tree_left+offset})
+
+    def _get_spacing(self):
+        """ 取得左右值的间隔，见TreeMixin.__tree_spacing__ """
+        return max(int(getattr(self._model_class,"__tree_spacing__",1)),1)
+
+    def _get_parent_field(self):
+        """
+        取得保存父节点pk值的字段名称，见TreeMixin.__tree_parent_field__
+        表中没有定义该字段时返回None
+        """
+        cls=self._model_class
+        name=getattr(cls,"__tree_parent_field__",None)
+        return name if name is not None and name in cls.__table__.columns else None
+
+    def _get_position_parent_pk(self,ref_node,pos):
+        """
+        取得插入到ref_node的pos位置的节点的父节点pk值
+        """
+        if pos in (TREE_NODE_POSITION.LastChild,TREE_NODE_POSITION.FirstChild):
+            pk_name=self.get_primary_field().name
+            if getattr(ref_node,pk_name) is None:#相对节点还没有写入数据库,需要先提交以取得pk值
+                self._session.flush()
+            return getattr(ref_node,pk_name)
+        return getattr(ref_node,self._get_parent_field())
+
+    def _new_primary_value(self):
+        """
+        通过主键字段的默认值函数生成一个新的pk值，主键没有默认值函数(如自增字段)时返回None
+        """
+        default=self.get_primary_field().default
+        if default is not None and default.is_callable:
+            return default.arg(None)
+        return None
+
+    def _update_parent_ids(self,tree_id,left,right):
+        """
+        根据左右值重新计算树中左值在left,right之间的节点的父节点pk值
+        """
+        cls=self._model_class
+        parent_field=self._get_parent_field()
+        tree_key=cls.__dict__[cls.__tree_key__]
+        parent=aliased(cls)
+        parent_pk=self._session.query(getattr(parent,self.get_primary_field().name))\
+            .filter(and_(
+                getattr(parent,cls.__tree_key__)==tree_key,
+                parent.tree_left<cls.tree_left,
+                parent.tree_right>cls.tree_right
+            )).order_by(parent.tree_left.desc()).limit(1).correlate(cls).as_scalar()
+        self._session.query(cls)\
+            .filter(and_(tree_key==tree_id,cls.tree_left>=left,cls.tree_left<=right))\
+            .update({cls.__dict__[parent_field]:parent_pk},synchronize_session=False)
+
+    def _get_path_field(self):
+        """
+        取得保存节点路径的字段名称，见TreeMixin.__tree_path_field__
+        表中没有定义该字段时返回None
+        """
+        cls=self._model_class
+        name=getattr(cls,"__tree_path_field__",None)
+        return name if name is not None and name in cls.__table__.columns else None
+
+    def _get_position_parent_path(self,ref_node,pos):
+        """
+        取得插入到ref_node的pos位置的节点的父节点路径，ref_node=None时返回根路径"/"
+        """
+        if ref_node is None:
+            return u"/"
+        path=getattr(ref_node,self._get_path_field())
+        if pos in (TREE_NODE_POSITION.LastChild,TREE_NODE_POSITION.FirstChild):
+            return path
+        return path[:path.rstrip("/").rfind("/")+1]
+
+    def _parse_path(self,path):
+        """ 将路径解析为pk值列表,从根节点开始,最后一个是节点自身 """
+        python_type=self.get_primary_field().type.python_type
+        return [python_type(pk) for pk in path.strip("/").split("/")] if path.strip("/") else []
+
+    def _escape_like(self,value):
+        """ 转义LIKE中的通配符，使用\\作为转义字符 """
+        return value.replace("\\","\\\\").replace("%","\\%").replace("_","\\_")
+
+    def _set_node_paths(self,nodes,parent_path):
+        """
+        设置新增节点的路径,没有pk值的节点先通过主键的默认值函数生成，仍然没有时(如自增主键)需要先提交到数据库
+        """
+        pk_name=self.get_primary_field().name
+        path_field=self._get_path_field()
+        for node in nodes:
+            if getattr(node,pk_name) is None:
+                setattr(node,pk_name,self._new_primary_value())
+        if [node for node in nodes if getattr(node,pk_name) is None]:
+            self._session.flush()
+        for node in nodes:
+            setattr(node,path_field,u"%s%s/" % (parent_path,getattr(node,pk_name)))
+
+    def _update_paths(self,tree_id,left,right,parent_path):
+        """
+        根据左右值重新计算树中左值在left,right之间的节点的路径，这些节点的父节点路径为parent_path
+        """
+        cls=self._model_class
+        pk_name=self.get_primary_field().name
+        tree_key=cls.__dict__[cls.__tree_key__]
+        rows=self._session.query(cls.__dict__[pk_name],cls.tree_left,cls.tree_right)\
+            .filter(and_(tree_key==tree_id,cls.tree_left>=left,cls.tree_left<=right))\
+            .order_by(cls.tree_left).all()
+        mappings=[]
+        stack=[]#(tree_right,路径)
+        for pk,left,right in rows:
+            while stack and stack[-1][0]<left:
+                stack.pop()
+            path=u"%s%s/" % (stack[-1][1] if stack else parent_path,pk)
+            mappings.append({pk_name:pk,self._get_path_field():path})
+            stack.append((right,path))
+        self._session.bulk_update_mappings(cls,mappings)
+
+    def _move_paths(self,node,parent_path):
+        """
+        节点移动到parent_path下时，更新节点及所有后代节点的路径:将原路径前缀替换为新路径
+        """
+        cls=self._model_class
+        path_field=self._get_path_field()
+        column=cls.__dict__[path_field]
+        old_path=getattr(node,path_field)
+        new_path=u"%s%s/" % (parent_path,self.get_node_primary(node))
+        if old_path==new_path:
+            return
+        self._session.query(cls)\
+            .filter(column.like(self._escape_like(old_path)+"%",escape="\\"))\
+            .update({column:literal(new_path,type_=column.type).concat(func.substr(column,len(old_path)+1))},synchronize_session=False)
+        for item in list(self._session.identity_map.values()):
+            if isinstance(item,cls) and (item.__dict__.get(path_field) or "").startswith(old_path):
+                set_committed_value(item,path_field,new_path+item.__dict__[path_field][len(old_path):])
+
+    def _get_free_range(self,ref_node,pos):
+        """
+        间隔编号时，取得ref_node的pos位置两侧已经使用的左右值
+        :return: (下界,上界,层级,树id),新节点的左右值只能在下界与上界之间(不包括两者),上界=None时不限制
+        """
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        tree_id=self.get_node_tree_id(ref_node)
+        ref_left,ref_right=ref_node.tree_left,ref_node.tree_right
+        query=lambda value,*conditions:self._session.query(value).filter(and_(tree_key==tree_id,*conditions)).as_scalar()
+        if pos==TREE_NODE_POSITION.LastChild:#最后一个子节点的右值到ref_node的右值之间
+            lo=self._session.query(query(func.max(cls.tree_right),cls.tree_left>ref_left,cls.tree_right<ref_right)).scalar()
+            return max(lo,ref_left) if lo is not None else ref_left,ref_right,ref_node.tree_level+1,tree_id
+        elif pos==TREE_NODE_POSITION.FirstChild:#ref_node的左值到第一个子节点的左值之间
+            hi=self._session.query(query(func.min(cls.tree_left),cls.tree_left>ref_left,cls.tree_left<ref_right)).scalar()
+            return ref_left,hi if hi is not None else ref_right,ref_node.tree_level+1,tree_id
+        elif pos==TREE_NODE_POSITION.NextSibling:#ref_node的右值到下一个左右值之间
+            values=self._session.query(query(func.min(cls.tree_left),cls.tree_left>ref_right),query(func.min(cls.tree_right),cls.tree_right>ref_right)).one()
+            values=[value for value in values if value is not None]
+            return ref_right,min(values) if values else None,ref_node.tree_level,tree_id
+        elif pos==TREE_NODE_POSITION.PreviousSibling:#上一个左右值到ref_node的左值之间
+            values=self._session.query(query(func.max(cls.tree_left),cls.tree_left<ref_left),query(func.max(cls.tree_right),cls.tree_right<ref_left)).one()
+            values=[value for value in values if value is not None]
+            return max(values) if values else 0,ref_left,ref_node.tree_level,tree_id
+        raise TreeNodeInvalidOperation
+
+    def _get_free_values(self,ref_node,pos,size):
+        """
+        间隔编号时，在ref_node的pos位置的空隙中取得一段可以容纳size个左右值的范围
+        空隙足够时不修改任何节点，否则从空隙的上界开始将后面的左右值后移，空出一段较大的空隙以便后续使用
+        :return: (下界,上界,间隔,层级,树id),下界与上界之间可以按间隔依次分配size个左右值
+        """
+        spacing=self._get_spacing()
+        lo,hi,level,tree_id=self._get_free_range(ref_node,pos)
+        if hi is None:#根节点的兄弟节点，后面没有其他左右值
+            hi=lo+(size+1)*spacing
+        step=min(spacing,(hi-lo)/(size+1))
+        if step<1:
+            offset=max(size+1,spacing)*spacing
+            self._shift_values(tree_id,hi,offset)
+            hi+=offset
+            step=spacing
+        return lo,hi,step,level,tree_id
+
+    def _alloc_values(self,ref_node,pos,count):
+        """
+        在ref_node的pos位置为count个节点分配左右值
+        连续编号时空出count*2个左右值，间隔编号时尽量在已有的空隙中分配
+        :return: (count*2个递增的左右值列表,层级,树id)
+        """
+        size=count*2
+        if self._get_spacing()==1:
+            left,level,tree_id=self._open_gap(ref_node,pos,size)
+            return range(left,left+size),level,tree_id
+        lo,hi,step,level,tree_id=self._get_free_values(ref_node,pos,size)
+        if pos in (TREE_NODE_POSITION.FirstChild,TREE_NODE_POSITION.PreviousSibling):
+            #插入到前面时靠近上界分配，以便在同一位置继续插入
+            return [hi-step*(size-i) for i in range(size)],level,tree_id
+        else:
+            return [lo+step*(i+1) for i in range(size)],level,tree_id
+
+    @_profiled
     def add_node(self,nodes, ref_node=None, pos=TREE_NODE_POSITION.LastChild,tree_id=None):
         """
             增加一个或多个节点
@@ -174,12 +1098,20 @@ class TreeManager(object):
 
         #取得要增加的树id，要求所有节点必须是同一棵树
         tree_id=self.get_node_tree_id(nodes[0]) if tree_id is None else tree_id
+        self._lock_nodes([ref_node],[tree_id] if ref_node is None else [])
+
+        #同时维护父节点pk值
+        parent_field=self._get_parent_field()
+        if parent_field is not None:
+            parent_pk=None if ref_node is None else self._get_position_parent_pk(ref_node,pos)
+            for node in nodes:
+                node.__dict__[parent_field]=parent_pk
 
         # 增加根节点,一棵树只能有一个根节点
         # 如果nodes有多个，说明要新增多个根节点，或者多棵树
         if ref_node is None:
             #判断该树是否已经存在root节点
-            has_root_node=session.query(session.query(cls).filter(and_(cls.__dict__[cls.__tree_key__]==tree_id,cls.tree_left==1)).exists()).scalar()
+            has_root_node=session.query(session.query(cls).filter(self._get_root_condition(tree_id)).exists()).scalar()
             #根节点已经存在,触发错误
             if has_root_node:
                 raise TreeNodeOnlyOneRootException
@@ -187,93 +1119,206 @@ class TreeManager(object):
             for i in range(added_node_count):
                 nodes[i].__dict__.update({
                     "tree_left":1,
-                    "tree_right":2,
+                    "tree_right":1+self._get_spacing(),
                     "tree_level":1
                 })
         else:
-            #保存相对节点的基本数据
-            ref_right=ref_node.tree_right;ref_left=ref_node.tree_left
-            ref_level=ref_node.tree_level;ref_tree_id=self.get_node_tree_id(ref_node)
-
-            if pos==TREE_NODE_POSITION.LastChild:#增加为最后一个子节点
-                for i in range(added_node_count):
-                    nodes[i].__dict__.update({
-                        cls.__tree_key__:ref_tree_id,
-                        "tree_left":ref_right+i*2,
-                        "tree_right":ref_right+i*2+1,
-                        "tree_level":ref_level+1
-                    })
-                self._session.query(cls)\
-                    .filter(and_(cls.tree_right>=ref_right,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                    .update({cls.tree_right:cls.tree_right+added_node_count*2})
-                self._session.query(cls)\
-                    .filter(and_(cls.tree_left>=ref_right,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                    .update({cls.tree_left:cls.tree_left+added_node_count*2})
-            elif pos==TREE_NODE_POSITION.FirstChild:#增加为第一个子节点
-                for i in range(len(nodes)):
-                    nodes[i].__dict__.update({
-                        cls.__tree_key__:ref_tree_id,
-                        "tree_left":ref_left+i*2+1,
-                        "tree_right":ref_left+i*2+2,
-                        "tree_level":ref_level+1
-                    })
-                session.query(cls)\
-                    .filter(and_(cls.tree_left>ref_left,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                    .update({cls.tree_left:cls.tree_left+added_node_count*2})
-                session.query(cls)\
-                    .filter(and_(cls.tree_right>=ref_left+1,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                    .update({cls.tree_right:cls.tree_right+added_node_count*2})
-            elif pos==TREE_NODE_POSITION.NextSibling:#增加为下一个兄弟节点
-                for i in range(len(nodes)):
-                    nodes[i].__dict__.update({
-                        cls.__tree_key__:ref_tree_id,
-                        "tree_left":ref_right+i*2+1,
-                        "tree_right":ref_right+i*2+2,
-                        "tree_level":ref_level
-                    })
-                self._session.query(cls).\
-                    filter(and_(cls.tree_left>ref_right,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                    .update({cls.tree_left:cls.tree_left+added_node_count*2})
-                self._session.query(cls)\
-                    .filter(and_(cls.tree_right>ref_right,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                    .update({cls.tree_right:cls.tree_right+added_node_count*2})
-            elif pos==TREE_NODE_POSITION.PreviousSibling:#增加为上一个兄弟节点
-                for i in range(len(nodes)):
-                    nodes[i].__dict__.update({
-                        cls.__tree_key__:ref_tree_id,
-                        "tree_left":ref_left+i*2,
-                        "tree_right":ref_left+i*2+1,
-                        "tree_level":ref_level
-                    })
-                self._session.query(cls)\
-                    .filter(and_(cls.tree_left>=ref_left,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                    .update({cls.tree_left:cls.tree_left+added_node_count*2})
-                self._session.query(cls)\
-                    .filter(and_(cls.tree_right>=ref_left+1,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                    .update({cls.tree_right:cls.tree_right+added_node_count*2})
+            #在相对节点处分配所需的左右值，然后依次分配给新节点
+            values,level,ref_tree_id=self._alloc_values(ref_node,pos,added_node_count)
+            for i in range(added_node_count):
+                nodes[i].__dict__.update({
+                    cls.__tree_key__:ref_tree_id,
+                    "tree_left":values[i*2],
+                    "tree_right":values[i*2+1],
+                    "tree_level":level
+                })
 
         #提交增加节点到会话
         if len(nodes)==1:
             session.add(nodes[0])
         else:
             session.add_all(nodes)
+        if self._get_path_field() is not None:
+            self._set_node_paths(nodes,self._get_position_parent_path(ref_node,pos))
+        self._invalidate_tree(tree_id if ref_node is None else ref_tree_id)
+
+    def _get_import_items(self,data,children_name):
+        """
+        将import_tree的数据转换为先序排列的[(节点数据,深度),...]，顶层节点深度为0
+        """
+        pk_name=self.get_primary_field().name
+        items=[]
+        if isinstance(data,dict):
+            data=[data]
+        if len(data)>0 and isinstance(data[0],(tuple,list)):
+            pks=set(item[1].get(pk_name) for item in data)
+            children={}
+            for parent_pk,node_data in data:
+                children.setdefault(parent_pk if parent_pk in pks else None,[]).append(node_data)
+            stack=[(iter(children.get(None,[])),0)]
+            while stack:
+                node_data=next(stack[-1][0],None)
+                if node_data is None:
+                    stack.pop()
+                    continue
+                depth=stack[-1][1]
+                items.append((node_data,depth))
+                node_pk=node_data.get(pk_name)
+                if node_pk is not None and node_pk in children:
+                    stack.append((iter(children[node_pk]),depth+1))
+            if len(items)<len(data):#父节点形成环(包括父节点是自己)的节点无法从顶层节点到达
+                reached=set(id(item[0]) for item in items)
+                raise TreeNodeInvalidOperation(u"父节点形成环的节点:%s" %
+                    ",".join(unicode(node_data.get(pk_name)) for parent_pk,node_data in data if id(node_data) not in reached))
+        else:
+            stack=[(iter(data),0)]
+            while stack:
+                node_data=next(stack[-1][0],None)
+                if node_data is None:
+                    stack.pop()
+                    continue
+                depth=stack[-1][1]
+                node_data=dict(node_data)
+                child_nodes=node_data.pop(children_name,None)
+                items.append((node_data,depth))
+                if child_nodes:
+                    stack.append((iter(child_nodes),depth+1))
+        return items
+
+    @_profiled
+    def import_tree(self,data,ref_node=None,pos=TREE_NODE_POSITION.LastChild,tree_id=None,children_name="children"):
+        """
+            批量导入一棵或多棵子树
+        所有节点的左右值、层级在内存中一次计算完成，只在插入位置空出一次2*n的左右值，
+        然后通过一次bulk_insert_mappings插入所有节点，适用于导入大量的树形数据。
+        注意：导入的节点不会加入到会话中
+        :param data: 支持以下两种格式
+                嵌套结构:{"name":"A","children":[{"name":"A1"},...]}，或者由多个这样的dict组成的列表
+                (父节点pk,节点数据)列表:[(None,{"id":1,"name":"A"}),(1,{"id":2,"name":"A1"}),...]
+                    父节点pk是同一批数据中另一节点的pk值，父节点pk=None或者不在该批数据中的节点作为顶层节点,
+                    兄弟节点按列表中的顺序排列，父节点形成环(包括父节点是自己)时抛出TreeNodeInvalidOperation
+        :param ref_node: 相对节点，如果=None则导入为一棵新树，此时只能有一个顶层节点
+        :param pos: 顶层节点相对ref_node的位置，同add_node
+        :param tree_id: 导入为新树时的树id,如果没有指定则使用顶层节点数据中的值
+        :param children_name: 嵌套结构中存放子节点的键名称
+        :return: 导入的节点数量
+        """
+        session=self._session
+        cls=self._model_class
+        pk_name=self.get_primary_field().name
+        self._lock_nodes([ref_node])
 
+        items=self._get_import_items(data,children_name)
+        if len(items)==0:
+            return 0
+
+        parent_field=self._get_parent_field()
+        parent_pk=None if ref_node is None or parent_field is None else self._get_position_parent_pk(ref_node,pos)
+        path_field=self._get_path_field()
+        parent_path=None if path_field is None else self._get_position_parent_path(ref_node,pos)
+        if ref_node is None:
+            if len([item for item in items if item[1]==0])>1:
+                raise TreeNodeOnlyOneRootException
+            tree_id=items[0][0].get(cls.__tree_key__,0) if tree_id is None else tree_id
+            self._lock_nodes([],[tree_id])
+            has_root_node=session.query(session.query(cls).filter(self._get_root_condition(tree_id)).exists()).scalar()
+            if has_root_node:
+                raise TreeNodeOnlyOneRootException
+            values,level=xrange(1,len(items)*2*self._get_spacing()+1,self._get_spacing()),1
+        else:
+            values,level,tree_id=self._alloc_values(ref_node,pos,len(items))
+
+        #按先序依次分配左右值，栈中保存未结束节点的插入数据
+        mappings=[]
+        stack=[]
+        values=iter(values)
+        unknown_parent=False#是否有节点的父节点pk值在插入前无法确定
+        unknown_path=False
+        for node_data,depth in items:
+            while len(stack)>depth:
+                stack.pop()["tree_right"]=next(values)
+            mapping=dict(node_data)
+            mapping.update({cls.__tree_key__:tree_id,"tree_left":next(values),"tree_level":level+depth})
+            if (parent_field is not None or path_field is not None) and mapping.get(pk_name) is None:
+                mapping[pk_name]=self._new_primary_value()
+            if parent_field is not None:
+                mapping[parent_field]=stack[-1][pk_name] if stack else parent_pk
+                unknown_parent=unknown_parent or (len(stack)>0 and mapping[parent_field] is None)
+            if path_field is not None:
+                if mapping[pk_name] is None:
+                    unknown_path=True
+                elif not unknown_path:
+                    mapping[path_field]=u"%s%s/" % (stack[-1][path_field] if stack else parent_path,mapping[pk_name])
+            mappings.append(mapping)
+            stack.append(mapping)
+        while stack:
+            stack.pop()["tree_right"]=next(values)
+
+        session.bulk_insert_mappings(cls,mappings)
+        if unknown_parent:#如自增主键，插入后再根据左右值更新
+            self._update_parent_ids(tree_id,mappings[0]["tree_left"],mappings[-1]["tree_left"])
+        if unknown_path:
+            self._update_paths(tree_id,mappings[0]["tree_left"],mappings[-1]["tree_left"],parent_path)
+        self._invalidate_tree(tree_id)
+        return len(mappings)
+
+    @_profiled
     def del_node(self,node):
         """ 删除指定的节点 """
 
         cls=self._model_class
+        self._lock_nodes([node])
         lft=node.tree_left
         rgt=node.tree_right
         self._session.query(cls)\
             .filter(and_(cls.tree_left>=lft,cls.tree_right<=rgt,cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)))\
             .delete()
-        self._session.query(cls)\
-            .filter(and_(cls.tree_left>lft,cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)))\
-            .update({cls.tree_left:cls.tree_left-(rgt-lft+1)})
-        self._session.query(cls)\
-            .filter(and_(cls.tree_right>rgt,cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)))\
-            .update({cls.tree_right:cls.tree_right-(rgt-lft+1)})
+        #间隔编号时删除节点留下的空隙不需要收回
+        if self._get_spacing()==1:
+            self._session.query(cls)\
+                .filter(and_(cls.tree_left>lft,cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)))\
+                .update({cls.tree_left:cls.tree_left-(rgt-lft+1)})
+            self._session.query(cls)\
+                .filter(and_(cls.tree_right>rgt,cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)))\
+                .update({cls.tree_right:cls.tree_right-(rgt-lft+1)})
+        self._invalidate_tree(self.get_node_tree_id(node))
 
+    @_profiled
+    def del_nodes(self,nodes):
+        """
+        批量删除多个节点，连同各节点下属的子孙节点
+        已经被其他选中节点包含的节点会被忽略，所有节点通过一条DELETE语句删除，
+        每棵树的左右值只需要一次UPDATE调整
+        """
+        self._lock_nodes(nodes)
+        nodes=self._get_top_nodes(nodes)
+        if len(nodes)==0:
+            return
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        trees=self._group_by_tree(nodes)
+        self._session.query(cls)\
+            .filter(self._get_many_condition(nodes,lambda node:cls.tree_left.between(node.tree_left,node.tree_right)))\
+            .delete(synchronize_session="fetch")
+        #间隔编号时删除节点留下的空隙不需要收回
+        if self._get_spacing()==1:
+            tree_shifts={}
+            for tree_id,tree_nodes in trees.items():
+                shifts=self._get_shifts([(node.tree_left,node.tree_right) for node in tree_nodes])
+                tree_shifts[tree_id]=shifts
+                self._session.query(cls)\
+                    .filter(and_(tree_key==tree_id,cls.tree_right>=shifts[-1][0]))\
+                    .update({
+                        cls.tree_left:self._get_shift_case(cls.tree_left,[],shifts),
+                        cls.tree_right:self._get_shift_case(cls.tree_right,[],shifts)
+                    },synchronize_session=False)
+            def sync(left,right,level,tree_id):
+                shifts=tree_shifts[tree_id]
+                return self._shift_value(left,[],shifts),self._shift_value(right,[],shifts),level,tree_id
+            self._sync_session_nodes(tree_shifts,sync)
+        self._invalidate_tree(*trees.keys())
+
+    @_profiled
     def move_node(self,node,ref_node,pos=0):
         """
             移动节点node到refnode的相对位置，连同该节点下属的所有子节点
@@ -283,144 +1328,346 @@ class TreeManager(object):
          """
 
         assert isinstance(node,TreeMixin),u'非法节点'
-
-        cls=self._model_class
+        self._lock_nodes([node,ref_node])
 
         #如果在同一棵树，则需要判断一下节点之间的关系
         #如果两个节点是一样的，或者ref_node是Node是后代，则移动操作不允许
         if self.get_node_tree_id(ref_node)==self.get_node_tree_id(node):
-            R=self.get_node_relation(ref_node,node)
-            if R==TREE_NODE_RELATION.Descendants or R==TREE_NODE_RELATION.Self:
+            if node.tree_left<=ref_node.tree_left and ref_node.tree_right<=node.tree_right:
                 raise TreeNodeInvalidOperation
 
-        node_left=node.tree_left
-        node_right=node.tree_right
-        node_level=node.tree_level
-        node_tree_id=self.get_node_tree_id(node)
-
-        node_count=(node_right-node_left-1)/2+1#所有子孙节点数量，加自己
-        node_offset=node_count*2
-
-        #找出所有子孙节点,包括自己
-        move_nodes= [item.id for item in self._session.query(cls).filter(and_(cls.tree_left>=node_left,cls.tree_left<=node_right,cls.__dict__[cls.__tree_key__]==node_tree_id)).order_by(cls.tree_left)]
+        parent_field=self._get_parent_field()
+        if parent_field is not None:
+            setattr(node,parent_field,self._get_position_parent_pk(ref_node,pos))
+        if self._get_path_field() is not None:
+            self._move_paths(node,self._get_position_parent_path(ref_node,pos))
 
-        #先模拟删除该节点,更新相关的节点left,right值
-        #执行以下两句后，要移动的节点就从树中脱离，但并没有实际删除
-        self._session.query(cls)\
-            .filter(and_(cls.tree_left>node_right,cls.__dict__[cls.__tree_key__]==node_tree_id))\
-            .update({cls.tree_left:cls.tree_left-(node_right-node_left+1)})
-        self._session.query(cls)\
-            .filter(and_(cls.tree_right>node_right,cls.__dict__[cls.__tree_key__]==node_tree_id))\
-            .update({cls.tree_right:cls.tree_right-(node_right-node_left+1)})
+        if self._get_spacing()>1:
+            return self._move_node_spaced(node,ref_node,pos)
 
-        #模拟删节点后，refnode的left,right值发生变化需要重新取得
-        ref_left=ref_node.tree_left
-        ref_right=ref_node.tree_right
-        ref_level=ref_node.tree_level
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        node_left,node_right,node_level=node.tree_left,node.tree_right,node.tree_level
+        node_tree_id=self.get_node_tree_id(node)
         ref_tree_id=self.get_node_tree_id(ref_node)
-
-        if pos==0:#最后一个子节点
-            #先移动到最后一个子节点
-            self._session.query(cls).filter(cls.id.in_(move_nodes)).update({
-                cls.tree_left:cls.tree_left-(node_left-ref_right),
-                cls.tree_level:ref_level+(cls.tree_level-node_level)+1,
-                cls.tree_right:cls.tree_right-(node_left-ref_right),
-                cls.__tree_key__: ref_tree_id                    #更新tree id
-            },synchronize_session="fetch")
-
-            #调整个后续节点,只调整同一棵树
-            self._session.query(cls).filter(
-                and_(~cls.id.in_(move_nodes),cls.tree_left>ref_right,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                .update({cls.tree_left:cls.tree_left+node_offset},synchronize_session="fetch")
-            self._session.query(cls).filter(
-                and_(~cls.id.in_(move_nodes),cls.tree_right>=ref_right,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                .update({cls.tree_right:cls.tree_right+node_offset},synchronize_session="fetch")
-
-        elif pos==1:#第一个子节点
-            #先移动到第一个子节点
-            self._session.query(cls).filter(cls.id.in_(move_nodes)).update({
-                cls.tree_left:cls.tree_left+(ref_left-node_left+1),
-                cls.tree_right:cls.tree_right+(ref_left-node_left+1),
-                cls.tree_level:ref_level+(cls.tree_level-node_level)+1,
-                cls.__tree_key__:ref_tree_id
-            },synchronize_session="fetch")
-
-            #调整移动操作导致后续节点RL值变化,以下调整相应的RL值
-            self._session.query(cls)\
-                .filter(and_(~cls.id.in_(move_nodes),cls.tree_left>ref_left,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                .update({cls.tree_left:cls.tree_left+node_count*2},synchronize_session="fetch")
-            self._session.query(cls)\
-                .filter(and_(~cls.id.in_(move_nodes),cls.tree_right>ref_left,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                .update({cls.tree_right:cls.tree_right+node_count*2},synchronize_session="fetch")
-
-        elif pos==2:#2:移动到下一节点，
-            #移动到下一节点
+        width=node_right-node_left+1
+        #目标位置在移动前的左值，以及移动后node的层级
+        value,level=self._get_insert_position(ref_node,pos)
+        level_offset=level-node_level
+
+        if node_tree_id==ref_tree_id:
+            #同一棵树中移动只影响node与目标位置之间的节点:子树整体平移offset,中间的节点反向平移子树的宽度
+            if value>node_right:
+                offset=value-node_right-1
+                lo,hi,other_offset=node_right+1,value-1,-width
+            else:
+                offset=value-node_left
+                lo,hi,other_offset=value,node_left-1,width
+            def move_value(v):
+                if node_left<=v<=node_right:
+                    return v+offset
+                if lo<=v<=hi:
+                    return v+other_offset
+                return v
+            def new_value(column):
+                return case([(column.between(node_left,node_right),column+offset),
+                             (column.between(lo,hi),column+other_offset)],else_=column)
+            lo,hi=min(lo,node_left),max(hi,node_right)
             self._session.query(cls)\
-                .filter(cls.id.in_(move_nodes))\
+                .filter(and_(tree_key==node_tree_id,or_(cls.tree_left.between(lo,hi),cls.tree_right.between(lo,hi))))\
                 .update({
-                    cls.tree_left:ref_right+(cls.tree_left-node_left)+1,
-                    cls.tree_right:cls.tree_right+(ref_left-node_left+1)+1,
-                    cls.tree_level:ref_level+(cls.tree_level-node_level),
-                    cls.__tree_key__:ref_tree_id
-                },synchronize_session="fetch")
-            #调整个后续节点
-            self._session.query(cls)\
-                .filter(and_(~cls.id.in_(move_nodes),cls.tree_left>ref_left,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                .update({cls.tree_left:cls.tree_left+node_count*2},synchronize_session="fetch")
-            self._session.query(cls)\
-                .filter(and_(~cls.id.in_(move_nodes),cls.tree_right>ref_right,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                .update({cls.tree_right:cls.tree_right+node_count*2},synchronize_session="fetch")
-
-        elif pos==3:#3:移到上一节点
-            #移动到上一节点
+                    cls.tree_left:new_value(cls.tree_left),
+                    cls.tree_right:new_value(cls.tree_right),
+                    cls.tree_level:case([(cls.tree_left.between(node_left,node_right),cls.tree_level+level_offset)],else_=cls.tree_level)
+                },synchronize_session=False)
+            def sync(left,right,level,tree_id):
+                if node_left<=left<=node_right:
+                    level+=level_offset
+                return move_value(left),move_value(right),level,tree_id
+        else:
+            #移动到另一棵树:在目标位置空出子树的宽度，移入子树，再收回原位置的空隙
             self._session.query(cls)\
-                .filter(cls.id.in_(move_nodes))\
+                .filter(and_(tree_key==ref_tree_id,cls.tree_right>=value))\
                 .update({
-                    cls.tree_left:ref_left+(cls.tree_left-node_left),
-                    cls.tree_right:cls.tree_right+(ref_left-node_left),
-                    cls.tree_level:ref_level+(cls.tree_level-node_level),
-                    cls.__tree_key__:ref_tree_id
-                },synchronize_session="fetch")
-            #调整个后续节点
+                    cls.tree_left:case([(cls.tree_left>=value,cls.tree_left+width)],else_=cls.tree_left),
+                    cls.tree_right:cls.tree_right+width
+                },synchronize_session=False)
             self._session.query(cls)\
-                .filter(and_(~cls.id.in_(move_nodes),cls.tree_left>=ref_left,cls.__dict__[cls.__tree_key__]==ref_tree_id)).\
-                update({cls.tree_left:cls.tree_left+node_count*2},synchronize_session="fetch")
+                .filter(and_(tree_key==node_tree_id,cls.tree_left.between(node_left,node_right)))\
+                .update({
+                    cls.tree_left:cls.tree_left+(value-node_left),
+                    cls.tree_right:cls.tree_right+(value-node_left),
+                    cls.tree_level:cls.tree_level+level_offset,
+                    tree_key:ref_tree_id
+                },synchronize_session=False)
             self._session.query(cls)\
-                .filter(and_(~cls.id.in_(move_nodes),cls.tree_right>=ref_right,cls.__dict__[cls.__tree_key__]==ref_tree_id))\
-                .update({cls.tree_right:cls.tree_right+node_count*2},synchronize_session="fetch")
-
-    def move_node_up(self,node,allow_upgrade=True):
+                .filter(and_(tree_key==node_tree_id,cls.tree_right>node_right))\
+                .update({
+                    cls.tree_left:case([(cls.tree_left>node_right,cls.tree_left-width)],else_=cls.tree_left),
+                    cls.tree_right:cls.tree_right-width
+                },synchronize_session=False)
+            def sync(left,right,level,tree_id):
+                if tree_id==ref_tree_id:
+                    return left+(width if left>=value else 0),right+(width if right>=value else 0),level,tree_id
+                if node_left<=left<=node_right:
+                    return left+(value-node_left),right+(value-node_left),level+level_offset,ref_tree_id
+                return left-(width if left>node_right else 0),right-(width if right>node_right else 0),level,tree_id
+
+        self._sync_session_nodes((node_tree_id,ref_tree_id),sync)
+        self._invalidate_tree(node_tree_id,ref_tree_id)
+
+    def _sync_session_nodes(self,tree_ids,sync):
         """
-        将节点上移一步
-        :param allow_upgrade: 当移动到最上面时，是否继续上移为父节点的下一个兄弟节点
-        :return:
+        以synchronize_session=False批量更新后，同步会话中已载入的节点值,避免再次查询数据库
+        :param sync: sync(tree_left,tree_right,tree_level,tree_id)返回新的(tree_left,tree_right,tree_level,tree_id)
         """
-        #取得上一个兄弟节点
-        try:
-            ref_node=self.get_previous_sibling(node)
-            self.move_node(node,ref_node,pos=TREE_NODE_POSITION.PreviousSibling)
-        except TreeNodeNotFound:#不存在前一个节点，则需要升级并移动父点的下一个节点
-            if allow_upgrade:
-                ref_node=self.get_parent(node)
-                self.move_node(node,ref_node,pos=TREE_NODE_POSITION.NextSibling)
-            else:
-                raise TreeNodeInvalidOperation
-
-    def move_node_down(self,node,allow_downgrade=True):
+        cls=self._model_class
+        names=("tree_left","tree_right","tree_level",cls.__tree_key__)
+        for node in list(self._session.identity_map.values()):
+            #已过期的节点下次访问时会从数据库读取最新值,不需要同步
+            if not isinstance(node,cls) or not all(name in node.__dict__ for name in names):
+                continue
+            old_values=tuple(node.__dict__[name] for name in names)
+            if old_values[3] not in tree_ids:
+                continue
+            for name,old_value,new_value in zip(names,old_values,sync(*old_values)):
+                if new_value!=old_value:
+                    set_committed_value(node,name,new_value)
+
+    def _move_node_spaced(self,node,ref_node,pos):
         """
-        :param allow_downgrade: 当移动到最下面时，是否继续上移为父节点的下一个兄弟节点
-        :return:
+        间隔编号时移动节点:在目标位置的空隙中放入整个子树，只需要一次更新子树的左右值
+        原位置留下的空隙不需要收回，只有目标位置空隙不够时才需要后移其他节点
         """
-        #取得上一个兄弟节点
-        try:
-            ref_node=self.get_previous_sibling(node)
-            self.move_node(node,ref_node,pos=TREE_NODE_POSITION.NextSibling)
-        except TreeNodeNotFound:#不存在下一个节点，则需要升级并移动父点的下一个节点
+        cls=self._model_class
+        node_tree_id=self.get_node_tree_id(node)
+        width=node.tree_right-node.tree_left
+        lo,hi,level,ref_tree_id=self._get_free_range(ref_node,pos)
+        if hi is not None and hi-lo<width+2:
+            #空隙放不下整个子树时重新编号子树，后移的范围只与子树的节点数有关，
+            #否则子树内部的空隙会随每次移动成倍增大左右值
+            return self._move_node_renumbered(node,ref_node,pos)
+        if hi is None:#根节点的兄弟节点，后面没有其他左右值
+            hi=lo+(width+2)*self._get_spacing()
+        step=min(self._get_spacing(),(hi-lo)/(width+2))
+        node_left,node_right,node_level=node.tree_left,node.tree_right,node.tree_level
+        if pos in (TREE_NODE_POSITION.FirstChild,TREE_NODE_POSITION.PreviousSibling):
+            offset=hi-min(step,(hi-lo-width)/2)-node_right
+        else:
+            offset=lo+min(step,(hi-lo-width)/2)-node_left
+        self._session.query(cls)\
+            .filter(and_(cls.tree_left>=node_left,cls.tree_left<=node_right,cls.__dict__[cls.__tree_key__]==node_tree_id))\
+            .update({
+                cls.tree_left:cls.tree_left+offset,
+                cls.tree_right:cls.tree_right+offset,
+                cls.tree_level:cls.tree_level+(level-node_level),
+                cls.__tree_key__:ref_tree_id
+            })
+        self._invalidate_tree(node_tree_id,ref_tree_id)
+
+    def _move_node_renumbered(self,node,ref_node,pos):
+        """
+        间隔编号时移动节点:在目标位置按间隔为子树的所有节点重新分配左右值，通过bulk_update_mappings写回
+        """
+        cls=self._model_class
+        pk_name=self.get_primary_field().name
+        tree_key=cls.__dict__[cls.__tree_key__]
+        node_tree_id=self.get_node_tree_id(node)
+        count=self._session.query(func.count(cls.tree_left))\
+            .filter(and_(tree_key==node_tree_id,cls.tree_left>=node.tree_left,cls.tree_left<=node.tree_right)).scalar()
+        values,level,ref_tree_id=self._alloc_values(ref_node,pos,count)
+        #分配左右值时可能后移node本身，因此在分配后再读取node的左右值
+        node_left,node_right,level_offset=node.tree_left,node.tree_right,level-node.tree_level
+        rows=self._session.query(cls.__dict__[pk_name],cls.tree_left,cls.tree_right,cls.tree_level)\
+            .filter(and_(tree_key==node_tree_id,cls.tree_left>=node_left,cls.tree_left<=node_right)).all()
+        new_values=dict(zip(sorted([row[1] for row in rows]+[row[2] for row in rows]),values))
+        self._session.bulk_update_mappings(cls,[{
+            pk_name:pk,
+            "tree_left":new_values[left],
+            "tree_right":new_values[right],
+            "tree_level":node_level+level_offset,
+            cls.__tree_key__:ref_tree_id
+        } for pk,left,right,node_level in rows])
+        def sync(left,right,node_level,tree_id):
+            if tree_id==node_tree_id and node_left<=left<=node_right:
+                return new_values[left],new_values[right],node_level+level_offset,ref_tree_id
+            return left,right,node_level,tree_id
+        self._sync_session_nodes([node_tree_id],sync)
+        self._invalidate_tree(node_tree_id,ref_tree_id)
+
+    def _get_top_nodes(self,nodes):
+        """
+        去掉重复的节点以及被其他选中节点包含的节点，保持原来的顺序
+        """
+        tops=set()
+        last={}#{tree_id:上一个保留节点的右值}
+        for node in sorted(nodes,key=lambda node:(self.get_node_tree_id(node),node.tree_left)):
+            tree_id=self.get_node_tree_id(node)
+            if tree_id not in last or node.tree_left>last[tree_id]:
+                tops.add((tree_id,node.tree_left))
+                last[tree_id]=node.tree_right
+        result=[]
+        for node in nodes:
+            key=(self.get_node_tree_id(node),node.tree_left)
+            if key in tops:
+                tops.remove(key)
+                result.append(node)
+        return result
+
+    def _get_shifts(self,intervals,value=None,width=0):
+        """
+        计算移走(删除)若干区间后，其余节点左右值的分段平移量
+        :param intervals: 移走的(tree_left,tree_right)列表
+        :param value: 插入位置的原左值，插入位置之后的值增加width
+        :return: [(起始值,平移量),...],按起始值从大到小排列，值>=起始值时平移对应的量
+        """
+        points=set(right+1 for left,right in intervals)
+        if value is not None:
+            points.add(value)
+        shifts=[]
+        for point in sorted(points,reverse=True):
+            offset=-sum(right-left+1 for left,right in intervals if right<point)
+            if value is not None and point>=value:
+                offset+=width
+            shifts.append((point,offset))
+        return shifts
+
+    def _get_shift_case(self,column,blocks,shifts):
+        """
+        构造分段平移的CASE表达式
+        :param blocks: [(tree_left,tree_right,平移量,层级变化),...],原值在该范围内的整体平移
+        :param shifts: _get_shifts返回的分段平移量
+        """
+        whens=[(column.between(left,right),column+offset) for left,right,offset,level_offset in blocks]
+        whens.extend((column>=point,column+offset) for point,offset in shifts)
+        return case(whens,else_=column)
+
+    def _shift_value(self,value,blocks,shifts):
+        """ 在内存中计算_get_shift_case的结果 """
+        for left,right,offset,level_offset in blocks:
+            if left<=value<=right:
+                return value+offset
+        for point,offset in shifts:
+            if value>=point:
+                return value+offset
+        return value
+
+    @_profiled
+    def move_nodes(self,nodes,ref_node,pos=TREE_NODE_POSITION.LastChild):
+        """
+        批量移动多个节点到ref_node的相对位置，连同各节点下属的子孙节点，移动后按nodes中的顺序排列
+        已经被其他选中节点包含的节点会被忽略。所有节点的新左右值一次计算完成，
+        目标树及每棵源树各只需要执行一次UPDATE
+        """
+        self._lock_nodes(list(nodes)+[ref_node])
+        nodes=self._get_top_nodes(nodes)
+        if len(nodes)==0:
+            return
+        ref_tree_id=self.get_node_tree_id(ref_node)
+        for node in nodes:
+            if self.get_node_tree_id(node)==ref_tree_id and node.tree_left<=ref_node.tree_left and ref_node.tree_right<=node.tree_right:
+                raise TreeNodeInvalidOperation
+
+        if self._get_spacing()>1:
+            #间隔编号时每次移动只更新子树本身,依次移动即可,插入到前面的位置时需要倒序移动
+            if pos in (TREE_NODE_POSITION.FirstChild,TREE_NODE_POSITION.NextSibling):
+                nodes=reversed(nodes)
+            for node in nodes:
+                self.move_node(node,ref_node,pos)
+            return
+
+        parent_field=self._get_parent_field()
+        if parent_field is not None:
+            parent_pk=self._get_position_parent_pk(ref_node,pos)
+            for node in nodes:
+                setattr(node,parent_field,parent_pk)
+        if self._get_path_field() is not None:
+            parent_path=self._get_position_parent_path(ref_node,pos)
+            for node in nodes:
+                self._move_paths(node,parent_path)
+
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        value,level=self._get_insert_position(ref_node,pos)
+        width=sum(node.tree_right-node.tree_left+1 for node in nodes)
+        intervals={}#{tree_id:[移走的区间,...]}
+        for node in nodes:
+            intervals.setdefault(self.get_node_tree_id(node),[]).append((node.tree_left,node.tree_right))
+        intervals.setdefault(ref_tree_id,[])
+        #移走所有节点后插入位置的左值，各子树从该值开始依次排列
+        base=value-sum(right-left+1 for left,right in intervals[ref_tree_id] if right<value)
+        tree_blocks={}#{tree_id:[(tree_left,tree_right,平移量,层级变化),...]}
+        for node in nodes:
+            tree_blocks.setdefault(self.get_node_tree_id(node),[]).append((node.tree_left,node.tree_right,base-node.tree_left,level-node.tree_level))
+            base+=node.tree_right-node.tree_left+1
+
+        tree_shifts={}
+        #先更新目标树，再更新各源树
+        for tree_id in [ref_tree_id]+[tree_id for tree_id in intervals if tree_id!=ref_tree_id]:
+            blocks=tree_blocks.get(tree_id,[])
+            if tree_id==ref_tree_id:
+                shifts=self._get_shifts(intervals[tree_id],value,width)
+            else:
+                shifts=self._get_shifts(intervals[tree_id])
+            tree_shifts[tree_id]=shifts
+            values={
+                cls.tree_left:self._get_shift_case(cls.tree_left,blocks,shifts),
+                cls.tree_right:self._get_shift_case(cls.tree_right,blocks,shifts)
+            }
+            if blocks:
+                values[cls.tree_level]=case([(cls.tree_left.between(left,right),cls.tree_level+level_offset)
+                                             for left,right,offset,level_offset in blocks],else_=cls.tree_level)
+            if tree_id!=ref_tree_id:
+                values[tree_key]=case([(cls.tree_left.between(left,right),ref_tree_id) for left,right,offset,level_offset in blocks],else_=tree_key)
+            low=min([left for left,right,offset,level_offset in blocks]+[point for point,offset in shifts])
+            self._session.query(cls)\
+                .filter(and_(tree_key==tree_id,cls.tree_right>=low))\
+                .update(values,synchronize_session=False)
+
+        def sync(left,right,level,tree_id):
+            blocks,shifts=tree_blocks.get(tree_id,[]),tree_shifts[tree_id]
+            for block_left,block_right,offset,level_offset in blocks:
+                if block_left<=left<=block_right:
+                    return left+offset,right+offset,level+level_offset,ref_tree_id
+            return self._shift_value(left,blocks,shifts),self._shift_value(right,blocks,shifts),level,tree_id
+        self._sync_session_nodes(tree_shifts,sync)
+        self._invalidate_tree(*tree_shifts.keys())
+
+    @_profiled
+    def move_node_up(self,node,allow_upgrade=True):
+        """
+        将节点上移一步
+        :param allow_upgrade: 当移动到最上面时，是否继续上移为父节点的下一个兄弟节点
+        :return:
+        """
+        #取得上一个兄弟节点
+        try:
+            ref_node=self.get_previous_sibling(node)
+            self.move_node(node,ref_node,pos=TREE_NODE_POSITION.PreviousSibling)
+        except TreeNodeNotFound:#不存在前一个节点，则需要升级并移动父点的下一个节点
+            if allow_upgrade:
+                ref_node=self.get_parent(node)
+                self.move_node(node,ref_node,pos=TREE_NODE_POSITION.NextSibling)
+            else:
+                raise TreeNodeInvalidOperation
+
+    @_profiled
+    def move_node_down(self,node,allow_downgrade=True):
+        """
+        :param allow_downgrade: 当移动到最下面时，是否继续上移为父节点的下一个兄弟节点
+        :return:
+        """
+        #取得上一个兄弟节点
+        try:
+            ref_node=self.get_previous_sibling(node)
+            self.move_node(node,ref_node,pos=TREE_NODE_POSITION.NextSibling)
+        except TreeNodeNotFound:#不存在下一个节点，则需要升级并移动父点的下一个节点
             if allow_downgrade:
                 ref_node=self.get_parent(node)
                 self.move_node(node,ref_node,pos=TREE_NODE_POSITION.NextSibling)
             else:
                 raise TreeNodeInvalidOperation
+    @_profiled
     def move_node_right(self,node):
         """
         将当前节点调整为上一个节点的子节点
@@ -434,6 +1681,7 @@ class TreeManager(object):
         except TreeNodeNotFound:#不存在下一个节点，则需要升级并移动父点的下一个节点
             raise TreeNodeInvalidOperation
 
+    @_profiled
     def move_node_left(self,node):
         try:
             #取得上一个兄弟节点
@@ -442,113 +1690,344 @@ class TreeManager(object):
         except TreeNodeNotFound:#不存在下一个节点，则需要升级并移动父点的下一个节点
             raise TreeNodeInvalidOperation
 
+    @_profiled
     def get_trees(self):
         """ 取得存储的树清单
          """
         root_nodes=self.get_nodes(level=1)
         return root_nodes
 
-    def verify_tree(self,tree_id=0):
+    @_profiled
+    def verify_tree(self,tree_id=0,batch_size=1000):
         """
             通过检查树的左右值来校验树结构的完整性
         当树结构被破坏时，表现在tree_left，tree_right、tree_level值不正确
         如果tree_level不正确，而tree_left,tree_right正确，则tree_level是可以修复的。
         而如果tree_left,tree_right不正确，则整棵树结构就被破坏了。
-        :param tree_id:树标识，如果没有指定则校验所有树
-        :return:树结构有效返回True
-        """
-        cls=self._model_class
-        rs=self._session.query(cls).filter(cls.__dict__[cls.__tree_key__]==tree_id).order_by(self._get_tree_sort_key(),"tree_left").options(load_only(self.get_primary_field().name,cls.__tree_key__,"tree_left","tree_right","tree_level"))
-        nodes=[(item.tree_left,item.tree_right,item.tree_level) for item in rs]
-        node_values=[]
-
-        def check_node(cur_node,descendant_nodes):
-            if cur_node[1]-cur_node[0]==1:#没有子节点
-                node_values.append(cur_node[0])
-                node_values.append(cur_node[1])
-            elif cur_node[1]-cur_node[0] > 1:#有子节点
-                #计算出子节点
-                node_values.append(cur_node[0])
-                child_nodes=filter(lambda node: node[0]>cur_node[0] and node[1]< cur_node[1] and node[2]==cur_node[2]+1,descendant_nodes)
-                for node in child_nodes:
-                    check_node(node,filter(lambda item: item[0]>node[0] and item[1]<node[1],descendant_nodes))
-                node_values.append(cur_node[1])
-
-        check_node(nodes[0],filter(lambda node: node[0]>1 and node[1]< 2*len(nodes) ,nodes))
-
-        #如果上述检查合法，则应该得到一个[1,2,3,4,.........n]的序列
-        #这个序列总数应等一下总记录数的两倍，并且是一个序列
-        if len(node_values)!=len(nodes)*2:
-            return False
-        for v in range(1,len(node_values)):
-            if v!=node_values[v-1]:
-                return False
-        return True
-
+        按tree_left顺序流式读取节点(yield_per)，用一个栈保存未结束的祖先节点，只需遍历一次，
+        因此可以用来校验很大、很深的树。
+        :param tree_id:树标识，如果=None则校验所有树
+        :param batch_size:每次从数据库读取的记录数
+        :return:TreeVerifyReport实例,树结构有效时为真
+        """
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        rs=self._session.query(cls.__dict__[self.get_primary_field().name],tree_key,cls.tree_left,cls.tree_right,cls.tree_level)
+        if tree_id is not None:
+            rs=rs.filter(tree_key==tree_id)
+        rs=rs.order_by(tree_key,cls.tree_left).yield_per(batch_size)
+
+        report=TreeVerifyReport()
+        state={"tree_id":None,"cursor":0}#当前校验的树,以及已经检查到的最大左右值
+        stack=[]#未结束的祖先节点右值
+
+        check_gap=self._get_spacing()==1
+        def check_value(value):
+            #连续编号时左右值应该是连续的，跳过的值就是空隙
+            if check_gap and value>state["cursor"]+1:
+                report["gaps"].append((state["tree_id"],state["cursor"]+1,value-1))
+            state["cursor"]=max(state["cursor"],value)
+
+        for pk,cur_tree_id,left,right,level in rs:
+            if cur_tree_id!=state["tree_id"] or report["count"]==0:#开始校验一棵新树
+                while stack:
+                    check_value(stack.pop())
+                state["tree_id"]=cur_tree_id
+                state["cursor"]=0
+                is_first=True
+            else:
+                is_first=False
+            #结束所有右值小于当前左值的节点，剩下的栈顶就是父节点
+            while stack and stack[-1]<left:
+                check_value(stack.pop())
+            if left<=state["cursor"]:#左值与已有的左右值重复
+                report["overlaps"].append((cur_tree_id,pk))
+            check_value(left)
+            if right<=left or (stack and right>=stack[-1]):#右值无效或者超出了父节点的范围
+                report["overlaps"].append((cur_tree_id,pk))
+            if not stack and not is_first:#不在根节点范围内
+                report["orphans"].append((cur_tree_id,pk))
+            if level!=len(stack)+1:
+                report["levels"].append((cur_tree_id,pk,level,len(stack)+1))
+            stack.append(right)
+            report["count"]+=1
+        while stack:
+            check_value(stack.pop())
+        return report
+
+    @_profiled
+    def repair_tree(self,tree_id=0,parent_field=None,batch_size=1000):
+        """
+            修复树结构，重新计算并写入tree_left,tree_right,tree_level值
+        修复的依据:
+            parent_field=None  : 按当前tree_left的顺序，结合tree_right的包含关系确定父节点，
+                                 可以修复左右值的空隙、重叠及错误的tree_level
+            parent_field="xxx" : 以该字段保存的父节点pk值来确定父节点，兄弟节点按当前tree_left排序，
+                                 父节点形成环时环中tree_left最小的节点成为根节点的子节点
+        排在最前面的节点作为根节点，不在根节点范围内的节点修复后成为根节点的最后子节点。
+        所有新值在内存中一次计算完成，只有发生变化的节点才写回，写回时按batch_size分批执行bulk_update_mappings
+        定义了TreeMixin.__tree_parent_field__、__tree_path_field__字段时同时修复这些字段的值
+        :param tree_id: 树标识
+        :param parent_field: 保存父节点pk值的字段名称
+        :param batch_size: 每批写回的记录数
+        :return: 修复的节点数量
+        """
+        session=self._session
+        cls=self._model_class
+        pk_name=self.get_primary_field().name
+        tree_key=cls.__dict__[cls.__tree_key__]
+        self._lock_nodes([],[tree_id])
+
+        #会话中已有的节点需要同步更新,以免再次提交时覆盖修复后的值
+        session_nodes={}
+        for node in session.identity_map.values():
+            if isinstance(node,cls) and self.get_node_tree_id(node)==tree_id:
+                session_nodes[self.get_node_primary(node)]=node
+
+        #需要同时修复的父节点字段及路径字段,原值保存在old_values的最后
+        fix_field=self._get_parent_field()
+        path_field=self._get_path_field()
+        fix_columns=[cls.__dict__[name] for name in (fix_field,path_field) if name is not None]
+
+        state={"count":0}
+        mappings=[]
+        def write_node(pk,old_values,left,right,level,parent_pk,path):
+            new_values=(("tree_left",left),("tree_right",right),("tree_level",level))
+            if fix_field is not None:
+                new_values+=((fix_field,parent_pk),)
+            if path_field is not None:
+                new_values+=((path_field,path),)
+            if old_values==tuple(value for name,value in new_values):
+                return
+            mapping=dict(new_values)
+            mapping[pk_name]=pk
+            mappings.append(mapping)
+            if pk in session_nodes:
+                for name,value in new_values:
+                    set_committed_value(session_nodes[pk],name,value)
+            if len(mappings)>=batch_size:
+                session.bulk_update_mappings(cls,mappings)
+                state["count"]+=len(mappings)
+                del mappings[:]
+
+        spacing=self._get_spacing()
+        value=1-spacing#当前分配到的左右值,第一个值(根节点左值)为1
+        if parent_field is None:
+            #tree_left相同时，范围大的节点排在前面作为父节点
+            rows=session.query(cls.__dict__[pk_name],cls.tree_left,cls.tree_right,cls.tree_level,*fix_columns)\
+                .filter(tree_key==tree_id)\
+                .order_by(cls.tree_left,cls.tree_right.desc()).all()
+            stack=[]#(pk,原右值,原值,新左值,新层级,新父节点pk,新路径)
+            for row in rows:
+                pk,left,right=row[:3]
+                #根节点保留在栈底，直到最后才结束，因此游离的节点会成为根节点的子节点
+                while len(stack)>1 and stack[-1][1]<left:
+                    node_pk,_,old_values,new_left,new_level,new_parent,new_path=stack.pop()
+                    value+=spacing
+                    write_node(node_pk,old_values,new_left,value,new_level,new_parent,new_path)
+                value+=spacing
+                path=u"%s%s/" % (stack[-1][6] if stack else u"/",pk)
+                stack.append((pk,right,tuple(row[1:]),value,len(stack)+1,stack[-1][0] if stack else None,path))
+            while stack:
+                node_pk,_,old_values,new_left,new_level,new_parent,new_path=stack.pop()
+                value+=spacing
+                write_node(node_pk,old_values,new_left,value,new_level,new_parent,new_path)
+        else:
+            rows=session.query(cls.__dict__[pk_name],cls.__dict__[parent_field],cls.tree_left,cls.tree_right,cls.tree_level,*fix_columns)\
+                .filter(tree_key==tree_id)\
+                .order_by(cls.tree_left).all()
+            old_values={}
+            children={}#{父节点pk:[子节点pk,...]}
+            root_pk=None
+            for row in rows:
+                old_values[row[0]]=tuple(row[2:])
+            for row in rows:
+                pk,parent_pk=row[:2]
+                if parent_pk is None or parent_pk not in old_values or parent_pk==pk:
+                    if root_pk is None:
+                        root_pk=pk
+                        continue
+                    parent_pk=root_pk#游离节点修复为根节点的子节点
+                children.setdefault(parent_pk,[]).append(pk)
+            if root_pk is not None:
+                #父节点形成环的节点从根节点无法到达，按tree_left顺序将环中第一个节点修复为根节点的子节点，以断开该环
+                parents=dict((row[0],row[1]) for row in rows)
+                positions=dict((row[0],i) for i,row in enumerate(rows))
+                reached=set()
+                pending=[root_pk]
+                for row in [(root_pk,None)]+rows:
+                    pk=row[0]
+                    if pk in reached:
+                        continue
+                    if pk!=root_pk:
+                        #沿父节点向上找到环，无法到达的节点也可能只是挂在环上
+                        path=[]
+                        while pk not in path:
+                            path.append(pk)
+                            pk=parents[pk]
+                        pk=min(path[path.index(pk):],key=positions.get)
+                        children[parents[pk]].remove(pk)
+                        children.setdefault(root_pk,[]).append(pk)
+                        pending.append(pk)
+                    while pending:
+                        node_pk=pending.pop()
+                        reached.add(node_pk)
+                        pending.extend(children.get(node_pk,[]))
+                value=1
+                stack=[(root_pk,1,1,iter(children.get(root_pk,[])),u"/%s/" % root_pk)]#(pk,新左值,新层级,子节点迭代器,新路径)
+                while stack:
+                    pk,new_left,new_level,child_iter,path=stack[-1]
+                    child_pk=next(child_iter,None)
+                    if child_pk is None:
+                        stack.pop()
+                        value+=spacing
+                        write_node(pk,old_values[pk],new_left,value,new_level,stack[-1][0] if stack else None,path)
+                    else:
+                        value+=spacing
+                        stack.append((child_pk,value,new_level+1,iter(children.get(child_pk,[])),u"%s%s/" % (path,child_pk)))
+        if mappings:
+            session.bulk_update_mappings(cls,mappings)
+            state["count"]+=len(mappings)
+        self._invalidate_tree(tree_id)
+        return state["count"]
+
+    @_profiled
     def get_node_relation(self,node,ref_node):
         """
             取得节点的相对关系
             node:当前节点
             ref_node：相对节点
-            Return:0-两个节点相等，1-子节点，2-后代节点，3-父节点，4-祖先节点,5-兄弟节点
+            Return:见TREE_NODE_RELATION，Self-两个节点相等，Child-子节点，Descendants-后代节点，Parent-父节点，Ancestors-祖先节点,Siblings-兄弟节点
             例：
                 n=tm.get_node_relation(node1,node2)
-                n=1：说明node1是node2的子节点
+                n=TREE_NODE_RELATION.Child：说明node1是node2的子节点
         """
-        tree_id=self.get_node_tree_id(node)
-        ref_tree_id=self.get_node_tree_id(ref_node)
+        return self.get_node_relations(node,[ref_node])[0]
 
-        if tree_id==ref_tree_id:#同一棵树的比较
-            if node is ref_node:#两个节点相等
+    @_profiled
+    def get_node_relations(self,node,ref_nodes):
+        """
+            一次取得节点与多个相对节点的关系，返回与ref_nodes顺序相同的列表，每个值同get_node_relation
+            只根据左右值及层级判断，不需要查询数据库。只有存在同一层级的相对节点需要区分Siblings与Same_level时，
+            才取得一次node的父节点，定义了父节点字段时直接比较父节点pk值。适用于过滤大量的权限节点
+            例：
+                relations=tm.get_node_relations(node,granted_nodes)
+                #node是否在某个授权节点的子树中
+                allowed=any(r in (TREE_NODE_RELATION.Self,TREE_NODE_RELATION.Child,TREE_NODE_RELATION.Descendants) for r in relations)
+        """
+        tree_id=self.get_node_tree_id(node)
+        parent_field=self._get_parent_field()
+        parent_node=None#node的父节点，需要时才取得
+        results=[]
+        for ref_node in ref_nodes:
+            if self.get_node_tree_id(ref_node)!=tree_id:#不同树的比较
+                if self.is_root(node) and self.is_root(ref_node):#均是根节点，两个根节点是兄弟关系
+                    result=TREE_NODE_RELATION.Siblings
+                else:
+                    result=TREE_NODE_RELATION.Diff_tree
+            elif ref_node.tree_left==node.tree_left:#两个节点相等
                 result=TREE_NODE_RELATION.Self
-            elif node.tree_left>ref_node.tree_left and node.tree_right<ref_node.tree_right and node.tree_level+1==ref_node.tree_level:
-                result= TREE_NODE_RELATION.Child
-            elif node.tree_left>ref_node.tree_left and node.tree_right<ref_node.tree_right:
-                result=TREE_NODE_RELATION.Descendants #后代
-            elif node.tree_left<ref_node.tree_left and node.tree_right>ref_node.tree_right and node.tree_level==ref_node.tree_level+1:
-                result=TREE_NODE_RELATION.Parent
-            elif node.tree_left<ref_node.tree_left and node.tree_right>ref_node.tree_right:
-                result= TREE_NODE_RELATION.Ancestors                 #祖先
-            elif node.tree_level==ref_node.tree_level:          #
-                #兄弟姐妹节点应具有同一父节点
-                #先取得父节点
-                parent_node=None
-                try:
-                    parent_node=self.get_parent(node)
-                except:
-                    pass
+            elif ref_node.tree_left<node.tree_left and node.tree_right<ref_node.tree_right:#node在ref_node的子树中
+                result=TREE_NODE_RELATION.Child if node.tree_level==ref_node.tree_level+1 else TREE_NODE_RELATION.Descendants
+            elif node.tree_left<ref_node.tree_left and ref_node.tree_right<node.tree_right:#ref_node在node的子树中
+                result=TREE_NODE_RELATION.Parent if ref_node.tree_level==node.tree_level+1 else TREE_NODE_RELATION.Ancestors
+            elif node.tree_level!=ref_node.tree_level:
+                result=TREE_NODE_RELATION.Same_tree
+            elif parent_field is not None:#兄弟节点具有同一父节点
+                result=TREE_NODE_RELATION.Siblings if getattr(node,parent_field)==getattr(ref_node,parent_field) else TREE_NODE_RELATION.Same_level
+            else:
+                if parent_node is None:
+                    try:
+                        parent_node=self.get_parent(node)
+                    except TreeNodeNotFound:
+                        pass
                 #如果没有父节点,说明已经是根节点或者出错了
                 if parent_node is None:
-                    result= TREE_NODE_RELATION.Unknow
-                else:
-                    #两个节点均同时大于父节点的Left，小于Right
-                    if node.tree_left>parent_node.tree_left and node.tree_right<parent_node.tree_right and ref_node.tree_left>parent_node.tree_left and ref_node.tree_right<parent_node.tree_right:
-                        result=TREE_NODE_RELATION.Siblings
-                    else:#如果不满足，则说明不是兄弟节点，但是同一辈分
-                        result=TREE_NODE_RELATION.Same_level
-            else:
-                result=TREE_NODE_RELATION.Same_tree
-        else:       #不同树的比较
-            if node.tree_left==ref_node.tree_left==1:  #均是根节点，两个根节点是兄弟关系
-                result=TREE_NODE_RELATION.Siblings
-            else:                                       #不同树之间
-                result=TREE_NODE_RELATION.Diff_tree        #不同树
+                    result=TREE_NODE_RELATION.Unknow
+                elif parent_node.tree_left<ref_node.tree_left and ref_node.tree_right<parent_node.tree_right:
+                    result=TREE_NODE_RELATION.Siblings
+                else:#同一辈分，但不是兄弟节点
+                    result=TREE_NODE_RELATION.Same_level
+            results.append(result)
+        return results
+
+    def _use_cte(self,node,ancestors):
+        """
+        判断本次查询是否使用递归CTE，TREE_QUERY_MODE.Auto时按左右值估计：
+            祖先节点：区间查询要扫描左值小于该节点的所有记录(约tree_left/2/间隔条)，CTE只需要按主键查找tree_level次，
+                      估计的记录数超过cte_threshold时使用CTE
+            限定层数的后代节点：区间查询可能扫描整个子树，或者整个树中对应层级的所有节点(使用level索引时)，
+                      CTE只读取需要的几级，节点可能有后代时使用CTE。叶子节点的左右值之差不会超过间隔，
+                      因此只有差值大于间隔的节点才使用CTE，连续编号时就是tree_right-tree_left>1；
+                      差值不超过间隔的节点即使有后代，区间内也最多只有几个节点，区间查询同样很快
+        :param ancestors: True-查询祖先节点，False-查询限定层数的后代节点
+        """
+        if self.query_mode==TREE_QUERY_MODE.Nested or self._get_parent_field() is None:
+            return False
+        if self.query_mode==TREE_QUERY_MODE.Cte:
+            return True
+        if ancestors:
+            return node.tree_left/(2*self._get_spacing())>self.cte_threshold
+        return node.tree_right-node.tree_left>self._get_spacing()
 
-        return result
+    def _query_ancestors_cte(self,node):
+        """
+        从节点本身开始沿父节点字段向上递归，返回按tree_left排序的查询，最后一条记录是节点本身
+        结果总是包含节点本身，因为Python 2的sqlite3在WITH语句没有返回记录时不设置cursor.description
+        """
+        cls=self._model_class
+        table=cls.__table__
+        pk=table.c[self.get_primary_field().name]
+        parent=table.c[self._get_parent_field()]
+        ancestors=select([pk.label("node_id"),parent.label("parent_id")])\
+            .where(pk==self.get_node_primary(node))\
+            .cte("tree_ancestors",recursive=True)
+        ancestors=ancestors.union_all(select([pk,parent]).where(pk==ancestors.c.parent_id))
+        return self._session.query(cls)\
+            .join(ancestors,cls.__dict__[pk.name]==ancestors.c.node_id)\
+            .order_by(cls.tree_left)
 
+    def _query_descendants_cte(self,node,level):
+        """ 从节点本身开始沿父节点字段向下递归level级，返回按tree_left排序的查询，第一条记录是节点本身 """
+        cls=self._model_class
+        table=cls.__table__
+        pk=table.c[self.get_primary_field().name]
+        parent=table.c[self._get_parent_field()]
+        descendants=select([pk.label("node_id"),literal_column("0",Integer).label("depth")])\
+            .where(pk==self.get_node_primary(node))\
+            .cte("tree_descendants",recursive=True)
+        descendants=descendants.union_all(
+            select([pk,descendants.c.depth+1]).where(and_(parent==descendants.c.node_id,descendants.c.depth<level))
+        )
+        return self._session.query(cls)\
+            .join(descendants,cls.__dict__[pk.name]==descendants.c.node_id)\
+            .order_by(cls.tree_left)
 
+    @_profiled
     def get_ancestors(self,node):
         """
             取得所有祖先节点,包括父节点
         """
+        snapshot,i=self._get_snapshot_index(node)
+        if snapshot is not None:
+            return self._get_nodes_by_pk([snapshot.pks[j] for j in snapshot.get_ancestors(i)])
+        path_field=self._get_path_field()
+        if path_field is not None:#解析路径得到祖先节点的pk值，按pk查询
+            return self._get_nodes_by_pk(self._parse_path(getattr(node,path_field))[:-1])
         cls=self._model_class
-        return self._session.query(cls)\
-            .filter(and_(
-                cls.tree_left<node.tree_left,
-                cls.tree_right>node.tree_right,
-                cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)
-            )).order_by("tree_left").all()
+        if self._use_cte(node,True):
+            rs=self._query_ancestors_cte(node)
+            load=lambda:rs.all()[:-1]
+        else:
+            load=self._session.query(cls)\
+                .filter(and_(
+                    cls.tree_left<node.tree_left,
+                    cls.tree_right>node.tree_right,
+                    cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)
+                )).order_by("tree_left").all
+        return self._cached_nodes(self.get_node_tree_id(node),("ancestors",self.get_node_primary(node)),load)
 
+    @_profiled
     def get_parent(self,node):
         """
             取得节点的父节点
@@ -556,6 +2035,14 @@ class TreeManager(object):
         cls=self._model_class
         if node.tree_level==1 and node.tree_left==1: #根节点没有父
             raise TreeNodeNotFound
+        snapshot,i=self._get_snapshot_index(node)
+        if snapshot is not None:
+            j=snapshot.parents[i]
+            return self._get_nodes_by_pk([snapshot.pks[j]])[0] if j>=0 else None
+        parent_field=self._get_parent_field()
+        if parent_field is not None:#直接通过父节点pk值取得
+            parent_pk=getattr(node,parent_field)
+            return self._session.query(cls).get(parent_pk) if parent_pk is not None else None
         else:
             return self._session.query(self._model_class)\
                 .filter(and_(
@@ -564,45 +2051,100 @@ class TreeManager(object):
                     cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)
                 )).order_by("-tree_left").first()
 
+    @_profiled
     def get_ancestors_count(self,node):
         """
         取得祖先节点数量,不包括自己
         :param node:
         :return:
         """
+        snapshot,i=self._get_snapshot_index(node)
+        if snapshot is not None:
+            return len(snapshot.get_ancestors(i))
         cls=self._model_class
-        return self._session.query(func.count(self._model_class))\
+        return self._session.query(func.count(cls.tree_left))\
                 .filter(and_(
                     cls.tree_left<node.tree_left,
                     cls.tree_right>node.tree_right,
                     cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)
         )).scalar()
 
+    @_profiled
     def get_descendants(self,node,level=0):
         """
         所有后代节点
         :param level:仅返回几级后代,如果=1相当于只返回子节点
         :return:
         """
+        snapshot,i=self._get_snapshot_index(node)
+        if snapshot is not None:
+            if level==1:
+                indexes=snapshot.get_children(i)
+            else:
+                indexes=snapshot.get_descendants(i,level)
+            return self._get_nodes_by_pk([snapshot.pks[j] for j in indexes])
         cls=self._model_class
         tree_id=self.get_node_tree_id(node)
-        if level==0:
-            return self._session.query(cls)\
-                .filter(and_(
-                    cls.tree_left>node.tree_left,
-                    cls.tree_right<node.tree_right,
-                    cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)
-                )).order_by("tree_left").all()
+        parent_field=self._get_parent_field()
+        path_field=self._get_path_field()
+        if level==1 and parent_field is not None:#子节点直接通过父节点pk值查询
+            rs=self._session.query(cls)\
+                .filter(cls.__dict__[parent_field]==self.get_node_primary(node))\
+                .order_by(cls.tree_left)
+        elif level>0 and self._use_cte(node,False):#限定层数时只递归查询需要的几级
+            rs=self._query_descendants_cte(node,level)
+            return self._cached_nodes(tree_id,("descendants",self.get_node_primary(node),level),lambda:rs.all()[1:])
+        elif path_field is not None:#按路径前缀查询
+            path=getattr(node,path_field)
+            conditions=[cls.__dict__[path_field].like(self._escape_like(path)+"%",escape="\\"),cls.__dict__[path_field]!=path]
+            if level>0:
+                conditions.append(cls.tree_level<=node.tree_level+level)
+            rs=self._session.query(cls).filter(and_(*conditions)).order_by(cls.tree_left)
         else:
-            return self._session.query(cls)\
-                .filter(and_(
-                    cls.tree_left>node.tree_left,
-                    cls.tree_right<node.tree_right,
-                    cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node),
-                    cls.tree_level>node.tree_level,
-                    cls.tree_level<=node.tree_level+level,
-                )).order_by("tree_left").all()
+            rs=self._query_descendants(node,level)
+        return self._cached_nodes(tree_id,("descendants",self.get_node_primary(node),level),rs.all)
 
+    def _query_descendants(self,node,level=0,after_left=None):
+        """ 返回按左右值区间查询后代节点的查询，按tree_left排序，after_left不是None时只返回左值大于该值的节点 """
+        cls=self._model_class
+        conditions=[
+            cls.tree_left>(node.tree_left if after_left is None else max(node.tree_left,after_left)),
+            cls.tree_right<node.tree_right,
+            cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)
+        ]
+        if level>0:
+            conditions.append(cls.tree_level<=node.tree_level+level)
+        return self._session.query(cls).filter(and_(*conditions)).order_by(cls.tree_left)
+
+    def iter_descendants(self,node,level=0,batch_size=1000):
+        """
+        逐个返回后代节点的生成器，参数同get_descendants
+        按tree_left顺序通过yield_per每次从数据库读取batch_size条记录，不需要一次将整个子树载入会话，适用于批量处理很大的子树。
+        遍历过程中不要修改该树的结构。
+        """
+        for node in self._query_descendants(node,level).yield_per(batch_size):
+            yield node
+
+    @_profiled
+    def get_descendants_page(self,node,after_left=None,limit=100,level=0,offset=0):
+        """
+        按tree_left分页取得后代节点，适用于界面中分页显示很大的子树
+        :param after_left: 只返回左值大于该值的节点，第一页为None，下一页使用上一页最后一个节点的tree_left
+        :param limit: 每页最多返回的节点数
+        :param level: 同get_descendants
+        :param offset: 跳过前offset个节点，按偏移分页时下一页使用offset+len(page)，闭包表模式只支持这种方式
+        :return: 按tree_left排序的节点列表，少于limit个时说明已经是最后一页
+        例：
+            page=tm.get_descendants_page(root,limit=50)
+            next_page=tm.get_descendants_page(root,after_left=page[-1].tree_left,limit=50)
+            next_page=tm.get_descendants_page(root,limit=50,offset=50)
+        """
+        query=self._query_descendants(node,level,after_left)
+        if offset>0:
+            query=query.offset(offset)
+        return query.limit(limit).all()
+
+    @_profiled
     def get_children(self,node):
         """
          取得所有子节点
@@ -610,13 +2152,23 @@ class TreeManager(object):
         """
         return self.get_descendants(node,1)
 
+    @_profiled
     def get_descendants_count(self,node):
         """
         取得后代节点数目
         :param node:
         :return:
         """
-        return (node.tree_right-node.tree_left-1)/2
+        if self._get_spacing()==1:
+            return (node.tree_right-node.tree_left-1)/2
+        #间隔编号时不能通过左右值计算
+        cls=self._model_class
+        return self._session.query(func.count(cls.tree_left))\
+            .filter(and_(
+                cls.tree_left>node.tree_left,
+                cls.tree_right<node.tree_right,
+                cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node)
+            )).scalar()
 
     def is_root(self,node):
         """
@@ -626,6 +2178,7 @@ class TreeManager(object):
         """
         return node.tree_left==1
 
+    @_profiled
     def get_siblings(self,node,include_self=False):
         """
         获取所有兄弟节点
@@ -637,7 +2190,7 @@ class TreeManager(object):
         parent_node=self.get_parent(node)
         result_nodes=[]
         if parent_node is None:#根节点
-            result_nodes=self._session.query(cls).filter(cls.tree_left==1).order_by(self._get_tree_sort_key()).all()
+            result_nodes=self._session.query(cls).filter(self._get_root_condition()).order_by(self._get_tree_sort_key()).all()
             try:
                 if not include_self:#不包括自己
                     result_nodes.remove(node)
@@ -649,62 +2202,239 @@ class TreeManager(object):
                 result_nodes.remove(node)
         return result_nodes
 
+    @_profiled
     def get_next_sibling(self,node):
         """取得下一个兄弟节点"""
         cls=self._model_class
         #根节点的下一个兄弟就是下一个根节点
         try:
+            snapshot,i=self._get_snapshot_index(node)
             if self.is_root(node):
-                root_nodes=self._session.query(cls).filter(cls.tree_left==1).order_by(self._get_tree_sort_key()).all()
+                root_nodes=self._session.query(cls).filter(self._get_root_condition()).order_by(self._get_tree_sort_key()).all()
                 next_node= root_nodes[root_nodes.index(node)+1]
+            elif snapshot is not None:
+                j=snapshot.get_next_sibling(i)
+                next_node=self._get_nodes_by_pk([snapshot.pks[j]])[0] if j>=0 else None
+            elif self._get_parent_field() is not None:
+                parent_field=self._get_parent_field()
+                next_node=self._session.query(cls)\
+                    .filter(and_(
+                        cls.__dict__[parent_field]==getattr(node,parent_field),
+                        cls.tree_left>node.tree_left
+                    )).order_by(cls.tree_left).first()
+            elif self._get_spacing()==1:#连续编号时下一个兄弟节点的左值就是tree_right+1
+                next_node=self._session.query(cls)\
+                    .filter(and_(
+                        cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node),
+                        cls.tree_left==node.tree_right+1
+                    )).first()
             else:
-                #先取得下一节点
-                #下一节点应满足：同一级别，同一棵树,Left要大于node.tree_left,且具有同一个
+                #子树之后第一个层级不大于该节点的节点，层级相同时是下一个兄弟节点，否则是上级节点的兄弟，说明已经是最后一个子节点
                 next_node=self._session.query(cls)\
                     .filter(and_(
                         cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node),
-                        cls.tree_left>node.tree_left,
-                        cls.tree_level==node.tree_level
-                    )).order_by("tree_left").first()
-                #满足上述条件的节点，可能只是同一辈分的节点,因此需要再重新排除
-                if next_node is not None:
-                    parent_node=self.get_parent(next_node)
-                    if not (next_node.tree_left>node.tree_left and next_node.tree_right<parent_node.tree_right):
-                        next_node=None
+                        cls.tree_left>node.tree_right,
+                        cls.tree_level<=node.tree_level
+                    )).order_by(cls.tree_left).first()
+                if next_node is not None and next_node.tree_level!=node.tree_level:
+                    next_node=None
             if next_node is None:
                 raise TreeNodeNotFound
             return next_node
         except:
             raise TreeNodeNotFound
 
+    @_profiled
     def get_previous_sibling(self,node):
         """取得上一个兄弟节点"""
         cls=self._model_class
         #根节点的下一个兄弟就是下一个根节点
         try:
+            snapshot,i=self._get_snapshot_index(node)
             if self.is_root(node):
-                root_nodes=self._session.query(cls).filter(cls.tree_left==1).order_by(self._get_tree_sort_key()).all()
+                root_nodes=self._session.query(cls).filter(self._get_root_condition()).order_by(self._get_tree_sort_key()).all()
                 pre_node= root_nodes[root_nodes.index(node)-1]
+            elif snapshot is not None:
+                j=snapshot.get_previous_sibling(i)
+                pre_node=self._get_nodes_by_pk([snapshot.pks[j]])[0] if j>=0 else None
+            elif self._get_parent_field() is not None:
+                parent_field=self._get_parent_field()
+                pre_node=self._session.query(cls)\
+                    .filter(and_(
+                        cls.__dict__[parent_field]==getattr(node,parent_field),
+                        cls.tree_left<node.tree_left
+                    )).order_by(cls.tree_left.desc()).first()
+            elif self._get_spacing()==1:#连续编号时上一个兄弟节点的右值就是tree_left-1
+                pre_node=self._session.query(cls)\
+                    .filter(and_(
+                        cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node),
+                        cls.tree_right==node.tree_left-1
+                    )).first()
             else:
-                #先取得下一节点
-                #下一节点应满足：同一级别，同一棵树,Left要大于node.tree_left,且具有同一个父节点
+                #该节点之前最后一个层级不大于该节点的节点，层级相同时是上一个兄弟节点，否则是父节点，说明已经是第一个子节点
                 pre_node=self._session.query(cls)\
                     .filter(and_(
                         cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node),
                         cls.tree_left<node.tree_left,
-                        cls.tree_level==node.tree_level
-                    )).order_by("-tree_left").first()
-                #满足上述条件的节点，可能只是同一辈分的节点
-                if pre_node is not None:
-                    parent_node=self.get_parent(pre_node)
-                    if not (pre_node.tree_left<node.tree_left and pre_node.tree_right<parent_node.tree_right):
-                        pre_node=None
+                        cls.tree_level<=node.tree_level
+                    )).order_by(cls.tree_left.desc()).first()
+                if pre_node is not None and pre_node.tree_level!=node.tree_level:
+                    pre_node=None
             if pre_node is None:
                 raise TreeNodeNotFound
             return pre_node
         except:
             raise TreeNodeNotFound
 
+    def _group_by_tree(self,nodes):
+        """ 按树标识对节点分组,返回{tree_id:[node,...]} """
+        trees={}
+        for node in nodes:
+            trees.setdefault(self.get_node_tree_id(node),[]).append(node)
+        return trees
+
+    def _get_many_condition(self,nodes,condition):
+        """
+        构造多个节点的查询条件,按树分组后以OR连接各节点的条件
+        :param condition: condition(node)返回单个节点的条件，不含树标识
+        """
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        return or_(*[and_(tree_key==tree_id,or_(*[condition(node) for node in tree_nodes]))
+                     for tree_id,tree_nodes in self._group_by_tree(nodes).items()])
+
+    def _match_ancestors(self,nodes,rows):
+        """
+        将查询到的祖先记录分配给各节点
+        :param rows: 按树标识、tree_left排序的(tree_id,tree_left,tree_right,数据)
+        :return: {节点pk:[(tree_left,tree_right,数据),...]},按tree_left排序
+        """
+        trees={}
+        for tree_id,left,right,data in rows:
+            trees.setdefault(tree_id,[]).append((left,right,data))
+        result={}
+        for tree_id,tree_nodes in self._group_by_tree(nodes).items():
+            rows=trees.get(tree_id,[])
+            i=0
+            stack=[]#包含当前位置的祖先记录
+            for node in sorted(tree_nodes,key=lambda node:node.tree_left):
+                while i<len(rows) and rows[i][0]<node.tree_left:
+                    while stack and stack[-1][1]<rows[i][0]:
+                        stack.pop()
+                    stack.append(rows[i])
+                    i+=1
+                while stack and stack[-1][1]<node.tree_left:
+                    stack.pop()
+                result[self.get_node_primary(node)]=[row for row in stack if row[1]>node.tree_right]
+        return result
+
+    @_profiled
+    def get_ancestors_many(self,nodes):
+        """
+        一次查询取得多个节点的祖先节点
+        :return: {节点pk:[祖先节点,...]},祖先节点按tree_left排序
+        """
+        if len(nodes)==0:
+            return {}
+        path_field=self._get_path_field()
+        if path_field is not None:#所有节点的路径中的祖先通过一次按pk的查询取得
+            paths=dict((self.get_node_primary(node),self._parse_path(getattr(node,path_field))[:-1]) for node in nodes)
+            ancestors=self._get_nodes_by_pk(list(set(pk for pks in paths.values() for pk in pks)))
+            ancestors=dict((self.get_node_primary(ancestor),ancestor) for ancestor in ancestors if ancestor is not None)
+            return dict((pk,[ancestors[ancestor_pk] for ancestor_pk in pks if ancestor_pk in ancestors]) for pk,pks in paths.items())
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        rs=self._session.query(cls)\
+            .filter(self._get_many_condition(nodes,lambda node:and_(cls.tree_left<node.tree_left,cls.tree_right>node.tree_right)))\
+            .order_by(tree_key,cls.tree_left)
+        rows=[(self.get_node_tree_id(ancestor),ancestor.tree_left,ancestor.tree_right,ancestor) for ancestor in rs]
+        return dict((pk,[row[2] for row in ancestors]) for pk,ancestors in self._match_ancestors(nodes,rows).items())
+
+    @_profiled
+    def get_ancestors_count_many(self,nodes):
+        """
+        一次查询取得多个节点的祖先节点数量
+        :return: {节点pk:祖先节点数量}
+        """
+        if len(nodes)==0:
+            return {}
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        rs=self._session.query(tree_key,cls.tree_left,cls.tree_right,cls.tree_level)\
+            .filter(self._get_many_condition(nodes,lambda node:and_(cls.tree_left<node.tree_left,cls.tree_right>node.tree_right)))\
+            .order_by(tree_key,cls.tree_left)
+        return dict((pk,len(ancestors)) for pk,ancestors in self._match_ancestors(nodes,rs).items())
+
+    @_profiled
+    def get_parent_many(self,nodes):
+        """
+        一次查询取得多个节点的父节点
+        :return: {节点pk:父节点},根节点的父节点为None
+        """
+        if len(nodes)==0:
+            return {}
+        cls=self._model_class
+        parent_field=self._get_parent_field()
+        if parent_field is not None:
+            parents=self._get_nodes_by_pk(list(set(getattr(node,parent_field) for node in nodes if getattr(node,parent_field) is not None)))
+            parents=dict((self.get_node_primary(parent),parent) for parent in parents if parent is not None)
+            return dict((self.get_node_primary(node),parents.get(getattr(node,parent_field))) for node in nodes)
+        tree_key=cls.__dict__[cls.__tree_key__]
+        rs=self._session.query(cls)\
+            .filter(self._get_many_condition(nodes,lambda node:and_(
+                cls.tree_left<node.tree_left,
+                cls.tree_right>node.tree_right,
+                cls.tree_level==node.tree_level-1
+            ))).order_by(tree_key,cls.tree_left)
+        rows=[(self.get_node_tree_id(parent),parent.tree_left,parent.tree_right,parent) for parent in rs]
+        #不同层级节点的父节点可能相互包含,最后一个包含该节点的就是父节点
+        return dict((pk,ancestors[-1][2] if ancestors else None) for pk,ancestors in self._match_ancestors(nodes,rows).items())
+
+    @_profiled
+    def get_descendants_many(self,nodes,level=0):
+        """
+        一次查询取得多个节点的后代节点
+        :param level:仅返回几级后代,如果=1相当于只返回子节点
+        :return: {节点pk:[后代节点,...]},后代节点按tree_left排序
+        """
+        if len(nodes)==0:
+            return {}
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        def condition(node):
+            if level>0:
+                return and_(cls.tree_left>node.tree_left,cls.tree_left<node.tree_right,cls.tree_level<=node.tree_level+level)
+            return and_(cls.tree_left>node.tree_left,cls.tree_left<node.tree_right)
+        trees={}#{tree_id:([tree_left,...],[node,...])}
+        for descendant in self._session.query(cls).filter(self._get_many_condition(nodes,condition)).order_by(tree_key,cls.tree_left):
+            lefts,descendants=trees.setdefault(self.get_node_tree_id(descendant),([],[]))
+            lefts.append(descendant.tree_left)
+            descendants.append(descendant)
+        result={}
+        for node in nodes:
+            lefts,descendants=trees.get(self.get_node_tree_id(node),([],[]))
+            result[self.get_node_primary(node)]=[descendant
+                for descendant in descendants[bisect_right(lefts,node.tree_left):bisect_left(lefts,node.tree_right)]
+                if level==0 or descendant.tree_level<=node.tree_level+level]
+        return result
+
+    @_profiled
+    def get_children_many(self,nodes):
+        """
+        一次查询取得多个节点的子节点
+        :return: {节点pk:[子节点,...]}
+        """
+        parent_field=self._get_parent_field()
+        if parent_field is None or len(nodes)==0:
+            return self.get_descendants_many(nodes,1)
+        cls=self._model_class
+        result=dict((self.get_node_primary(node),[]) for node in nodes)
+        for child in self._session.query(cls)\
+                .filter(cls.__dict__[parent_field].in_(result.keys()))\
+                .order_by(cls.tree_left):
+            result[getattr(child,parent_field)].append(child)
+        return result
+
     def _get_output_fields(self,fields):
         """
         返回要输出的字段名称列表
@@ -717,7 +2447,12 @@ class TreeManager(object):
         tree_field_name=self.get_tree_key_field_name()
         output_fields=[pk_field_name,tree_field_name,"tree_level"]
 
-        if len(fields)>=0:
+        #fields或__tree_output_fields__="*"时输出所有字段
+        if fields=="*" or (len(fields)==0 and getattr(cls,"__tree_output_fields__",None)=="*"):
+            output_fields.extend(cls.__table__.columns.keys())
+            return list(set(output_fields))
+
+        if len(fields)>0:
             output_fields.extend(fields)
             return list(set(output_fields))
 
@@ -740,7 +2475,102 @@ class TreeManager(object):
 
         return list(set(output_fields))
 
-    def output(self,nodes=None,level=0,flatted=False,fields=[],format="json",children_name="children",pid_field_name="pId",output_err=False):
+    def _get_output_roots(self,nodes):
+        """
+        将要输出的节点转换为(tree_id,tree_left,tree_right,tree_level,pk)列表
+        """
+        if not isinstance(nodes,list):
+            nodes=[nodes]
+        return [(self.get_node_tree_id(node),node.tree_left,node.tree_right,node.tree_level,self.get_node_primary(node)) for node in nodes]
+
+    def _query_output_rows(self,roots,level,fields,lazy=False):
+        """
+        构造一次取得所有要输出节点的查询，只查询输出字段，返回的是元组而不是ORM实例
+        每行依次是tree_id,tree_left,tree_right,排序字段,以及fields中的字段,按树及tree_left排序
+        :param roots: _get_output_roots返回的列表，如果=None则输出所有树
+        :param lazy: 为True时在最后增加一列是否有子节点，见_get_is_parent_column
+        """
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        columns=[tree_key,cls.tree_left,cls.tree_right,cls.__dict__[self._get_tree_sort_key()]]
+        columns.extend([cls.__dict__[field] for field in fields])
+        if lazy:
+            columns.append(self._get_is_parent_column())
+        rs=self._session.query(*columns)
+        if roots is None:
+            if level>0:
+                rs=rs.filter(cls.tree_level<=level)
+        else:
+            conditions=[]
+            for tree_id,left,right,node_level,pk in roots:
+                condition=and_(tree_key==tree_id,cls.tree_left>=left,cls.tree_left<right)
+                if level>0:
+                    condition=and_(condition,cls.tree_level<=node_level+level)
+                conditions.append(condition)
+            rs=rs.filter(or_(*conditions))
+        return rs.order_by(tree_key,cls.tree_left)
+
+    def _get_is_parent_column(self):
+        """
+        返回节点是否有子节点(1/0)的列，连续编号时直接由tree_right-tree_left>1得到，
+        间隔编号时左右值之间可能只是空隙，通过EXISTS查询左右值之间是否有节点
+        """
+        cls=self._model_class
+        if self._get_spacing()==1:
+            return case([(cls.tree_right-cls.tree_left>1,1)],else_=0)
+        child=aliased(cls)
+        return case([(exists([child.tree_left]).where(and_(
+            getattr(child,cls.__tree_key__)==cls.__dict__[cls.__tree_key__],
+            child.tree_left>cls.tree_left,
+            child.tree_left<cls.tree_right
+        )),1)],else_=0)
+
+    def _get_node_children_condition(self,node):
+        """ 返回node的子节点的查询条件 """
+        cls=self._model_class
+        parent_field=self._get_parent_field()
+        if parent_field is not None:
+            return cls.__dict__[parent_field]==self.get_node_primary(node)
+        return and_(
+            cls.__dict__[cls.__tree_key__]==self.get_node_tree_id(node),
+            cls.tree_left>node.tree_left,
+            cls.tree_right<node.tree_right,
+            cls.tree_level==node.tree_level+1
+        )
+
+    def _get_parent_pks(self,roots):
+        """
+        一次查询取得多个节点的父节点pk值
+        :param roots: _get_output_roots返回的列表
+        :return: {节点pk:父节点pk}，根节点不包括在内
+        """
+        cls=self._model_class
+        tree_key=cls.__dict__[cls.__tree_key__]
+        roots=[root for root in roots if root[1]!=1]
+        if len(roots)==0:
+            return {}
+        parent_field=self._get_parent_field()
+        if parent_field is not None:#直接读取父节点字段
+            pk_column=cls.__dict__[self.get_primary_field().name]
+            return dict(self._session.query(pk_column,cls.__dict__[parent_field])\
+                .filter(pk_column.in_([root[4] for root in roots])))
+        rs=self._session.query(tree_key,cls.tree_left,cls.tree_right,cls.__dict__[self.get_primary_field().name])\
+            .filter(or_(*[and_(tree_key==tree_id,cls.tree_left<left,cls.tree_right>right) for tree_id,left,right,level,pk in roots]))\
+            .order_by(tree_key,cls.tree_left)
+        ancestors={}
+        for tree_id,left,right,pk in rs:
+            ancestors.setdefault(tree_id,[]).append((left,right,pk))
+        result={}
+        for tree_id,left,right,level,pk in roots:
+            #祖先节点按tree_left排序，最后一个包含该节点的就是父节点
+            for a_left,a_right,a_pk in ancestors.get(tree_id,[]):
+                if a_left<left and a_right>right:
+                    result[pk]=a_pk
+        return result
+
+    @_profiled
+    def output(self,nodes=None,level=0,flatted=False,fields=[],format="json",children_name="children",pid_field_name="pId",output_err=False,
+               lazy=False,is_parent_field_name="isParent"):
         """
          输出节点数据到JSON格式
             nodes:输出该节点清单，如果没有指定则输出所有Tree
@@ -749,84 +2579,1131 @@ class TreeManager(object):
             flatted:False-按树形结构输出，True-提供PID，按平面结构输出
             fields=[]:指定输出的字段，如果没有指定，则按默认的节点输出。如果=*，但输出所有字段、如果指定字段名称，则输出指定的字段。
             pid_field:默认=pId，这样刚好默认可以将输出数据直接用到zTree里面
+            lazy:True-每个节点增加is_parent_field_name字段，表示是否有子节点，与level配合只输出前几级，
+                 其余节点由zTree展开节点时通过output_children异步加载
+            is_parent_field_name:默认=isParent，即zTree异步加载时使用的字段
+         所有节点的数据通过一次查询取得，然后按tree_left顺序遍历一次生成输出结构
+         设置了cache时，结果按参数及相关树的版本号缓存
         """
-        if nodes is None:
-            nodes=self.get_nodes(level==level)
-
-        if not isinstance(nodes,list):
-            nodes=[nodes]
-        #主键字段名称
-        pk_name=self.get_primary_field().name
+        args=(level,flatted,fields,format,children_name,pid_field_name,output_err,lazy,is_parent_field_name)
+        if self.cache is None:
+            return self._output(nodes,*args)
+        roots=None if nodes is None else self._get_output_roots(nodes)
+        tree_ids=None if roots is None else [root[0] for root in roots]
+        if not self._use_cache(tree_ids):
+            return self._output(nodes,*args)
+        key=self._get_cache_key(tree_ids,("output",None if roots is None else [root[4] for root in roots])+args)
+        result=self.cache.get(key)
+        if result is None:
+            result=self._output(nodes,*args)
+            self.cache.set(key,result if format.lower()=="json" else copy.deepcopy(result))
+            return result
+        #list格式的结果可能被调用者修改，返回副本
+        return result if format.lower()=="json" else copy.deepcopy(result)
+
+    def _output(self,nodes,level,flatted,fields,format,children_name,pid_field_name,output_err,lazy,is_parent_field_name):
+        """ 输出节点数据，参数见output """
         #输出的字段名称列表
         fields=self._get_output_fields(fields)
-        if flatted:
-            fields.append(pid_field_name)
-        fields=list(set(fields))#去重
-
-        #输出指定节点下属的所有后代
-        def output_node_tree(node):
-            outputs={item[0]:item[1] for item in node.__dict__.iteritems() if item[0] in fields}
-            #取得所有后代
-            descendants=node._TreeManager.get_descendants(node,level)
-            if len(descendants)>0:
-                parent_nodes=[]#保存父节点
-                pre_level=node.tree_level
-                parent_pointer=-1
-                #开始遍历所有后代
-                for i in range(len(descendants)):
-                    cur_level=descendants[i].tree_level
-                    cur_data={item[0]:item[1] for item in descendants[i].__dict__.iteritems() if item[0] in fields}
-                    if cur_level>pre_level:#降级,找出当前节点以及下面的所有节点
-                        if i==0:
-                            parent_nodes.append(outputs)
-                        else:
-                            parent_nodes.append(parent_nodes[-1][children_name][-1])
-                        if not parent_nodes[-1].has_key(children_name):
-                            parent_nodes[parent_pointer][children_name]=[]
-                    elif cur_level<pre_level:#升级
-                        del parent_nodes[-(pre_level-cur_level):]
-                    parent_nodes[-1][children_name].append(cur_data)
-                    pre_level=cur_level
-            return outputs
-        #扁平结构输出
-        def output_node_flatted(node):
-            outputs=[{item[0]:item[1] for item in node.__dict__.iteritems() if item[0] in fields}]
+        pk_index=fields.index(self.get_primary_field().name)
+
+        roots=None if nodes is None else self._get_output_roots(nodes)
+        #按树分组保存查询结果,{tree_id:([tree_left,...],[(tree_left,tree_right,节点数据),...])}
+        trees={}
+        root_rows=[]
+        for row in self._query_output_rows(roots,level,fields,lazy):
+            lefts,rows=trees.setdefault(row[0],([],[]))
+            lefts.append(row[1])
+            rows.append((row[1],row[2],row[4:]))
+            if roots is None and row[1]==1:
+                root_rows.append(row)
+        if roots is None:#输出所有树，按__tree_sort__排序
+            root_rows.sort(key=lambda row:row[3])
+            roots=[(row[0],row[1],row[2],0,row[4+pk_index]) for row in root_rows]
+        parent_pks=self._get_parent_pks(roots) if flatted else {}
+
+        outputs=[]
+        for tree_id,root_left,root_right,root_level,root_pk in roots:
             try:
-                outputs[0][pid_field_name]=self.get_node_primary(self.get_parent(node))
-            except:
-                outputs[0][pid_field_name]=""
-            #取得所有后代数据
-            for d_node in node._TreeManager.get_descendants(node,level):
-                outputs.append({item[0]:item[1] for item in d_node.__dict__.iteritems() if item[0] in fields})
-            #保存父节点pk值
-            parent_node_pk=[]
-            pre_level=outputs[0]["tree_level"]
-            for i in range(1,len(outputs)):
-                cur_level=outputs[i]["tree_level"]
-                if cur_level>pre_level:#降级,找出当前节点以及下面的所有节点
-                    parent_node_pk.append(outputs[i-1][pk_name])
-                elif cur_level<pre_level:#升级
-                    del parent_node_pk[-(pre_level-cur_level):]
-                outputs[i][pid_field_name]=parent_node_pk[-1]
-                pre_level=cur_level
+                lefts,rows=trees[tree_id]
+                stack=[]#(tree_right,输出数据)
+                for i in xrange(bisect_left(lefts,root_left),bisect_left(lefts,root_right)):
+                    left,right,values=rows[i]
+                    data=dict(zip(fields,values))
+                    if lazy:
+                        data[is_parent_field_name]=bool(values[-1])
+                    #弹出所有已经结束的节点,栈顶就是父节点
+                    while stack and stack[-1][0]<left:
+                        stack.pop()
+                    if flatted:#输出平面结构，含PID字段
+                        data[pid_field_name]=stack[-1][1][fields[pk_index]] if stack else parent_pks.get(root_pk,"")
+                        outputs.append(data)
+                    elif stack:
+                        stack[-1][1].setdefault(children_name,[]).append(data)
+                    else:
+                        outputs.append(data)
+                    stack.append((right,data))
+            except Exception,E:
+                if output_err:
+                    outputs.append({"error":E,"node":root_pk})
+
+        if format.lower()=="json":
+            return json.dumps(outputs)
+        else:
+            return outputs
+
+
+
+    def iter_output(self,nodes=None,level=0,flatted=False,fields=[],children_name="children",pid_field_name="pId",batch_size=1000,
+                    lazy=False,is_parent_field_name="isParent"):
+        """
+         以流的方式输出JSON文本，参数同output
+         按tree_left顺序通过yield_per逐批读取节点，每次返回一段JSON文本，内存占用不随树的大小增长,
+         可以直接作为web响应的内容逐段输出。将所有返回的文本连接起来，与output(format="json")的结果等价。
+            nodes:输出该节点清单，如果没有指定则输出所有Tree,此时与output一样按__tree_sort__排序
+            batch_size:每次从数据库读取的记录数，同时也是每段文本包含的最多节点数
+        例：
+            return Response(tm.iter_output(root_node,flatted=True),mimetype="application/json")
+        """
+        cls=self._model_class
+        fields=self._get_output_fields(fields)
+        pk_index=fields.index(self.get_primary_field().name)
+        children_key=", %s: [" % json.dumps(children_name)
+
+        if nodes is None and self._get_tree_sort_key()==cls.__tree_key__:
+            streams=[self._query_output_rows(None,level,fields,lazy)]
+            parent_pks={}
+        elif nodes is None:
+            #__tree_sort__不是树标识时先按其取得所有根节点，再逐棵树查询，level同output是绝对层级
+            tree_key=cls.__dict__[cls.__tree_key__]
+            roots=self._session.query(tree_key,cls.tree_left,cls.tree_right,literal(0),cls.__dict__[self.get_primary_field().name])\
+                .filter(self._get_root_condition()).order_by(cls.__dict__[self._get_tree_sort_key()],tree_key).all()
+            streams=(self._query_output_rows([root],level,fields,lazy) for root in roots)
+            parent_pks={}
+        else:
+            roots=self._get_output_roots(nodes)
+            #每个节点单独查询，保证按nodes的顺序输出
+            streams=(self._query_output_rows([root],level,fields,lazy) for root in roots)
+            parent_pks=self._get_parent_pks(roots) if flatted else {}
+
+        def iter_texts():
+            first=True
+            for rs in streams:
+                stack=[]#[tree_id,tree_right,pk,是否已经输出子节点]
+                for row in rs.yield_per(batch_size):
+                    tree_id,left,right=row[0],row[1],row[2]
+                    data=dict(zip(fields,row[4:]))
+                    if lazy:
+                        data[is_parent_field_name]=bool(row[-1])
+                    pk=data[fields[pk_index]]
+                    #结束所有已经结束的节点,栈顶就是父节点
+                    while stack and (stack[-1][0]!=tree_id or stack[-1][1]<left):
+                        node_info=stack.pop()
+                        if not flatted:
+                            yield "]}" if node_info[3] else "}"
+                    if flatted:
+                        data[pid_field_name]=stack[-1][2] if stack else parent_pks.get(pk,"")
+                        text=json.dumps(data)
+                    else:
+                        text=json.dumps(data)[:-1]#先不输出"}",以便继续输出子节点
+                    if stack and not flatted:
+                        if stack[-1][3]:
+                            yield ","+text
+                        else:
+                            stack[-1][3]=True
+                            yield children_key+text
+                    else:
+                        yield text if first else ","+text
+                        first=False
+                    stack.append([tree_id,right,pk,False])
+                while stack:
+                    node_info=stack.pop()
+                    if not flatted:
+                        yield "]}" if node_info[3] else "}"
+
+        texts=["["]
+        for text in iter_texts():
+            texts.append(text)
+            if len(texts)>=batch_size:
+                yield "".join(texts)
+                texts=[]
+        texts.append("]")
+        yield "".join(texts)
+
+    @_profiled
+    def output_children(self,node,after_left=None,limit=0,fields=[],format="json",pid_field_name="pId",is_parent_field_name="isParent"):
+        """
+         输出一个节点的子节点，用于zTree异步加载：先用output(lazy=True)输出前几级，展开节点时再请求该节点的子节点
+         每个子节点包含pid_field_name及is_parent_field_name字段，按tree_left排序
+            after_left:不是None时只输出tree_left大于该值的子节点，用于分页，此时fields中应包含tree_left以便取得下一页的after_left；
+                       闭包表模式的tree_left是兄弟顺序，可能为0或负数，因此第一页必须使用None
+            limit:最多输出的子节点数，0-不限制
+            其他参数同output
+         例：
+            def get_children(request):
+                node=session.query(User).get(request.args["id"])
+                return tm.output_children(node)
+        """
+        cls=self._model_class
+        fields=self._get_output_fields(fields)
+        rs=self._session.query(*([cls.__dict__[field] for field in fields]+[self._get_is_parent_column()]))\
+            .filter(self._get_node_children_condition(node))
+        if after_left is not None:
+            rs=rs.filter(cls.tree_left>after_left)
+        rs=rs.order_by(cls.tree_left)
+        if limit>0:
+            rs=rs.limit(limit)
+        pk=self.get_node_primary(node)
+        outputs=[]
+        for row in rs:
+            data=dict(zip(fields,row))
+            data[pid_field_name]=pk
+            data[is_parent_field_name]=bool(row[-1])
+            outputs.append(data)
+        if format.lower()=="json":
+            return json.dumps(outputs)
+        else:
             return outputs
 
+
+
+class ClosureTreeManager(TreeManager):
+    """
+    闭包表存储方式的树形管理器，提供与TreeManager相同的get_*、output等方法，TreeMixin的属性及实例方法同样可用
+    除节点表外另用一个闭包表保存所有(祖先pk,后代pk,深度)关系，包括深度为0的节点自身。
+    增加节点只需要插入O(depth)条闭包记录，删除节点只删除子树的节点及闭包记录，移动节点只修改子树与祖先之间的闭包记录，
+    都不需要像左右值那样调整树中其他的节点，适用于写操作频繁的树。
+    节点表中的tree_left保存节点在兄弟节点之间的顺序，tree_right不使用，tree_level及__tree_key__的含义不变。
+    不使用__tree_spacing__、__tree_path_field__，不支持snapshot、repair_tree，verify_tree校验闭包表与父子关系是否一致
+    使用方法,例：
+        class Category(ModelBase,TreeMixin):
+            __tablename__="category"
+            id=Column(Integer,primary_key=True)
+            TreeManager=ClosureTreeManager()#TreeMixin的属性及实例方法使用闭包表
+
+        tm=ClosureTreeManager(Category,session)
+        tm.get_closure_table()#在metadata.create_all之前调用，创建表时会一起创建闭包表
+        ModelBase.metadata.create_all(engine)
+    """
+
+    def get_closure_table(self):
+        """
+        返回闭包表，表名由TreeMixin.__tree_closure_table__指定，默认为"<表名>_closure"
+            ancestor   : 祖先节点pk
+            descendant : 后代节点pk
+            depth      : 后代节点相对祖先节点的深度，节点自身=0
+        闭包表会加入到模型的metadata中，因此在metadata.create_all之前调用时，创建表时会一起创建闭包表
+        :return: Table
+        """
+        cls=self._model_class
+        metadata=cls.__table__.metadata
+        name=getattr(cls,"__tree_closure_table__",None) or "%s_closure" % cls.__table__.name
+        if name in metadata.tables:
+            return metadata.tables[name]
+        pk_type=self.get_primary_field().type
+        table=Table(name,metadata,
+                    Column("ancestor",pk_type,nullable=False),
+                    Column("descendant",pk_type,nullable=False),
+                    Column("depth",Integer,nullable=False),
+                    PrimaryKeyConstraint("ancestor","descendant"))
+        Index("ix_%s_descendant" % name,table.c.descendant,table.c.depth)
+        return table
+
+    @_profiled
+    def create_closure_table(self,bind=None):
+        """
+        在数据库中创建闭包表，已经存在时跳过
+        :param bind: Engine或Connection，如果没有指定则使用会话绑定的数据库
+        """
+        if bind is None:
+            bind=self._session.get_bind(self._model_class)
+        self.get_closure_table().create(bind,checkfirst=True)
+
+    def _get_index_definitions(self):
+        """ 节点表只需要按层级及父节点字段的索引，闭包表的主键及索引随闭包表一起创建 """
+        return [(name,columns) for name,columns in TreeManager._get_index_definitions(self) if name in ("level","parent")]
+
+    def _get_path_field(self):
+        """ 闭包表模式不使用路径字段 """
+        return None
+
+    def _get_root_condition(self,tree_id=None):
+        """ tree_left保存的是兄弟顺序，根节点按层级判断 """
+        cls=self._model_class
+        if tree_id is None:
+            return cls.tree_level==1
+        return and_(cls.__dict__[cls.__tree_key__]==tree_id,cls.tree_level==1)
+
+    def is_root(self,node):
+        """
+        返回节点是否是根节点
+        :param node:
+        :return:
+        """
+        return node.tree_level==1
+
+    def _get_node_pk(self,node):
+        """ 取得节点的pk值，新节点没有pk值时通过主键的默认值函数生成，如自增主键则先写入数据库 """
+        pk_name=self.get_primary_field().name
+        pk=getattr(node,pk_name)
+        if pk is None:
+            pk=self._new_primary_value()
+            if pk is None:
+                self._session.flush()
+                pk=getattr(node,pk_name)
+            else:
+                setattr(node,pk_name,pk)
+        return pk
+
+    def _get_parent_pk(self,node):
+        """ 取得节点的父节点pk值，根节点返回None """
+        parent_field=self._get_parent_field()
+        if parent_field is not None:
+            return getattr(node,parent_field)
+        closure=self.get_closure_table()
+        return self._session.execute(select([closure.c.ancestor])
+            .where(and_(closure.c.descendant==self._get_node_pk(node),closure.c.depth==1))).scalar()
+
+    def _get_children_condition(self,parent_pk):
+        """ 返回parent_pk的所有子节点的查询条件 """
+        cls=self._model_class
+        parent_field=self._get_parent_field()
+        if parent_field is not None:
+            return cls.__dict__[parent_field]==parent_pk
+        closure=self.get_closure_table()
+        return cls.__dict__[self.get_primary_field().name].in_(
+            select([closure.c.descendant]).where(and_(closure.c.ancestor==parent_pk,closure.c.depth==1)))
+
+    def _add_parent_column(self,query):
+        """ 在查询的最后增加一列父节点pk值，根节点为None """
+        cls=self._model_class
+        parent_field=self._get_parent_field()
+        if parent_field is not None:
+            return query.add_columns(cls.__dict__[parent_field])
+        parent=self.get_closure_table().alias()
+        return query.add_columns(parent.c.ancestor)\
+            .outerjoin(parent,and_(parent.c.descendant==cls.__dict__[self.get_primary_field().name],parent.c.depth==1))
+
+    def _sort_preorder(self,rows,key=None):
+        """
+        将[(数据,pk,父节点pk,兄弟顺序),...]按先序排列，父节点不在rows中的作为顶层节点
+        :param key: 顶层节点的排序函数，默认按兄弟顺序
+        """
+        pks=set(row[1] for row in rows)
+        children={}
+        tops=[]
+        for row in rows:
+            if row[2] in pks:
+                children.setdefault(row[2],[]).append(row)
+            else:
+                tops.append(row)
+        for items in children.values():
+            items.sort(key=lambda row:row[3])
+        tops.sort(key=key or (lambda row:row[3]))
+        result=[]
+        stack=[iter(tops)]
+        while stack:
+            row=next(stack[-1],None)
+            if row is None:
+                stack.pop()
+                continue
+            result.append(row)
+            if row[1] in children:
+                stack.append(iter(children[row[1]]))
+        return result
+
+    def _alloc_orders(self,ref_node,pos,count):
+        """
+        在ref_node的pos位置为count个新节点分配兄弟顺序，插入到兄弟节点中间时后移后面的兄弟节点
+        :return: (父节点pk,树id,层级,第一个兄弟顺序)
+        """
+        session=self._session
+        cls=self._model_class
+        tree_id=self.get_node_tree_id(ref_node)
+        if pos in (TREE_NODE_POSITION.LastChild,TREE_NODE_POSITION.FirstChild):
+            parent_pk=self._get_node_pk(ref_node)
+            condition=self._get_children_condition(parent_pk)
+            if pos==TREE_NODE_POSITION.LastChild:
+                value=session.query(func.max(cls.tree_left)).filter(condition).scalar()
+                return parent_pk,tree_id,ref_node.tree_level+1,1 if value is None else value+1
+            value=session.query(func.min(cls.tree_left)).filter(condition).scalar()
+            return parent_pk,tree_id,ref_node.tree_level+1,1 if value is None else value-count
+        if pos not in (TREE_NODE_POSITION.NextSibling,TREE_NODE_POSITION.PreviousSibling):
+            raise TreeNodeInvalidOperation
+        if self.is_root(ref_node):#一棵树只能有一个根节点
+            raise TreeNodeOnlyOneRootException
+        parent_pk=self._get_parent_pk(ref_node)
+        level=ref_node.tree_level
+        value=ref_node.tree_left+1 if pos==TREE_NODE_POSITION.NextSibling else ref_node.tree_left
+        session.query(cls)\
+            .filter(and_(self._get_children_condition(parent_pk),cls.tree_left>=value))\
+            .update({cls.tree_left:cls.tree_left+count},synchronize_session=False)
+        #会话中可能被后移的兄弟节点，下次访问时重新读取
+        for node in list(session.identity_map.values()):
+            if isinstance(node,cls) and node.__dict__.get(cls.__tree_key__)==tree_id \
+                    and node.__dict__.get("tree_level")==level and node.__dict__.get("tree_left",value-1)>=value:
+                session.expire(node,["tree_left"])
+        return parent_pk,tree_id,level,value
+
+    def _insert_closure(self,pks,parent_pk):
+        """ 为没有子节点的新节点插入闭包记录，包括节点自身以及与parent_pk的所有祖先之间的记录 """
+        closure=self.get_closure_table()
+        rows=[{"ancestor":pk,"descendant":pk,"depth":0} for pk in pks]
+        if parent_pk is not None:
+            ancestors=self._session.execute(select([closure.c.ancestor,closure.c.depth]).where(closure.c.descendant==parent_pk)).fetchall()
+            rows.extend({"ancestor":ancestor,"descendant":pk,"depth":depth+1} for pk in pks for ancestor,depth in ancestors)
+        self._session.execute(closure.insert(),rows)
+
+    @_profiled
+    def add_node(self,nodes,ref_node=None,pos=TREE_NODE_POSITION.LastChild,tree_id=None):
+        """
+        增加一个或多个节点，参数同TreeManager.add_node
+        只需要插入新节点的闭包记录，插入到兄弟节点中间时后移后面的兄弟节点，不影响树中的其他节点
+        """
+        session=self._session
+        cls=self._model_class
+        if isinstance(nodes,list):
+            nodes=[cls(**node) if isinstance(node,dict) else node for node in nodes if isinstance(node,(TreeMixin,dict))]
+        else:
+            nodes=[nodes]
+        if len(nodes)==0:
+            return
+        parent_field=self._get_parent_field()
+        if ref_node is None:
+            #增加根节点，每个节点是一棵树
+            tree_ids=[self.get_node_tree_id(node) for node in nodes] if tree_id is None else [tree_id]*len(nodes)
+            self._lock_nodes([],tree_ids)
+            if len(set(tree_ids))<len(tree_ids) or session.query(session.query(cls)
+                    .filter(and_(cls.__dict__[cls.__tree_key__].in_(tree_ids),cls.tree_level==1)).exists()).scalar():
+                raise TreeNodeOnlyOneRootException
+            for node,node_tree_id in zip(nodes,tree_ids):
+                node.__dict__.update({cls.__tree_key__:node_tree_id,"tree_left":1,"tree_right":0,"tree_level":1})
+                if parent_field is not None:
+                    node.__dict__[parent_field]=None
+            parent_pk=None
+        else:
+            self._lock_nodes([ref_node])
+            parent_pk,tree_id,level,order=self._alloc_orders(ref_node,pos,len(nodes))
+            for i,node in enumerate(nodes):
+                node.__dict__.update({cls.__tree_key__:tree_id,"tree_left":order+i,"tree_right":0,"tree_level":level})
+                if parent_field is not None:
+                    node.__dict__[parent_field]=parent_pk
+            tree_ids=[tree_id]
+        session.add_all(nodes)
+        self._insert_closure([self._get_node_pk(node) for node in nodes],parent_pk)
+        self._invalidate_tree(*set(tree_ids))
+
+    @_profiled
+    def import_tree(self,data,ref_node=None,pos=TREE_NODE_POSITION.LastChild,tree_id=None,children_name="children"):
+        """
+        批量导入一棵或多棵子树，参数同TreeManager.import_tree
+        节点通过一次bulk_insert_mappings插入，闭包记录通过一次executemany插入
+        """
+        session=self._session
+        cls=self._model_class
+        closure=self.get_closure_table()
+        pk_name=self.get_primary_field().name
+        self._lock_nodes([ref_node])
+
+        items=self._get_import_items(data,children_name)
+        if len(items)==0:
+            return 0
+        if ref_node is None:
+            if len([item for item in items if item[1]==0])>1:
+                raise TreeNodeOnlyOneRootException
+            tree_id=items[0][0].get(cls.__tree_key__,0) if tree_id is None else tree_id
+            self._lock_nodes([],[tree_id])
+            if session.query(session.query(cls).filter(self._get_root_condition(tree_id)).exists()).scalar():
+                raise TreeNodeOnlyOneRootException
+            parent_pk,level,order,ancestors=None,1,1,[]
+        else:
+            parent_pk,tree_id,level,order=self._alloc_orders(ref_node,pos,len([item for item in items if item[1]==0]))
+            ancestors=session.execute(select([closure.c.ancestor,closure.c.depth]).where(closure.c.descendant==parent_pk)).fetchall()
+
+        #按先序依次生成插入数据，栈中保存[祖先节点的插入数据,已分配的子节点数]
+        parent_field=self._get_parent_field()
+        mappings=[]
+        chains=[]#每个节点在同一批数据中的祖先
+        stack=[]
+        for node_data,depth in items:
+            del stack[depth:]
+            mapping=dict(node_data)
+            mapping.update({cls.__tree_key__:tree_id,"tree_right":0,"tree_level":level+depth})
+            if stack:
+                stack[-1][1]+=1
+                mapping["tree_left"]=stack[-1][1]
+            else:
+                mapping["tree_left"]=order
+                order+=1
+            if mapping.get(pk_name) is None:
+                mapping[pk_name]=self._new_primary_value()
+            if parent_field is not None:
+                mapping[parent_field]=stack[-1][0][pk_name] if stack else parent_pk
+            mappings.append(mapping)
+            chains.append([item[0] for item in stack])
+            stack.append([mapping,0])
+
+        unknown_pk=any(mapping[pk_name] is None for mapping in mappings)#如自增主键，插入后才能取得pk值
+        if unknown_pk:
+            for mapping in mappings:
+                mapping.pop(pk_name,None)
+        session.bulk_insert_mappings(cls,mappings,return_defaults=unknown_pk)
+        if unknown_pk and parent_field is not None:
+            pk_column=cls.__table__.columns[pk_name]
+            session.execute(cls.__table__.update().where(pk_column==bindparam("_pk")).values({parent_field:bindparam("_parent")}),
+                            [{"_pk":mapping[pk_name],"_parent":chain[-1][pk_name]} for mapping,chain in zip(mappings,chains) if chain])
+
+        rows=[]
+        for mapping,chain in zip(mappings,chains):
+            pk=mapping[pk_name]
+            rows.append({"ancestor":pk,"descendant":pk,"depth":0})
+            for depth,ancestor in enumerate(reversed(chain)):
+                rows.append({"ancestor":ancestor[pk_name],"descendant":pk,"depth":depth+1})
+            for ancestor,depth in ancestors:
+                rows.append({"ancestor":ancestor,"descendant":pk,"depth":depth+len(chain)+1})
+        session.execute(closure.insert(),rows)
+        self._invalidate_tree(tree_id)
+        return len(mappings)
+
+    def _delete_subtrees(self,pks):
+        """ 删除pks及其所有后代节点，以及这些节点的闭包记录 """
+        cls=self._model_class
+        closure=self.get_closure_table()
+        subtree=select([closure.c.descendant]).where(closure.c.ancestor.in_(pks))
+        self._session.query(cls)\
+            .filter(cls.__dict__[self.get_primary_field().name].in_(subtree))\
+            .delete(synchronize_session="fetch")
+        self._session.execute(closure.delete().where(closure.c.descendant.in_(subtree)))
+
+    @_profiled
+    def del_node(self,node):
+        """ 删除指定的节点及其后代节点，兄弟节点的顺序不需要调整 """
+        self._lock_nodes([node])
+        self._delete_subtrees([self._get_node_pk(node)])
+        self._invalidate_tree(self.get_node_tree_id(node))
+
+    @_profiled
+    def del_nodes(self,nodes):
+        """ 批量删除多个节点，连同各节点下属的子孙节点，所有节点及闭包记录各通过一条DELETE语句删除 """
+        self._lock_nodes(nodes)
+        if len(nodes)==0:
+            return
+        self._delete_subtrees(list(set(self._get_node_pk(node) for node in nodes)))
+        self._invalidate_tree(*set(self.get_node_tree_id(node) for node in nodes))
+
+    def _get_top_nodes(self,nodes):
+        """
+        去掉重复的节点以及被其他选中节点包含的节点，保持原来的顺序
+        """
+        closure=self.get_closure_table()
+        pks=list(set(self._get_node_pk(node) for node in nodes))
+        if len(pks)==0:
+            return []
+        contained=set(pk for pk, in self._session.execute(select([closure.c.descendant])
+            .where(and_(closure.c.ancestor.in_(pks),closure.c.descendant.in_(pks),closure.c.depth>0))))
+        result=[]
+        for node in nodes:
+            pk=self._get_node_pk(node)
+            if pk not in contained:
+                contained.add(pk)
+                result.append(node)
+        return result
+
+    @_profiled
+    def move_node(self,node,ref_node,pos=0):
+        """
+        移动节点node到ref_node的相对位置，连同该节点下属的所有子节点，参数同TreeManager.move_node
+        只删除子树与原祖先之间的闭包记录，再插入子树与新祖先之间的记录，层级发生变化时调整子树的层级
+        """
+        assert isinstance(node,TreeMixin),u'非法节点'
+        self._lock_nodes([node,ref_node])
+        session=self._session
+        cls=self._model_class
+        closure=self.get_closure_table()
+        node_pk=self._get_node_pk(node)
+        #ref_node是node自身或者后代时不允许移动
+        if session.execute(select([closure.c.depth])
+                .where(and_(closure.c.ancestor==node_pk,closure.c.descendant==self._get_node_pk(ref_node)))).first() is not None:
+            raise TreeNodeInvalidOperation
+        node_tree_id,node_level=self.get_node_tree_id(node),node.tree_level
+        parent_pk,tree_id,level,order=self._alloc_orders(ref_node,pos,1)
+
+        subtree=select([closure.c.descendant]).where(closure.c.ancestor==node_pk)
+        ancestors=[pk for pk, in session.execute(select([closure.c.ancestor]).where(and_(closure.c.descendant==node_pk,closure.c.depth>0)))]
+        if len(ancestors)>0:
+            session.execute(closure.delete().where(and_(closure.c.ancestor.in_(ancestors),closure.c.descendant.in_(subtree))))
+        parent,child=closure.alias(),closure.alias()
+        session.execute(closure.insert().from_select(["ancestor","descendant","depth"],
+            select([parent.c.ancestor,child.c.descendant,parent.c.depth+child.c.depth+1])
+                .where(and_(parent.c.descendant==parent_pk,child.c.ancestor==node_pk))))
+
+        values={}
+        if level!=node_level:
+            values[cls.tree_level]=cls.tree_level+(level-node_level)
+        if tree_id!=node_tree_id:
+            values[cls.__dict__[cls.__tree_key__]]=tree_id
+        if values:
+            pks=set(pk for pk, in session.execute(subtree))
+            session.query(cls)\
+                .filter(cls.__dict__[self.get_primary_field().name].in_(subtree))\
+                .update(values,synchronize_session=False)
+            for subtree_node in list(session.identity_map.values()):
+                if isinstance(subtree_node,cls) and subtree_node.__dict__.get(self.get_primary_field().name) in pks:
+                    if "tree_level" in subtree_node.__dict__:
+                        set_committed_value(subtree_node,"tree_level",subtree_node.__dict__["tree_level"]+level-node_level)
+                    set_committed_value(subtree_node,cls.__tree_key__,tree_id)
+        node.tree_left=order
+        parent_field=self._get_parent_field()
+        if parent_field is not None:
+            setattr(node,parent_field,parent_pk)
+        self._invalidate_tree(*set([node_tree_id,tree_id]))
+
+    @_profiled
+    def move_nodes(self,nodes,ref_node,pos=TREE_NODE_POSITION.LastChild):
+        """
+        批量移动多个节点到ref_node的相对位置，移动后按nodes中的顺序排列，参数同TreeManager.move_nodes
+        已经被其他选中节点包含的节点会被忽略，其余节点依次移动，每次只修改该子树的闭包记录
+        """
+        self._lock_nodes(list(nodes)+[ref_node])
+        nodes=self._get_top_nodes(nodes)
+        if len(nodes)==0:
+            return
+        closure=self.get_closure_table()
+        if self._session.execute(select([closure.c.depth]).where(and_(
+                closure.c.ancestor.in_([self._get_node_pk(node) for node in nodes]),
+                closure.c.descendant==self._get_node_pk(ref_node)))).first() is not None:
+            raise TreeNodeInvalidOperation
+        #插入到前面的位置时需要倒序移动
+        if pos in (TREE_NODE_POSITION.FirstChild,TREE_NODE_POSITION.NextSibling):
+            nodes=reversed(nodes)
+        for node in nodes:
+            self.move_node(node,ref_node,pos)
+
+    @_profiled
+    def get_nodes(self,tree_id=None,level=0):
+        """
+            返回指定tree_id的树,按先序排列
+        :param tree_id: 树id，如果没有指定tree_id，则返加所有树
+        :param level:限制层次,1：只返回根节点，2：返回第二级
+        :return:
+        """
+        cls=self._model_class
+        conditions=[]
+        if tree_id is not None:
+            conditions.append(cls.__dict__[cls.__tree_key__]==tree_id)
+        if level>0:
+            conditions.append(cls.tree_level<=level)
+        sort_key=self._get_tree_sort_key()
+        rows=[(node,self.get_node_primary(node),parent_pk,node.tree_left)
+              for node,parent_pk in self._add_parent_column(self._session.query(cls)).filter(*conditions)]
+        return [row[0] for row in self._sort_preorder(rows,key=lambda row:getattr(row[0],sort_key))]
+
+    def get_node_relation(self,node,ref_node):
+        """
+            取得节点的相对关系，返回值同TreeManager.get_node_relation
+            祖先、后代关系通过闭包表中的一条记录判断
+        """
+        if self.get_node_tree_id(node)!=self.get_node_tree_id(ref_node):
+            if self.is_root(node) and self.is_root(ref_node):#均是根节点，两个根节点是兄弟关系
+                return TREE_NODE_RELATION.Siblings
+            return TREE_NODE_RELATION.Diff_tree
+        if node is ref_node:
+            return TREE_NODE_RELATION.Self
+        if node.tree_level!=ref_node.tree_level:
+            closure=self.get_closure_table()
+            ancestor,descendant=(ref_node,node) if node.tree_level>ref_node.tree_level else (node,ref_node)
+            depth=self._session.execute(select([closure.c.depth]).where(and_(
+                closure.c.ancestor==self._get_node_pk(ancestor),
+                closure.c.descendant==self._get_node_pk(descendant)))).scalar()
+            if depth is None:
+                return TREE_NODE_RELATION.Same_tree
+            if node.tree_level>ref_node.tree_level:
+                return TREE_NODE_RELATION.Child if depth==1 else TREE_NODE_RELATION.Descendants
+            return TREE_NODE_RELATION.Parent if depth==1 else TREE_NODE_RELATION.Ancestors
+        if self.is_root(node):
+            return TREE_NODE_RELATION.Unknow
+        if self._get_parent_pk(node)==self._get_parent_pk(ref_node):
+            return TREE_NODE_RELATION.Siblings
+        return TREE_NODE_RELATION.Same_level
+
+    @_profiled
+    def get_node_relations(self,node,ref_nodes):
+        """
+            一次取得节点与多个相对节点的关系，返回值同TreeManager.get_node_relations
+            通过一次查询闭包表取得node与所有相对节点之间的祖先、后代记录，以及node的父节点与同一层级的相对节点之间的记录
+        """
+        tree_id=self.get_node_tree_id(node)
+        pk=self._get_node_pk(node)
+        refs=[(ref_node,self._get_node_pk(ref_node)) for ref_node in ref_nodes]
+        same_tree=[ref_pk for ref_node,ref_pk in refs if self.get_node_tree_id(ref_node)==tree_id and ref_pk!=pk]
+        same_level=[ref_pk for ref_node,ref_pk in refs if self.get_node_tree_id(ref_node)==tree_id and ref_pk!=pk and ref_node.tree_level==node.tree_level]
+        closure=self.get_closure_table()
+        depths={}#{相对节点pk:深度}，深度为正说明相对节点是node的祖先，为负说明是后代
+        siblings=set()
+        if len(same_tree)>0:
+            conditions=[
+                and_(closure.c.descendant==pk,closure.c.ancestor.in_(same_tree)),
+                and_(closure.c.ancestor==pk,closure.c.descendant.in_(same_tree)),
+            ]
+            parent_pk=self._get_parent_pk(node) if len(same_level)>0 and not self.is_root(node) else None
+            if parent_pk is not None:
+                conditions.append(and_(closure.c.ancestor==parent_pk,closure.c.depth==1,closure.c.descendant.in_(same_level)))
+            for ancestor,descendant,depth in self._session.execute(
+                    select([closure.c.ancestor,closure.c.descendant,closure.c.depth]).where(or_(*conditions))):
+                if descendant==pk:
+                    depths[ancestor]=depth
+                elif ancestor==pk:
+                    depths[descendant]=-depth
+                else:
+                    siblings.add(descendant)
+        results=[]
+        for ref_node,ref_pk in refs:
+            if self.get_node_tree_id(ref_node)!=tree_id:
+                if self.is_root(node) and self.is_root(ref_node):#均是根节点，两个根节点是兄弟关系
+                    results.append(TREE_NODE_RELATION.Siblings)
+                else:
+                    results.append(TREE_NODE_RELATION.Diff_tree)
+            elif ref_pk==pk:
+                results.append(TREE_NODE_RELATION.Self)
+            elif ref_pk in depths:
+                depth=depths[ref_pk]
+                if depth>0:
+                    results.append(TREE_NODE_RELATION.Child if depth==1 else TREE_NODE_RELATION.Descendants)
+                else:
+                    results.append(TREE_NODE_RELATION.Parent if depth==-1 else TREE_NODE_RELATION.Ancestors)
+            elif ref_node.tree_level!=node.tree_level:
+                results.append(TREE_NODE_RELATION.Same_tree)
+            elif self.is_root(node):
+                results.append(TREE_NODE_RELATION.Unknow)
+            else:
+                results.append(TREE_NODE_RELATION.Siblings if ref_pk in siblings else TREE_NODE_RELATION.Same_level)
+        return results
+
+    @_profiled
+    def get_ancestors(self,node):
+        """
+            取得所有祖先节点,包括父节点，从根节点开始排列
+        """
+        cls=self._model_class
+        closure=self.get_closure_table()
+        pk=self._get_node_pk(node)
+        rs=self._session.query(cls)\
+            .join(closure,closure.c.ancestor==cls.__dict__[self.get_primary_field().name])\
+            .filter(and_(closure.c.descendant==pk,closure.c.depth>0))\
+            .order_by(closure.c.depth.desc())
+        return self._cached_nodes(self.get_node_tree_id(node),("ancestors",pk),rs.all)
+
+    @_profiled
+    def get_parent(self,node):
+        """
+            取得节点的父节点
+        """
+        if self.is_root(node):#根节点没有父
+            raise TreeNodeNotFound
+        parent_pk=self._get_parent_pk(node)
+        return self._session.query(self._model_class).get(parent_pk) if parent_pk is not None else None
+
+    @_profiled
+    def get_ancestors_count(self,node):
+        """
+        取得祖先节点数量,不包括自己
+        :param node:
+        :return:
+        """
+        closure=self.get_closure_table()
+        return self._session.execute(select([func.count(closure.c.ancestor)])
+            .where(and_(closure.c.descendant==self._get_node_pk(node),closure.c.depth>0))).scalar()
+
+    @_profiled
+    def get_descendants(self,node,level=0):
+        """
+        所有后代节点，按先序排列
+        :param level:仅返回几级后代,如果=1相当于只返回子节点
+        :return:
+        """
+        cls=self._model_class
+        closure=self.get_closure_table()
+        pk=self._get_node_pk(node)
+        conditions=[closure.c.ancestor==pk,closure.c.depth>0]
+        if level>0:
+            conditions.append(closure.c.depth<=level)
+        rs=self._session.query(cls)\
+            .join(closure,closure.c.descendant==cls.__dict__[self.get_primary_field().name])\
+            .filter(and_(*conditions))
+        def load():
+            if level==1:
+                return rs.order_by(cls.tree_left).all()
+            rows=[(descendant,self.get_node_primary(descendant),parent_pk,descendant.tree_left) for descendant,parent_pk in self._add_parent_column(rs)]
+            return [row[0] for row in self._sort_preorder(rows)]
+        return self._cached_nodes(self.get_node_tree_id(node),("descendants",pk,level),load)
+
+    @_profiled
+    def get_descendants_count(self,node):
+        """
+        取得后代节点数目
+        :param node:
+        :return:
+        """
+        closure=self.get_closure_table()
+        return self._session.execute(select([func.count(closure.c.descendant)])
+            .where(and_(closure.c.ancestor==self._get_node_pk(node),closure.c.depth>0))).scalar()
+
+    def _get_sibling(self,node,offset):
+        """ 取得下一个(offset=1)或上一个(offset=-1)兄弟节点 """
+        cls=self._model_class
+        if self.is_root(node):#根节点的兄弟就是其他的根节点
+            root_nodes=self._session.query(cls).filter(self._get_root_condition()).order_by(self._get_tree_sort_key()).all()
+            i=root_nodes.index(node)+offset
+            if 0<=i<len(root_nodes):
+                return root_nodes[i]
+            raise TreeNodeNotFound
+        rs=self._session.query(cls).filter(self._get_children_condition(self._get_parent_pk(node)))
+        if offset>0:
+            sibling=rs.filter(cls.tree_left>node.tree_left).order_by(cls.tree_left).first()
+        else:
+            sibling=rs.filter(cls.tree_left<node.tree_left).order_by(cls.tree_left.desc()).first()
+        if sibling is None:
+            raise TreeNodeNotFound
+        return sibling
+
+    @_profiled
+    def get_next_sibling(self,node):
+        """取得下一个兄弟节点"""
+        return self._get_sibling(node,1)
+
+    @_profiled
+    def get_previous_sibling(self,node):
+        """取得上一个兄弟节点"""
+        return self._get_sibling(node,-1)
+
+    @_profiled
+    def get_ancestors_many(self,nodes):
+        """
+        一次查询取得多个节点的祖先节点
+        :return: {节点pk:[祖先节点,...]},祖先节点从根节点开始排列
+        """
+        cls=self._model_class
+        closure=self.get_closure_table()
+        result=dict((self._get_node_pk(node),[]) for node in nodes)
+        if len(result)==0:
+            return result
+        rs=self._session.query(cls,closure.c.descendant)\
+            .join(closure,closure.c.ancestor==cls.__dict__[self.get_primary_field().name])\
+            .filter(and_(closure.c.descendant.in_(result.keys()),closure.c.depth>0))\
+            .order_by(closure.c.descendant,closure.c.depth.desc())
+        for ancestor,pk in rs:
+            result[pk].append(ancestor)
+        return result
+
+    @_profiled
+    def get_ancestors_count_many(self,nodes):
+        """
+        一次查询取得多个节点的祖先节点数量
+        :return: {节点pk:祖先节点数量}
+        """
+        closure=self.get_closure_table()
+        result=dict((self._get_node_pk(node),0) for node in nodes)
+        if len(result)==0:
+            return result
+        result.update(self._session.execute(select([closure.c.descendant,func.count(closure.c.ancestor)])
+            .where(and_(closure.c.descendant.in_(result.keys()),closure.c.depth>0))
+            .group_by(closure.c.descendant)).fetchall())
+        return result
+
+    @_profiled
+    def get_parent_many(self,nodes):
+        """
+        一次查询取得多个节点的父节点
+        :return: {节点pk:父节点},根节点的父节点为None
+        """
+        cls=self._model_class
+        closure=self.get_closure_table()
+        result=dict((self._get_node_pk(node),None) for node in nodes)
+        if len(result)==0:
+            return result
+        rs=self._session.query(cls,closure.c.descendant)\
+            .join(closure,closure.c.ancestor==cls.__dict__[self.get_primary_field().name])\
+            .filter(and_(closure.c.descendant.in_(result.keys()),closure.c.depth==1))
+        for parent,pk in rs:
+            result[pk]=parent
+        return result
+
+    @_profiled
+    def get_descendants_many(self,nodes,level=0):
+        """
+        一次查询取得多个节点的后代节点
+        :param level:仅返回几级后代,如果=1相当于只返回子节点
+        :return: {节点pk:[后代节点,...]},后代节点按先序排列
+        """
+        cls=self._model_class
+        closure=self.get_closure_table()
+        pks=list(set(self._get_node_pk(node) for node in nodes))
+        if len(pks)==0:
+            return {}
+        conditions=[closure.c.ancestor.in_(pks),closure.c.depth>0]
+        if level>0:
+            conditions.append(closure.c.depth<=level)
+        rs=self._add_parent_column(self._session.query(cls,closure.c.ancestor)
+            .join(closure,closure.c.descendant==cls.__dict__[self.get_primary_field().name])
+            .filter(and_(*conditions)))
+        rows=dict((pk,[]) for pk in pks)
+        for descendant,pk,parent_pk in rs:
+            rows[pk].append((descendant,self.get_node_primary(descendant),parent_pk,descendant.tree_left))
+        return dict((pk,[row[0] for row in self._sort_preorder(items)]) for pk,items in rows.items())
+
+    @_profiled
+    def get_children_many(self,nodes):
+        """
+        一次查询取得多个节点的子节点
+        :return: {节点pk:[子节点,...]}
+        """
+        return self.get_descendants_many(nodes,1)
+
+    def _output(self,nodes,level,flatted,fields,format,children_name,pid_field_name,output_err,lazy,is_parent_field_name):
+        """ 输出节点数据，参数见output，通过一次查询取得所有要输出的节点及其父节点pk值，按先序生成输出结构 """
+        cls=self._model_class
+        closure=self.get_closure_table()
+        fields=self._get_output_fields(fields)
+        pk_field=cls.__dict__[self.get_primary_field().name]
+        columns=[cls.__dict__[field] for field in fields]
+        if lazy:#是否有子节点作为一个输出字段
+            fields=fields+[is_parent_field_name]
+            columns.append(self._get_is_parent_column())
+        columns.extend([pk_field,cls.tree_left,cls.__dict__[self._get_tree_sort_key()]])
+        count=len(fields)
+        #按输出的顶层节点分组,[(顶层节点pk,[(节点数据,pk,父节点pk,兄弟顺序),...],顶层节点的排序函数)]
+        groups=[]
+        if nodes is None:
+            rs=self._session.query(*columns)
+            if level>0:
+                rs=rs.filter(cls.tree_level<=level)
+            rows=[]
+            sort_values={}
+            for row in self._add_parent_column(rs):
+                rows.append((dict(zip(fields,row[:count])),row[count],row[-1],row[count+1]))
+                sort_values[row[count]]=row[count+2]
+            groups.append((None,rows,lambda row:sort_values[row[1]]))
+        else:
+            if not isinstance(nodes,list):
+                nodes=[nodes]
+            root_pks=[self._get_node_pk(node) for node in nodes]
+            conditions=[closure.c.ancestor.in_(root_pks)]
+            if level>0:
+                conditions.append(closure.c.depth<=level)
+            rs=self._session.query(*(columns+[closure.c.ancestor]))\
+                .join(closure,closure.c.descendant==pk_field)\
+                .filter(and_(*conditions))
+            rows={}
+            for row in self._add_parent_column(rs):
+                rows.setdefault(row[count+3],[]).append((dict(zip(fields,row[:count])),row[count],row[-1],row[count+1]))
+            for pk in root_pks:
+                groups.append((pk,rows.get(pk,[]),None))
+
         outputs=[]
-        for i in range(len(nodes)):
+        for root_pk,rows,key in groups:
             try:
-                if flatted:#输出平面结构，含PID字段
-                    outputs.extend(output_node_flatted(nodes[i]))
-                else:
-                    outputs.append(output_node_tree(nodes[i]))
+                datas={}
+                for data,pk,parent_pk,order in self._sort_preorder(rows,key):
+                    datas[pk]=data
+                    if lazy:
+                        data[is_parent_field_name]=bool(data[is_parent_field_name])
+                    if flatted:#输出平面结构，含PID字段
+                        data[pid_field_name]=parent_pk if parent_pk is not None else ""
+                        outputs.append(data)
+                    elif parent_pk in datas:
+                        datas[parent_pk].setdefault(children_name,[]).append(data)
+                    else:
+                        outputs.append(data)
             except Exception,E:
                 if output_err:
-                    outputs.append({"error":E,"node":nodes[i]._TreeManager.get_node_primary(nodes[i])})
+                    outputs.append({"error":E,"node":root_pk})
 
         if format.lower()=="json":
             return json.dumps(outputs)
         else:
             return outputs
 
+    def iter_output(self,nodes=None,level=0,flatted=False,fields=[],children_name="children",pid_field_name="pId",batch_size=1000,
+                    lazy=False,is_parent_field_name="isParent"):
+        """
+         以流的方式输出JSON文本，参数同TreeManager.iter_output
+         闭包表模式需要取得所有节点后才能确定先序，因此一次返回output(format="json")的结果
+        """
+        yield self.output(nodes,level,flatted,fields,"json",children_name,pid_field_name,False,lazy,is_parent_field_name)
+
+    def _get_is_parent_column(self):
+        """ 返回节点是否有子节点(1/0)的列，通过EXISTS查询闭包表中深度为1的记录 """
+        cls=self._model_class
+        closure=self.get_closure_table().alias()
+        return case([(exists([closure.c.descendant]).where(and_(
+            closure.c.ancestor==cls.__dict__[self.get_primary_field().name],
+            closure.c.depth==1
+        )),1)],else_=0)
+
+    def _get_node_children_condition(self,node):
+        """ 返回node的子节点的查询条件，tree_left是兄弟节点之间的顺序，output_children同样可以按after_left分页 """
+        return self._get_children_condition(self._get_node_pk(node))
+
+    def _get_descendants_pk_query(self,node,level=0):
+        """ 返回node的后代节点(pk,兄弟顺序)的查询 """
+        cls=self._model_class
+        closure=self.get_closure_table()
+        pk_field=cls.__dict__[self.get_primary_field().name]
+        conditions=[closure.c.ancestor==self._get_node_pk(node),closure.c.depth>0]
+        if level>0:
+            conditions.append(closure.c.depth<=level)
+        return self._session.query(pk_field,cls.tree_left)\
+            .join(closure,closure.c.descendant==pk_field)\
+            .filter(and_(*conditions))
+
+    def _get_nodes_pk_query(self,tree_id=None,level=0):
+        """ 返回节点(pk,兄弟顺序,树排序字段)的查询 """
+        cls=self._model_class
+        conditions=[]
+        if tree_id is not None:
+            conditions.append(cls.__dict__[cls.__tree_key__]==tree_id)
+        if level>0:
+            conditions.append(cls.tree_level<=level)
+        return self._session.query(cls.__dict__[self.get_primary_field().name],cls.tree_left,cls.__dict__[self._get_tree_sort_key()])\
+            .filter(and_(*conditions))
+
+    def _get_preorder_pks(self,tree_ids,args,query,key=None):
+        """
+        只读取pk、兄弟顺序及父节点pk排出先序，返回pk列表，不载入节点实例
+        设置了缓存时按树的版本号缓存pk列表，树没有变化时后续分页不需要再读取整个子树
+        :param tree_ids: 结果依赖的树，None代表所有树
+        :param query: 返回(pk,兄弟顺序,...)的查询，父节点pk由_add_parent_column加在最后一列
+        """
+        def load():
+            rows=[(row,row[0],row[-1],row[1]) for row in self._add_parent_column(query)]
+            return [row[1] for row in self._sort_preorder(rows,key)]
+        if not self._use_cache(tree_ids):
+            return load()
+        cache_key=self._get_cache_key(tree_ids,args)
+        pks=self.cache.get(cache_key)
+        if pks is None:
+            pks=load()
+            self.cache.set(cache_key,pks)
+        return pks
+
+    def _iter_pks(self,pks,batch_size):
+        """ 按pks的顺序逐个返回节点，每次通过_get_nodes_by_pk载入batch_size个 """
+        for i in range(0,len(pks),batch_size):
+            for node in self._get_nodes_by_pk(pks[i:i+batch_size]):
+                yield node
+
+    def _check_after_left(self,after_left):
+        if after_left is not None:
+            raise TreeOperationNotSupported(u"闭包表模式的tree_left是兄弟节点之间的顺序，不能按after_left分页，请使用offset")
+
+    def iter_descendants(self,node,level=0,batch_size=1000):
+        """
+        闭包表模式需要取得整个子树的pk才能确定先序，内存中只保存pk列表，节点实例每次载入batch_size个
+        """
+        pks=self._get_preorder_pks([self.get_node_tree_id(node)],("preorder_descendants",self._get_node_pk(node),level),
+                                   self._get_descendants_pk_query(node,level))
+        return self._iter_pks(pks,batch_size)
+
+    def iter_nodes(self,tree_id=None,level=0,batch_size=1000):
+        """
+        闭包表模式需要取得所有节点的pk才能确定先序，内存中只保存pk列表，节点实例每次载入batch_size个
+        """
+        pks=self._get_preorder_pks([tree_id] if tree_id is not None else None,("preorder_nodes",tree_id,level),
+                                   self._get_nodes_pk_query(tree_id,level),key=lambda row:row[0][2])
+        return self._iter_pks(pks,batch_size)
+
+    @_profiled
+    def get_descendants_page(self,node,after_left=None,limit=100,level=0,offset=0):
+        """
+        按先序分页取得后代节点，顺序同get_descendants
+        闭包表模式的tree_left是兄弟节点之间的顺序，不支持after_left，使用offset分页，第一页为0，下一页使用offset+len(page)
+        每页只载入limit个节点，先序pk列表在设置了缓存时按树的版本号缓存
+        例：
+            page=tm.get_descendants_page(root,limit=50)
+            next_page=tm.get_descendants_page(root,limit=50,offset=len(page))
+        """
+        self._check_after_left(after_left)
+        pks=self._get_preorder_pks([self.get_node_tree_id(node)],("preorder_descendants",self._get_node_pk(node),level),
+                                   self._get_descendants_pk_query(node,level))
+        return self._get_nodes_by_pk(pks[offset:offset+limit])
+
+    @_profiled
+    def get_nodes_page(self,tree_id=0,after_left=None,limit=100,level=0,offset=0):
+        """
+        按先序分页取得节点，顺序同get_nodes，offset同get_descendants_page
+        """
+        self._check_after_left(after_left)
+        pks=self._get_preorder_pks([tree_id] if tree_id is not None else None,("preorder_nodes",tree_id,level),
+                                   self._get_nodes_pk_query(tree_id,level),key=lambda row:row[0][2])
+        return self._get_nodes_by_pk(pks[offset:offset+limit])
+
+    def snapshot(self,tree_id=0):
+        raise TreeOperationNotSupported(u"闭包表模式不支持snapshot")
+
+    @_profiled
+    def verify_tree(self,tree_id=0,batch_size=1000):
+        """
+            校验闭包表与节点的一致性
+        以闭包表中深度为1的记录确定父节点，检查每个节点的闭包记录是否正好是自身(深度0)及沿父节点得到的所有祖先(深度依次加1)。
+        tree_left是兄弟节点之间的顺序，不检查gaps、overlaps。
+        :param tree_id:树标识，如果=None则校验所有树
+        :param batch_size:每次从数据库读取的记录数
+        :return:TreeVerifyReport实例,包括:
+                closure : 闭包记录不正确、父节点不唯一或者与__tree_parent_field__不一致的节点
+                orphans : 不能沿父节点到达根节点的节点，包括父节点形成环的节点
+                levels  : tree_level不正确的节点
+        """
+        cls=self._model_class
+        closure=self.get_closure_table()
+        tree_key=cls.__dict__[cls.__tree_key__]
+        pk_field=cls.__dict__[self.get_primary_field().name]
+        parent_field=self._get_parent_field()
+        columns=[pk_field,tree_key,cls.tree_level]
+        if parent_field is not None:
+            columns.append(cls.__dict__[parent_field])
+        rs=self._session.query(*columns)
+        closure_rs=self._session.query(closure.c.ancestor,closure.c.descendant,closure.c.depth)
+        if tree_id is not None:
+            rs=rs.filter(tree_key==tree_id)
+            closure_rs=closure_rs.join(cls,pk_field==closure.c.descendant).filter(tree_key==tree_id)
+        nodes={}#{pk:(tree_id,tree_level,父节点字段值)}
+        for row in rs.yield_per(batch_size):
+            nodes[row[0]]=(row[1],row[2],row[3] if parent_field is not None else None)
+        ancestors={}#{pk:{祖先pk:深度}}
+        for ancestor,descendant,depth in closure_rs.yield_per(batch_size):
+            ancestors.setdefault(descendant,{})[ancestor]=depth
+
+        report=TreeVerifyReport()
+        report["count"]=len(nodes)
+        parents={}
+        roots={}#{tree_id:根节点pk}，没有父节点的节点中tree_level最小的作为根节点
+        for pk in sorted(nodes,key=lambda pk:nodes[pk][1]):
+            node_tree_id=nodes[pk][0]
+            parent_pks=[ancestor for ancestor,depth in ancestors.get(pk,{}).items() if depth==1]
+            if len(parent_pks)>1 or (parent_field is not None and nodes[pk][2]!=(parent_pks[0] if parent_pks else None)):
+                report["closure"].append((node_tree_id,pk))
+            if parent_pks and parent_pks[0] in nodes:
+                parents[pk]=parent_pks[0]
+            elif node_tree_id not in roots:
+                roots[node_tree_id]=pk
+        for pk,(node_tree_id,level,parent_value) in nodes.items():
+            path=[]
+            ancestor=parents.get(pk)
+            while ancestor is not None and ancestor!=pk and ancestor not in path:
+                path.append(ancestor)
+                ancestor=parents.get(ancestor)
+            if (path[-1] if path else pk)!=roots.get(node_tree_id) or ancestor is not None:
+                report["orphans"].append((node_tree_id,pk))
+            elif level!=len(path)+1:
+                report["levels"].append((node_tree_id,pk,level,len(path)+1))
+            expected=dict((ancestor,depth+1) for depth,ancestor in enumerate(path))
+            expected[pk]=0
+            if ancestors.get(pk)!=expected and (node_tree_id,pk) not in report["closure"]:
+                report["closure"].append((node_tree_id,pk))
+        return report
+
+    def repair_tree(self,tree_id=0,parent_field=None,batch_size=1000):
+        raise TreeOperationNotSupported(u"闭包表模式不支持repair_tree")
 
 
 class TreeMixin(object):
@@ -847,6 +3724,15 @@ class TreeMixin(object):
     #__tree_node_description__=""           #声明节点说明的字段名称
     #__tree_node_status__=""                #声明节点状态的字段名称  0-关闭，1-打开但数据未加载,2-打开数据已加载
     #__tree_node_icon__=""                  #声明节点图标的字段名称,一般是图标名称,open,close
+    #__tree_closure_table__=""              #ClosureTreeManager使用的闭包表名称，默认为"<表名>_closure"
+    #__tree_spacing__=1                     #左右值的间隔,1-连续编号。大于1时为间隔编号,增加、移动节点时尽量在已有的空隙中分配左右值，
+                                            #删除节点时不需要调整其他节点，只有空隙用完时才需要后移后面的节点
+    __tree_parent_field__="tree_parent_id" #保存父节点pk值的字段名称,模型中定义了该字段(类型与主键相同)时，增加、移动、修复节点时会同时维护该字段，
+                                            #取父节点、子节点、兄弟节点时直接按该字段查询。没有定义该字段时不使用
+    __tree_path_field__="tree_path"         #保存节点路径的字段名称，路径由根节点到该节点的pk值组成，如/1/17/204/，模型中定义了该字段(字符串类型)时，
+                                            #增加、移动、修复节点时会同时维护该字段，取祖先节点时解析路径按pk查询，取后代节点时按路径前缀查询。没有定义该字段时不使用
+    __tree_version_field__="tree_version"   #保存树版本号的字段名称，只使用根节点的值，模型中定义了该字段(整数类型，默认值0)时，每次修改树结构都通过带条件的UPDATE将版本号加1，
+                                            #如果树已经被其他事务修改则发生TreeVersionConflict。没有定义该字段时不使用
 
     tree_id = Column(Integer, default=0)#用来标识节点是哪一棵树的,默认为零,如果指定__tree_key__为其他值时，则以__tree_key__字段什来标识树，该字段就没有用。
     tree_left = Column(Integer, default=0)
@@ -877,7 +3763,7 @@ class TreeMixin(object):
     #返回树Key
     tree_key=property(lambda self:self._TreeManager.get_node_tree_id(self))
     #以下是用来获取节点关联属性的方法
-    is_root=property(lambda self:self.tree_left==1)
+    is_root=property(lambda self:self._TreeManager.is_root(self))
     next_sibling=property(lambda self:self._TreeManager.get_next_sibling(self))
     previous_sibling=property(lambda self:self._TreeManager.get_previous_sibling(self))
     siblings=property(lambda self:self._TreeManager.get_siblings(self))
@@ -165,6 +165,195 @@ elif ACTION==10:
 
     child_node_b=User(name="B")
     root_node.add_child(child_node_b)
+elif ACTION==11:#两个会话共用缓存时，未提交及已回滚的修改不能被缓存
+    from satree import LocalTreeCache
+    cache=LocalTreeCache()
+    session2=sessionmaker(bind=engine)()
+    tm1=TreeManager(User,session,cache=cache)
+    tm2=TreeManager(User,session2,cache=cache)
+    root1=session.query(User).filter(User.name == "root1").one()
+    root2=session2.query(User).filter(User.name == "root1").one()
+    tm1.output(root1)
+    #同一个会话增加节点、输出后回滚，不能再输出已回滚的节点
+    tm1.add_node(User(name="cache_check"),root1)
+    session.flush()
+    assert "cache_check" in tm1.output(root1)
+    session.rollback()
+    assert "cache_check" not in tm1.output(root1)
+    #会话A增加节点未提交时，会话B按已提交的数据输出并写入缓存，A提交后B需要输出新节点
+    new_node=User(name="cache_check")
+    tm1.add_node(new_node,root1)
+    session.flush()
+    assert "cache_check" not in tm2.output(root2)
+    session.commit()
+    session2.expire_all()
+    assert "cache_check" in tm2.output(root2)
+    tm1.del_node(new_node)
+    session.commit()
+    session2.expire_all()
+    assert "cache_check" not in tm2.output(root2)
+    session2.close()
+elif ACTION==12:#profile只记录当前线程的调用，其他线程共用TreeManager时不被记录
+    import threading
+    from sqlalchemy.orm import scoped_session
+    scoped=scoped_session(sessionmaker(bind=engine))
+    tm_shared=TreeManager(User,scoped)
+    started=threading.Event()
+    finished=threading.Event()
+    result={}
+    def other_request():
+        started.wait()
+        result["profiler"]=tm_shared.profiler
+        root=scoped.query(User).filter(User.name == "root1").one()
+        for i in range(10):
+            tm_shared.get_descendants(root)
+        finished.set()
+        scoped.remove()
+    thread=threading.Thread(target=other_request)
+    thread.start()
+    root=scoped.query(User).filter(User.name == "root1").one()
+    with tm_shared.profile() as profiler:
+        started.set()
+        tm_shared.output(root)
+        finished.wait()
+    thread.join()
+    scoped.remove()
+    assert result["profiler"] is None
+    assert profiler.as_dict().keys()==["output"]
+    assert profiler.as_dict()["output"]["statements"]==1
+    assert tm_shared.profiler is None
+elif ACTION==13:#随机批量移动、删除节点，每一步之后校验树结构，连续编号与间隔编号的结果应该相同
+    import random
+    batch_engine=create_engine("sqlite://")
+    BatchBase=declarative_base()
+    class BatchNode(BatchBase,TreeMixin):
+        __tablename__="batch_node"
+        id=Column(Integer,primary_key=True)
+        name=Column(String(60),default="")
+    class SpacedBatchNode(BatchBase,TreeMixin):
+        __tablename__="spaced_batch_node"
+        __tree_spacing__=8
+        id=Column(Integer,primary_key=True)
+        name=Column(String(60),default="")
+    BatchBase.metadata.create_all(batch_engine)
+    batch_session=sessionmaker(bind=batch_engine)()
+    #[(ORM类,会话,TreeManager)]，对每棵树执行相同的操作，结果应该相同
+    trees=[(cls,batch_session,TreeManager(cls,batch_session)) for cls in (BatchNode,SpacedBatchNode)]
+
+    def batch_nodes(cls,batch_session,names):
+        return [batch_session.query(cls).filter(cls.name==name).one() for name in names]
+
+    def batch_shape(batch_tm):
+        return [(node.name,node.tree_level) for node in batch_tm.get_nodes(0)]
+
+    random.seed(13)
+    for cls,batch_session,batch_tm in trees:
+        batch_tm.add_node(cls(name="n0",tree_id=0))
+        batch_session.commit()
+    count=1
+    for step in range(300):
+        nodes=trees[0][2].get_nodes(0)
+        if len(nodes)<20 or random.random()<0.2:
+            parent_name=random.choice(nodes).name
+            for cls,batch_session,batch_tm in trees:
+                batch_tm.add_node(cls(name="n%s" % count),batch_nodes(cls,batch_session,[parent_name])[0])
+            count+=1
+        else:
+            picked=[node.name for node in random.sample(nodes[1:],random.randint(1,5))]
+            if random.random()<0.3:
+                for cls,batch_session,batch_tm in trees:
+                    batch_tm.del_nodes(batch_nodes(cls,batch_session,picked))
+            else:
+                #目标节点不能是选中节点或其后代
+                selected=[node for node in nodes if node.name in picked]
+                refs=[node for node in nodes if not any(s.tree_left<=node.tree_left<=s.tree_right for s in selected)]
+                ref=random.choice(refs)
+                pos=random.randint(0,3) if ref.tree_level>1 else random.randint(0,1)
+                for cls,batch_session,batch_tm in trees:
+                    batch_tm.move_nodes(batch_nodes(cls,batch_session,picked),batch_nodes(cls,batch_session,[ref.name])[0],pos)
+        for cls,batch_session,batch_tm in trees:
+            batch_session.commit()
+            report=batch_tm.verify_tree(0)
+            assert report,(step,dict(report))
+            assert batch_shape(batch_tm)==batch_shape(trees[0][2]),step
+    for cls,batch_session,batch_tm in trees:
+        batch_session.close()
+elif ACTION==14:#闭包表与左右值执行相同的随机增加、移动、删除操作，节点、关系及输出应该相同
+    import json
+    import random
+    from satree import ClosureTreeManager
+    closure_engine=create_engine("sqlite://")
+    ClosureBase=declarative_base()
+    class NestedNode(ClosureBase,TreeMixin):
+        __tablename__="nested_node"
+        __tree_output_fields__=["name"]
+        id=Column(Integer,primary_key=True)
+        name=Column(String(60),default="")
+    class ClosureNode(ClosureBase,TreeMixin):
+        __tablename__="closure_node"
+        __tree_output_fields__=["name"]
+        id=Column(Integer,primary_key=True)
+        name=Column(String(60),default="")
+    closure_session=sessionmaker(bind=closure_engine)()
+    nested_tm=TreeManager(NestedNode,closure_session)
+    closure_tm=ClosureTreeManager(ClosureNode,closure_session)
+    closure_tm.get_closure_table()
+    ClosureBase.metadata.create_all(closure_engine)
+    trees=[(NestedNode,nested_tm),(ClosureNode,closure_tm)]
+
+    def closure_nodes(cls,names):
+        return [closure_session.query(cls).filter(cls.name==name).one() for name in names]
+
+    random.seed(14)
+    for cls,closure_tree_tm in trees:
+        closure_tree_tm.add_node(cls(name="n0",tree_id=0))
+    closure_session.commit()
+    count=1
+    for step in range(300):
+        nodes=nested_tm.get_nodes(0)
+        ref=random.choice(nodes)
+        pos=random.randint(0,3) if ref.tree_level>1 else random.randint(0,1)
+        action=random.random()
+        if len(nodes)<20 or action<0.4:
+            for cls,closure_tree_tm in trees:
+                closure_tree_tm.add_node(cls(name="n%s" % count),closure_nodes(cls,[ref.name])[0],pos)
+            count+=1
+        elif action<0.85:
+            #不能移动到自身或者后代节点的位置
+            candidates=[node for node in nodes[1:] if not node.tree_left<=ref.tree_left<=node.tree_right]
+            if candidates:
+                node_name=random.choice(candidates).name
+                for cls,closure_tree_tm in trees:
+                    closure_tree_tm.move_node(closure_nodes(cls,[node_name])[0],closure_nodes(cls,[ref.name])[0],pos)
+        else:
+            node_name=random.choice(nodes[1:]).name
+            for cls,closure_tree_tm in trees:
+                closure_tree_tm.del_node(closure_nodes(cls,[node_name])[0])
+        closure_session.commit()
+        assert nested_tm.verify_tree(0),step
+        report=closure_tm.verify_tree(0)
+        assert report,(step,dict(report))
+        names=[node.name for node in nested_tm.get_nodes(0)]
+        assert [(node.name,node.tree_level) for node in nested_tm.get_nodes(0)]==\
+               [(node.name,node.tree_level) for node in closure_tm.get_nodes(0)],step
+        pairs=[random.sample(names,2) for i in range(5) if len(names)>1]
+        for node_name,ref_name in pairs:
+            assert nested_tm.get_node_relation(*closure_nodes(NestedNode,[node_name,ref_name]))==\
+                   closure_tm.get_node_relation(*closure_nodes(ClosureNode,[node_name,ref_name])),(step,node_name,ref_name)
+        assert json.loads(nested_tm.output(closure_nodes(NestedNode,["n0"])))==\
+               json.loads(closure_tm.output(closure_nodes(ClosureNode,["n0"]))),step
+        #按offset分页及iter_descendants在两种模式下顺序相同
+        for cls,closure_tree_tm in trees:
+            root=closure_nodes(cls,["n0"])[0]
+            page_names=[]
+            while True:
+                page=closure_tree_tm.get_descendants_page(root,limit=7,offset=len(page_names))
+                page_names.extend(node.name for node in page)
+                if len(page)<7:
+                    break
+            assert page_names==names[1:],step
+            assert [node.name for node in closure_tree_tm.iter_descendants(root,batch_size=5)]==names[1:],step
+    closure_session.close()
 
 
 session.commit()